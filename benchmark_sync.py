@@ -0,0 +1,394 @@
+# benchmark_sync.py
+# Measures how a complete synchronization scales with the number of contacts.
+# A local fake CardDAV server (in its own process) serves synthetic address books generated on the fly, the sync
+# runs against an in-memory ldap3 MOCK_SYNC directory (or a throwaway LDAP server given with --ldap-server).
+# For every contact count, an initial run (empty directory) and a second run without changes are measured:
+# wall time, throughput, peak RSS and the time spent in every stage of the pipeline.
+#
+# Usage: python benchmark_sync.py [--contacts 1000,10000,100000] [--books 1] [--photo-ratio 0.3] [--photo-bytes 8000]
+#                                 [--tels 3] [--emails 2] [--non-ascii 0.5] [--seed 42]
+#                                 [--set CARDDAV_FETCH_MODE=etag --set CARDDAV_PARSE_WORKERS=4 ...] [--json results.json]
+
+import argparse
+import base64
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource # Import for the peak RSS of the sync process
+import shutil
+import sys
+import tempfile
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape as xml_escape
+
+# --- Synthetic vCards ---
+GIVEN_NAMES_ASCII = ["Anna", "Peter", "Laura", "Tom", "Maria", "Jan", "Emma", "Noah", "Sara", "Lukas"]
+GIVEN_NAMES_NON_ASCII = ["Jörg", "Zoë", "Łukasz", "François", "María", "Ørjan", "Çağla", "Dƣng", "李", "Åsa"]
+SURNAMES_ASCII = ["Smith", "Miller", "Schmidt", "Brown", "Fischer", "Wagner", "Jones", "Taylor", "Meyer", "Weber"]
+SURNAMES_NON_ASCII = ["Müller", "Nguyễn", "Ström", "Kowalczyk", "Dubois-Lefèvre", "王", "Øvrebø", "Şahin", "Ruíz", "Jäger"]
+DOMAINS = ["example.com", "example.org", "mail.example.net", "firma.example.de"]
+TEL_TYPES = ["WORK,VOICE", "HOME,VOICE", "CELL", "WORK,FAX", "VOICE"]
+CATEGORIES = ["Family", "Work", "VIP", "Suppliers", "Friends", "Sports"]
+
+def fold(line):
+    """Folds a content line to 75 characters, as CardDAV servers do."""
+    parts = [line[:75]]
+    for start in range(75, len(line), 74):
+        parts.append(" " + line[start:start + 74])
+    return "\r\n".join(parts)
+
+def build_photo_pool(photo_bytes, seed):
+    """
+    Returns a few photos of about photo_bytes bytes. Real JPEGs if Pillow is installed, so that
+    CARDDAV_NORMALIZE_PHOTOS has something to convert, otherwise random bytes behind a JPEG header.
+    """
+    rng = random.Random(seed)
+    pool = []
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    for _ in range(8):
+        if Image is None:
+            pool.append(b"\xff\xd8\xff\xe0" + rng.randbytes(max(0, photo_bytes - 4)))
+            continue
+        # Noise compresses badly, so the JPEG size grows roughly with the pixel count
+        dimension = max(16, int((photo_bytes / 0.9) ** 0.5))
+        buffer = io.BytesIO()
+        Image.effect_noise((dimension, dimension), rng.randrange(30, 90)).convert("RGB").save(buffer, format="JPEG", quality=85)
+        pool.append(buffer.getvalue())
+    return pool
+
+def generate_vcard(seed, book, index, profile, photo_pool):
+    """Generates the vCard of one contact. The same arguments always give the same card."""
+    rng = random.Random(f"{seed}-{book}-{index}")
+    non_ascii = rng.random() < profile["non_ascii"]
+    given = rng.choice(GIVEN_NAMES_NON_ASCII if non_ascii else GIVEN_NAMES_ASCII)
+    surname = rng.choice(SURNAMES_NON_ASCII if non_ascii else SURNAMES_ASCII)
+    # The index keeps the names unique, so every contact gets its own LDAP entry
+    lines = ["BEGIN:VCARD", "VERSION:3.0", f"UID:bench-{book}-{index}", f"FN:{given} {surname} {book}{index}",
+             f"N:{surname} {book}{index};{given};;;"]
+    for n in range(profile["emails"]):
+        lines.append(f"EMAIL;TYPE=INTERNET:{given.lower()}.{index}.{n}@{rng.choice(DOMAINS)}")
+    for n in range(profile["tels"]):
+        lines.append(f"TEL;TYPE={rng.choice(TEL_TYPES)}:+49 {rng.randrange(30, 999)} {rng.randrange(10**5, 10**8)}")
+    lines.append(f"ADR;TYPE=WORK:;;Hauptstraße {rng.randrange(1, 200)};Berlin;;{rng.randrange(10000, 99999)};Germany")
+    lines.append(f"ORG:{rng.choice(['ACME Corp', 'Müller & Söhne GmbH', 'Example Inc.'])};{rng.choice(['Sales', 'R&D', 'Support'])}")
+    lines.append("TITLE:" + rng.choice(["Engineer", "Geschäftsführer", "Head of Sales"]))
+    lines.append(f"CATEGORIES:{','.join(rng.sample(CATEGORIES, rng.randrange(1, 3)))}")
+    if photo_pool and rng.random() < profile["photo_ratio"]:
+        lines.append("PHOTO;ENCODING=b;TYPE=JPEG:" + base64.b64encode(rng.choice(photo_pool)).decode("ascii"))
+    lines.append("REV:2024-01-01T00:00:00Z")
+    lines.append("END:VCARD")
+    return "\r\n".join(fold(line) for line in lines) + "\r\n"
+
+# --- Fake CardDAV server ---
+class FakeCardDavHandler(BaseHTTPRequestHandler):
+    """
+    Answers the requests of the sync: PROPFIND on the base URL (discovery) and on an address book (full fetch or
+    ETag list), sync-collection and addressbook-multiget REPORTs. Responses are streamed with chunked encoding,
+    cards are generated while they are sent, so the server needs little memory for large address books.
+    The contents never change, so a sync-collection with the current token returns no changes.
+    """
+    protocol_version = "HTTP/1.1"
+    MULTISTATUS_START = '<?xml version="1.0" encoding="utf-8"?><d:multistatus xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:carddav" xmlns:cs="http://calendarserver.org/ns/">'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+
+    def send_multistatus(self, parts):
+        """Sends the multistatus parts (an iterable of str) with chunked transfer encoding, in chunks of about 64 KiB."""
+        self.send_response(207)
+        self.send_header("Content-Type", "application/xml; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        buffer = []
+        buffered = 0
+        for part in self.iter_with_frame(parts):
+            buffer.append(part)
+            buffered += len(part)
+            if buffered >= 65536:
+                self.write_chunk("".join(buffer).encode("utf-8"))
+                buffer, buffered = [], 0
+        if buffer:
+            self.write_chunk("".join(buffer).encode("utf-8"))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def iter_with_frame(self, parts):
+        yield self.MULTISTATUS_START
+        yield from parts
+        yield "</d:multistatus>"
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+    def card_response(self, book, index, with_data):
+        server = self.server
+        data = ""
+        if with_data:
+            data = f"<c:address-data>{xml_escape(generate_vcard(server.seed, book, index, server.profile, server.photo_pool))}</c:address-data>"
+        return (f'<d:response><d:href>/dav/{book}/{index}.vcf</d:href><d:propstat><d:prop>'
+                f'<d:getetag>"{server.seed}-{book}-{index}"</d:getetag>{data}</d:prop>'
+                f'<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>')
+
+    def book_from_path(self):
+        match = re.fullmatch(r"/dav/([^/]+)/", self.path)
+        if match and match.group(1) in self.server.books:
+            return match.group(1)
+        return None
+
+    def do_PROPFIND(self):
+        body = self.read_body()
+        if self.path == "/dav/":
+            parts = ['<d:response><d:href>/dav/</d:href><d:propstat><d:prop><d:resourcetype><d:collection/></d:resourcetype>'
+                     '</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>']
+            for book in self.server.books:
+                parts.append(f'<d:response><d:href>/dav/{book}/</d:href><d:propstat><d:prop><d:resourcetype><d:collection/>'
+                             f'<c:addressbook/></d:resourcetype><d:displayname>{book}</d:displayname><cs:getctag>ctag-1</cs:getctag>'
+                             f'<d:sync-token>tok-1</d:sync-token></d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>')
+            self.send_multistatus(parts)
+            return
+        book = self.book_from_path()
+        if book is None:
+            self.send_error(404)
+            return
+        with_data = "address-data" in body
+        self.send_multistatus(self.card_response(book, index, with_data) for index in range(self.server.books[book]))
+
+    def do_REPORT(self):
+        body = self.read_body()
+        book = self.book_from_path()
+        if book is None:
+            self.send_error(404)
+            return
+        if "sync-collection" in body:
+            # Nothing changes after the initial sync, the current token returns an empty change list
+            unchanged = re.search(r"<D:sync-token>tok-1</D:sync-token>", body, re.IGNORECASE) is not None
+            cards = [] if unchanged else (self.card_response(book, index, "address-data" in body) for index in range(self.server.books[book]))
+            self.send_multistatus(self.iter_then(cards, "<d:sync-token>tok-1</d:sync-token>"))
+            return
+        if "addressbook-multiget" in body:
+            indexes = [int(i) for i in re.findall(rf"<D:href>/dav/{re.escape(book)}/(\d+)\.vcf</D:href>", body, re.IGNORECASE)]
+            self.send_multistatus(self.card_response(book, index, True) for index in indexes)
+            return
+        self.send_error(400)
+
+    @staticmethod
+    def iter_then(parts, last):
+        yield from parts
+        yield last
+
+def serve_fake_carddav(books, seed, profile, port_queue):
+    """Runs the fake CardDAV server (in its own process) until it is terminated."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCardDavHandler)
+    server.daemon_threads = True
+    server.books = books
+    server.seed = seed
+    server.profile = profile
+    server.photo_pool = build_photo_pool(profile["photo_bytes"], seed) if profile["photo_ratio"] > 0 else []
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+# --- LDAP target ---
+MOCK_BASE_DN = "ou=contacts,dc=example,dc=com"
+MOCK_ADMIN_DN = "cn=admin,dc=example,dc=com"
+MOCK_ADMIN_PASSWORD = "benchmark"
+
+def use_mock_ldap():
+    """Makes every ldap3.Connection of the sync use one shared in-memory MOCK_SYNC directory with an empty base DN."""
+    import ldap3
+    mock_server = ldap3.Server("mock")
+    real_connection = ldap3.Connection
+    setup = real_connection(mock_server, user=MOCK_ADMIN_DN, password=MOCK_ADMIN_PASSWORD, client_strategy=ldap3.MOCK_SYNC)
+    setup.strategy.add_entry(MOCK_ADMIN_DN, {"userPassword": MOCK_ADMIN_PASSWORD, "sn": "admin"})
+    setup.strategy.add_entry(MOCK_BASE_DN, {"objectClass": ["organizationalUnit"], "ou": "contacts"})
+
+    def mock_connection(server, *args, **kwargs):
+        kwargs["client_strategy"] = ldap3.MOCK_SYNC
+        return real_connection(mock_server, *args, **kwargs)
+    ldap3.Connection = mock_connection
+
+# --- Running the sync ---
+def peak_rss_mb():
+    """Returns the peak RSS of this process, in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def parse_workers_peak_rss_mb(synchronizer):
+    """
+    Returns the peak RSS of the largest running parse worker, in MiB (0 without workers or outside Linux).
+    The workers are started by a fork server, so they are not children of this process and are read from /proc.
+    """
+    peak = 0.0
+    processes = getattr(synchronizer.parse_executor, "_processes", None) or {}
+    for process in list(processes.values()):
+        try:
+            with open(f"/proc/{process.pid}/status", encoding="ascii") as status_file:
+                for line in status_file:
+                    if line.startswith("VmHWM:"):
+                        peak = max(peak, int(line.split()[1]) / 1024)
+        except (OSError, ValueError):
+            continue
+    return peak
+
+def run_sync_process(environment, use_mock, cycles, log_path, result_connection):
+    """Runs the sync cycles in a fresh process and sends one result dict per cycle back."""
+    try:
+        # The log of the sync goes to a file, only the number of warnings and errors is reported
+        log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(log_fd, 1)
+        sys.stdout = os.fdopen(1, "w", closefd=False)
+        os.environ.update(environment)
+        if use_mock:
+            use_mock_ldap()
+        from carddav2ldap.config import load_config
+        from carddav2ldap.sync import Synchronizer
+        from carddav2ldap.logging_config import configure_logging
+        config = load_config()
+        configure_logging(config)
+        # Connections, parse workers and sync state are kept between the cycles, as in daemon mode
+        synchronizer = Synchronizer(config, keep_connections=True)
+        results = []
+        try:
+            for cycle in cycles:
+                start = time.perf_counter()
+                succeeded = synchronizer.run_cycle()
+                wall = time.perf_counter() - start
+                # Stage times and counters as recorded by the sync itself (see carddav2ldap/metrics.py)
+                report = synchronizer.metrics.report()
+                results.append({"cycle": cycle, "succeeded": succeeded, "wall": wall, "stages": report["stage_seconds"],
+                                "counters": report["counters"],
+                                "peak_rss_mb": peak_rss_mb(), "peak_rss_children_mb": parse_workers_peak_rss_mb(synchronizer)})
+        finally:
+            synchronizer.close()
+        result_connection.send(results)
+    except BaseException as e:
+        result_connection.send({"error": f"{type(e).__name__}: {e}"})
+        raise
+
+def count_log_problems(log_path):
+    """Returns the number of WARNING and ERROR lines in a sync log (LOG_FORMAT text or json)."""
+    warnings = errors = 0
+    with open(log_path, encoding="utf-8", errors="replace") as log_file:
+        for line in log_file:
+            level = json.loads(line).get("level") if line.startswith("{") else line.split(":", 1)[0]
+            if level == "WARNING":
+                warnings += 1
+            elif level == "ERROR":
+                errors += 1
+    return warnings, errors
+
+def benchmark_contact_count(contact_count, args, profile, settings, work_dir):
+    """Measures an initial and an unchanged run with contact_count contacts. Returns the result of both cycles."""
+    context = multiprocessing.get_context("fork")
+    # Spread the contacts over the address books
+    books = {f"book{n}": contact_count // args.books + (1 if n < contact_count % args.books else 0) for n in range(args.books)}
+    port_queue = context.Queue()
+    server_process = context.Process(target=serve_fake_carddav, args=(books, args.seed, profile, port_queue), daemon=True)
+    server_process.start()
+    try:
+        port = port_queue.get(timeout=60)
+        run_dir = os.path.join(work_dir, str(contact_count))
+        os.makedirs(run_dir, exist_ok=True)
+        environment = {
+            "CARDDAV_BASE_DISCOVERY_URL": f"http://127.0.0.1:{port}/dav/",
+            "CARDDAV_USERNAME": "benchmark",
+            "CARDDAV_PASSWORD": "benchmark",
+            "CARDDAV_IMPORT_PHOTOS": "true" if profile["photo_ratio"] > 0 else "false",
+            "SYNC_STATE_FILE": os.path.join(run_dir, "state.json"),
+            "SYNC_LOCK_FILE": os.path.join(run_dir, "sync.lock"),
+            "CARDDAV_PHOTO_CACHE_DIR": os.path.join(run_dir, "photo_cache"),
+        }
+        if args.ldap_server:
+            environment["LDAP_SERVER"] = args.ldap_server
+        else:
+            environment.update({"LDAP_SERVER": "ldap://mock", "LDAP_USER": MOCK_ADMIN_DN,
+                                "LDAP_PASSWORD": MOCK_ADMIN_PASSWORD, "LDAP_BASE_DN": MOCK_BASE_DN})
+        environment.update(settings)
+        log_path = os.path.join(run_dir, "sync.log")
+        receiving_end, sending_end = context.Pipe(duplex=False)
+        sync_process = context.Process(target=run_sync_process,
+                                       args=(environment, not args.ldap_server, ["initial", "unchanged"], log_path, sending_end))
+        sync_process.start()
+        sending_end.close()
+        results = receiving_end.recv()
+        sync_process.join()
+        if isinstance(results, dict):
+            raise RuntimeError(f"Sync process failed: {results['error']} (log: {log_path})")
+        warnings, errors = count_log_problems(log_path)
+        for result in results:
+            result.update({"contacts": contact_count, "books": args.books, "log_warnings": warnings, "log_errors": errors})
+        return results
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+def print_result(result):
+    stages = result["stages"]
+    stage_text = " ".join(f"{stage}={seconds:.2f}s" for stage, seconds in stages.items() if seconds)
+    print(f"INFO: {result['contacts']:>7} contacts, {result['cycle']:<9} {'ok' if result['succeeded'] else 'FAILED'}: "
+          f"{result['wall']:.2f}s wall, {result['contacts'] / result['wall']:.0f} contacts/s, "
+          f"peak RSS {result['peak_rss_mb']:.0f} MiB (parse workers {result['peak_rss_children_mb']:.0f} MiB)")
+    print(f"INFO:         stages: {stage_text}")
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Benchmarks complete synchronizations against a local fake CardDAV server.")
+    argument_parser.add_argument("--contacts", default="1000,10000,100000", help="comma-separated contact counts (default 1000,10000,100000)")
+    argument_parser.add_argument("--books", type=int, default=1, help="number of address books the contacts are spread over")
+    argument_parser.add_argument("--photo-ratio", type=float, default=0.3, help="share of contacts with a photo (default 0.3)")
+    argument_parser.add_argument("--photo-bytes", type=int, default=8000, help="approximate size of a photo (default 8000)")
+    argument_parser.add_argument("--tels", type=int, default=3, help="TEL properties per contact (default 3)")
+    argument_parser.add_argument("--emails", type=int, default=2, help="EMAIL properties per contact (default 2)")
+    argument_parser.add_argument("--non-ascii", type=float, default=0.5, help="share of contacts with non-ASCII names (default 0.5)")
+    argument_parser.add_argument("--seed", type=int, default=42, help="seed of the generated contacts")
+    argument_parser.add_argument("--set", action="append", default=[], metavar="VAR=VALUE",
+                                 help="setting for the sync, e.g. CARDDAV_PARSE_WORKERS=4 (may be repeated)")
+    argument_parser.add_argument("--ldap-server", help="use this (throwaway!) LDAP server instead of the in-memory mock, "
+                                 "LDAP_USER, LDAP_PASSWORD and LDAP_BASE_DN are taken from the environment or --set")
+    argument_parser.add_argument("--json", help="also write the results to this JSON file")
+    argument_parser.add_argument("--keep-logs", action="store_true", help="keep the sync logs and state files")
+    args = argument_parser.parse_args()
+
+    settings = {}
+    for setting in args.set:
+        name, separator, value = setting.partition("=")
+        if not separator:
+            argument_parser.error(f"--set expects VAR=VALUE, got '{setting}'")
+        settings[name] = value
+    profile = {"photo_ratio": args.photo_ratio, "photo_bytes": args.photo_bytes, "tels": args.tels,
+               "emails": args.emails, "non_ascii": args.non_ascii}
+    contact_counts = [int(count) for count in args.contacts.split(",") if count.strip()]
+
+    work_dir = tempfile.mkdtemp(prefix="carddav2ldap-benchmark-")
+    print(f"INFO: Profile: {profile}, {args.books} address book(s), settings: {settings or 'defaults'}")
+    all_results = []
+    failed = False
+    try:
+        for contact_count in contact_counts:
+            results = benchmark_contact_count(contact_count, args, profile, settings, work_dir)
+            for result in results:
+                print_result(result)
+                failed = failed or not result["succeeded"]
+            if results[0]["log_errors"] or results[0]["log_warnings"]:
+                print(f"WARNING: The sync logged {results[0]['log_errors']} error(s) and {results[0]['log_warnings']} warning(s).")
+            sys.stdout.flush()
+            all_results.extend(results)
+    finally:
+        if args.keep_logs:
+            print(f"INFO: Logs and state files kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump({"profile": profile, "books": args.books, "settings": settings, "results": all_results}, json_file, indent=2)
+        print(f"INFO: Results written to {args.json}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
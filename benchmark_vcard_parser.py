@@ -0,0 +1,126 @@
+# benchmark_vcard_parser.py
+# Compares the fast vCard parser (CARDDAV_FAST_VCARD_PARSER) with vobject on a generated corpus.
+# Every card is parsed with both parsers first and the contact_data must be identical (golden check),
+# then both parsers are timed. Exits with status 1 if any card differs. tests/test_vcard_parser.py runs the
+# same check on part of the corpus and also checks that the name and address fields are filled in.
+#
+# Usage: python benchmark_vcard_parser.py [number of cards] [repetitions]
+
+import base64
+import quopri
+import random
+import sys
+import time
+
+from carddav2ldap.vcard_parser import parse_card, fast_read_vcard
+
+BOOK_URL = "https://carddav.example.com/addressbooks/user/contacts/"
+
+GIVEN_NAMES = ["Anna", "Jörg", "Zoë", "Łukasz", "François", "María", "Ole", "Sven", "Emma", "Noah", "李", "Ørjan"]
+SURNAMES = ["Müller", "Smith", "O'Brien", "Nguyễn", "Schmidt", "García", "Kowalski", "Dubois", "Ström", "王"]
+DOMAINS = ["example.com", "example.org", "mail.example.net", "firma.example.de"]
+TEL_TYPES = ["WORK", "HOME", "CELL", "FAX", "VOICE", "PAGER", "work", "cell", "VOICE,WORK", "HOME,FAX"]
+CATEGORIES = ["Family", "Work", "VIP", "Suppliers", "Friends\\, Old", "Sports"]
+
+def fold(line):
+    """Folds a content line to 75 characters, as CardDAV servers do."""
+    parts = [line[:75]]
+    line = line[75:]
+    while line:
+        parts.append(" " + line[:74])
+        line = line[74:]
+    return "\r\n".join(parts)
+
+def escape_text(text):
+    return text.replace("\\", "\\\\").replace(",", "\\,").replace(";", "\\;").replace("\n", "\\n")
+
+def generate_vcard(rng, index):
+    """Generates one random vCard. Most cards are plain vCard 3.0, some use features only vobject handles."""
+    given = rng.choice(GIVEN_NAMES)
+    surname = rng.choice(SURNAMES)
+    lines = ["BEGIN:VCARD", "VERSION:3.0", f"UID:{index:08d}-{rng.randrange(10**8):08d}"]
+    if rng.random() < 0.9:
+        lines.append(f"FN:{escape_text(f'{given} {surname}')}")
+    elif rng.random() < 0.5:
+        lines.append("FN:")
+    lines.append(f"N:{escape_text(surname)};{escape_text(given)};;;")
+    for n in range(rng.randrange(0, 4)):
+        group = f"item{n}." if rng.random() < 0.2 else ""
+        params = ";TYPE=INTERNET" if rng.random() < 0.5 else ""
+        lines.append(f"{group}EMAIL{params}:{given.lower()}.{n}@{rng.choice(DOMAINS)}")
+    for _ in range(rng.randrange(0, 5)):
+        params = "".join(f";TYPE={t}" for t in rng.sample(TEL_TYPES, rng.randrange(0, 3)))
+        number = rng.choice(["+49 (0) 30 ", "0176-", "+1 555 ", "", "++"]) + str(rng.randrange(10**6, 10**9))
+        lines.append(f"TEL{params}:{number}")
+    if rng.random() < 0.5:
+        lines.append(f"ADR;TYPE=WORK:;;Hauptstraße {rng.randrange(1, 200)};Berlin;;{rng.randrange(10000, 99999)};Germany")
+    if rng.random() < 0.6:
+        org = rng.choice(["ACME Corp", "Müller & Söhne GmbH", "Example\\, Inc.", "ACME Corp;Sales", "ACME;R&D;Lab"])
+        lines.append(f"ORG:{org}")
+    if rng.random() < 0.5:
+        lines.append("TITLE:" + rng.choice(["Engineer", "Geschäftsführer", "Head of Sales\\, EMEA"]))
+    if rng.random() < 0.5:
+        lines.append(f"CATEGORIES:{','.join(rng.sample(CATEGORIES, rng.randrange(1, 4)))}")
+    if rng.random() < 0.1:
+        note = quopri.encodestring(f"Notiz für {given}".encode("utf-8")).decode("ascii").replace("=\n", "")
+        lines.append(f"NOTE;ENCODING=QUOTED-PRINTABLE;CHARSET=UTF-8:{note}")
+    if rng.random() < 0.1:
+        title = quopri.encodestring("Büroleiter".encode("latin-1")).decode("ascii")
+        lines.append(f"TITLE;ENCODING=QUOTED-PRINTABLE;CHARSET=ISO-8859-1:{title}")
+    if rng.random() < 0.3:
+        photo = base64.b64encode(rng.randbytes(rng.randrange(100, 8000))).decode("ascii")
+        lines.append(f"PHOTO;ENCODING=b;TYPE=JPEG:{photo}")
+    elif rng.random() < 0.05:
+        lines.append("PHOTO;VALUE=URI:https://example.com/photo.jpg")
+    if rng.random() < 0.05:
+        lines.append('X-SOCIALPROFILE;TYPE=twitter;X-USER="someone":https://twitter.com/someone')
+    if rng.random() < 0.03:
+        lines[1] = "VERSION:2.1"
+        lines.append("TEL;WORK;VOICE:+49 30 1234567")
+    lines.append("REV:2024-01-01T00:00:00Z")
+    lines.append("END:VCARD")
+    line_end = "\r\n" if rng.random() < 0.95 else "\n"
+    return line_end.join(fold(line) if line_end == "\r\n" else line for line in lines) + line_end
+
+def time_parser(vcard_blobs, parse_options, repetitions):
+    """Returns the best wall time of parsing all blobs, in seconds."""
+    best = None
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        for vcard_blob in vcard_blobs:
+            parse_card(vcard_blob, BOOK_URL, parse_options)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    card_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    rng = random.Random(42)
+    vcard_blobs = [generate_vcard(rng, index) for index in range(card_count)]
+    vobject_options = {"import_photos": True, "debug": False, "fast_parser": False, "photo_options": None}
+    fast_options = dict(vobject_options, fast_parser=True)
+
+    # Golden check: the fast parser must produce exactly the contact_data vobject produces
+    mismatches = 0
+    for vcard_blob in vcard_blobs:
+        expected, _ = parse_card(vcard_blob, BOOK_URL, vobject_options)
+        actual, _ = parse_card(vcard_blob, BOOK_URL, fast_options)
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"ERROR: contact_data differs for vCard:\n{vcard_blob}\nvobject: {expected}\nfast:    {actual}")
+    fast_cards = sum(1 for vcard_blob in vcard_blobs if fast_read_vcard(vcard_blob) is not None)
+    print(f"INFO: {card_count} vCards, {fast_cards} handled by the fast parser, {card_count - fast_cards} fall back to vobject.")
+    if mismatches:
+        print(f"ERROR: {mismatches} vCard(s) differ between the fast parser and vobject.")
+        sys.exit(1)
+    print("INFO: contact_data is identical for all vCards.")
+
+    vobject_time = time_parser(vcard_blobs, vobject_options, repetitions)
+    fast_time = time_parser(vcard_blobs, fast_options, repetitions)
+    print(f"INFO: vobject:     {vobject_time:.3f}s ({card_count / vobject_time:.0f} vCards/s)")
+    print(f"INFO: fast parser: {fast_time:.3f}s ({card_count / fast_time:.0f} vCards/s), {vobject_time / fast_time:.1f}x faster")
+
+if __name__ == "__main__":
+    main()
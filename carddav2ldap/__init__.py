@@ -0,0 +1,25 @@
+# carddav2ldap/__init__.py
+# Synchronizes contacts from CardDAV address books to an LDAP directory.
+#
+# The synchronization is a pipeline of stages that stream into each other:
+#   discover_addressbooks() -> fetch_cards() -> parse_card() -> filter_contact() -> build_ldap_entry() -> apply_to_ldap()
+# Synchronizer runs the whole pipeline with the settings returned by load_config(), cli.main() is the command line.
+
+from .config import load_config, build_parse_options, ConfigError
+from .carddav import create_carddav_session, discover_addressbooks, fetch_cards
+from .vcard_parser import parse_card, parse_cards
+from .filters import filter_contact
+from .ldap_entries import build_ldap_entry
+from .ldap_directory import LdapDirectory, apply_to_ldap
+from .metrics import SyncMetrics
+from .sync import Synchronizer
+
+__all__ = [
+    "load_config", "build_parse_options", "ConfigError",
+    "create_carddav_session", "discover_addressbooks", "fetch_cards",
+    "parse_card", "parse_cards",
+    "filter_contact",
+    "build_ldap_entry",
+    "LdapDirectory", "apply_to_ldap",
+    "SyncMetrics", "Synchronizer",
+]
@@ -0,0 +1,7 @@
+# carddav2ldap/__main__.py
+# Allows running the synchronization with "python -m carddav2ldap [--daemon]".
+
+import sys
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,115 @@
+# carddav2ldap/caller_id.py
+# Caller ID reverse lookup (daemon mode, CALLERID_LOOKUP_PORT): an in-memory index of the phone numbers of all
+# entries below LDAP_BASE_DN, served by a small HTTP endpoint, e.g. for the PBX to show the name of a caller.
+
+import bisect # Import for the longest-suffix search in the sorted index
+import json
+import logging
+import os
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler # Import for the lookup endpoint
+from .phone_numbers import normalize_phone_number
+
+logger = logging.getLogger(__name__)
+
+class CallerIdIndex:
+    """
+    Maps normalized phone numbers to names. A lookup is one dict lookup for numbers in the stored format and
+    otherwise one bisect in the sorted reversed numbers, which finds the number with the longest common suffix
+    (e.g. a caller ID without country code or trunk prefix). Built from the phonebook entries after every cycle.
+    """
+    def __init__(self, phonebook_entries, phone_options, min_suffix_digits):
+        self.phone_options = phone_options
+        self.min_suffix_digits = min_suffix_digits
+        self.names = {} # Normalized number -> name, the first entry (sorted by name) wins
+        for entry in phonebook_entries:
+            for raw_number in entry["phones"] + entry["faxes"]:
+                number = normalize_phone_number(raw_number, phone_options)
+                if number:
+                    self.names.setdefault(number, entry["name"])
+        # Digits of every number in reverse order, sorted, and the numbers in the same order
+        suffix_index = sorted((number.lstrip('+')[::-1], number) for number in self.names)
+        self.reversed_digits = [reversed_digits for reversed_digits, _ in suffix_index]
+        self.suffix_numbers = [number for _, number in suffix_index]
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, raw_number):
+        """
+        Returns {"number", "name", "match"} for the number ("exact" or "suffix" match, number is the stored number),
+        or None if no stored number ends with at least CALLERID_MIN_SUFFIX_DIGITS of its digits.
+        """
+        number = normalize_phone_number(raw_number, self.phone_options)
+        if not number:
+            return None
+        name = self.names.get(number)
+        if name is not None:
+            return {"number": number, "name": name, "match": "exact"}
+        # In sorted order, the longest common prefix with the reversed number is found next to its insertion point
+        reversed_digits = number.lstrip('+')[::-1]
+        position = bisect.bisect_left(self.reversed_digits, reversed_digits)
+        best_length, best_number = 0, None
+        for neighbor in (position - 1, position):
+            if 0 <= neighbor < len(self.reversed_digits):
+                common_length = len(os.path.commonprefix((reversed_digits, self.reversed_digits[neighbor])))
+                if common_length > best_length:
+                    best_length, best_number = common_length, self.suffix_numbers[neighbor]
+        if best_length < self.min_suffix_digits:
+            return None
+        return {"number": best_number, "name": self.names[best_number], "match": "suffix"}
+
+# --- Lookup endpoint (daemon mode) ---
+class CallerIdHandler(BaseHTTPRequestHandler):
+    """
+    Handles "GET /lookup?number=<number>". Answers with JSON, or with the plain name for "&format=text"
+    (e.g. for the caller ID lookup of a PBX). Unknown numbers are answered with 404.
+    """
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.rstrip("/") != "/lookup":
+            self.send_answer(404, {"error": "not found"}, "")
+            return
+        query = urllib.parse.parse_qs(url.query)
+        raw_number = query.get("number", [""])[0]
+        as_text = query.get("format", [""])[0] == "text"
+        # The index is replaced after every cycle, read it once per request
+        caller_id_index = self.server.synchronizer.caller_id_index
+        if caller_id_index is None:
+            self.send_answer(503, {"error": "index not loaded yet"}, "", as_text)
+            return
+        result = caller_id_index.lookup(raw_number)
+        if result is None:
+            self.send_answer(404, {"number": raw_number, "name": None}, "", as_text)
+            return
+        self.send_answer(200, result, result["name"], as_text)
+
+    def send_answer(self, status, body, text, as_text=False):
+        response_body = text.encode("utf-8") if as_text else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8" if as_text else "application/json")
+        self.send_header("Content-Length", str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        logger.debug("Caller ID endpoint: %s " + format, self.client_address[0], *args)
+
+def start_caller_id_server(config, synchronizer):
+    """
+    Serves the caller ID lookup endpoint from synchronizer.caller_id_index in a background thread.
+    Returns the server, or None if it could not be started.
+    """
+    bind, port = config["callerid_lookup_bind"], config["callerid_lookup_port"]
+    try:
+        server = ThreadingHTTPServer((bind, port), CallerIdHandler)
+    except OSError as e:
+        logger.error("Could not start the caller ID endpoint on %s:%s: %s", bind, port, e)
+        return None
+    server.daemon_threads = True
+    # Read by CallerIdHandler
+    server.synchronizer = synchronizer
+    threading.Thread(target=server.serve_forever, name="caller-id", daemon=True).start()
+    logger.info("Caller ID endpoint listening on %s:%s (GET /lookup?number=<number>).", bind, port)
+    return server
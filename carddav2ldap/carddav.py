@@ -0,0 +1,497 @@
+# carddav2ldap/carddav.py
+# CardDAV client: address book discovery (pipeline stage discover_addressbooks()) and streaming of the vCards of
+# one address book in the configured fetch mode (pipeline stage fetch_cards()).
+
+import logging
+import urllib.parse
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape as xml_escape # Import for escaping sync tokens in REPORT bodies
+import requests
+from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .filters import filter_addressbook
+from .sync_state import has_card_dns
+
+logger = logging.getLogger(__name__)
+
+# --- Shared HTTP session for all CardDAV requests ---
+def create_carddav_session(config):
+    """
+    Creates a requests session that keeps connections alive between requests and retries
+    transient failures (connection errors, 429 and 5xx responses) with exponential backoff,
+    honoring Retry-After headers sent by the server.
+    """
+    retry = Retry(
+        total=config["http_retries"],
+        backoff_factor=config["http_backoff_factor"],
+        status_forcelist=(429, 500, 502, 503, 504),
+        # PROPFIND and REPORT only read data and are safe to repeat
+        allowed_methods=frozenset(Retry.DEFAULT_ALLOWED_METHODS | {"PROPFIND", "REPORT"}),
+        respect_retry_after_header=True,
+        raise_on_status=False # Hand the last response to raise_for_status() once all retries are used up
+    )
+    # Every fetch worker needs its own connection, otherwise workers wait for each other
+    pool_size = max(config["http_pool_size"], config["fetch_workers"])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.auth = HTTPBasicAuth(config["carddav_username"], config["carddav_password"])
+    session.verify = config["ssl_verify"] # Use the SSL verification setting from environment variable
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    })
+    return session
+
+# --- CardDAV multistatus helpers ---
+CARDDAV_NS = {
+    "d": "DAV:", # DAV namespace
+    "c": "urn:ietf:params:xml:ns:carddav" # CardDAV namespace
+}
+# Size of the chunks read from streamed CardDAV responses
+CARDDAV_STREAM_CHUNK_SIZE = 64 * 1024
+
+def send_carddav_request(session, config, method, url, depth, body):
+    """
+    Sends a PROPFIND/REPORT request and returns the streamed response.
+    The body is not downloaded yet, it is parsed incrementally by MultistatusStream.
+    Raises requests.exceptions.RequestException on HTTP errors or if the status is not 207 Multi-Status.
+    """
+    headers = {
+        "Depth": depth,
+        "Content-Type": "application/xml; charset=UTF-8",
+    }
+    response = session.request(
+        method=method,
+        url=url,
+        headers=headers,
+        data=body.encode("utf-8"),
+        timeout=config["http_timeout"],
+        stream=True # Parse the body while it is downloaded instead of holding it in memory
+    )
+    if response.status_code != 207:
+        # Error bodies are small, read them so callers can inspect them
+        response.content
+        response.close()
+        response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
+        raise requests.exceptions.RequestException(f"Expected 207 Multi-Status, got {response.status_code}", response=response)
+    return response
+
+class MultistatusStream:
+    """
+    Incrementally parses a streamed 207 Multi-Status response.
+    Iterating yields one (href, etag, vcard_blob) tuple per <D:response>, etag and vcard_blob are None if
+    not present. Every <D:response> element is discarded right after it was handed out, so memory use does
+    not grow with the size of the address book.
+    Hrefs reported with a response-level 404 status are collected in missing_hrefs, the top-level
+    <D:sync-token> of a sync-collection REPORT is available as sync_token once iteration has finished.
+    The stream is appended to transfers (a list, optional), bytes_received counts the (decompressed) bytes of the body.
+    """
+    def __init__(self, response, transfers=None):
+        self.response = response
+        self.missing_hrefs = []
+        self.sync_token = None
+        self.bytes_received = 0
+        if transfers is not None:
+            transfers.append(self)
+
+    def __iter__(self):
+        parser = ET.XMLPullParser(events=("start", "end"))
+        root = None
+        response_depth = 0 # > 0 while inside a <D:response> element
+        try:
+            for chunk in self.response.iter_content(chunk_size=CARDDAV_STREAM_CHUNK_SIZE):
+                self.bytes_received += len(chunk)
+                parser.feed(chunk)
+                for event, elem in parser.read_events():
+                    if event == "start":
+                        if root is None:
+                            root = elem
+                        elif elem.tag == "{DAV:}response":
+                            response_depth += 1
+                        continue
+                    if elem.tag == "{DAV:}response":
+                        response_depth -= 1
+                        card = self._parse_response(elem)
+                        # Drop the processed element (and everything before it) from the tree
+                        root.clear()
+                        if card is not None:
+                            yield card
+                    elif elem.tag == "{DAV:}sync-token" and response_depth == 0:
+                        self.sync_token = elem.text.strip() if elem.text else None
+            parser.close()
+        finally:
+            self.response.close()
+
+    def _parse_response(self, response_elem):
+        """Extracts href, ETag and vCard data of a single <D:response> element."""
+        href_elem = response_elem.find("d:href", CARDDAV_NS)
+        if href_elem is None or not href_elem.text:
+            return None
+        href = href_elem.text.strip()
+        # A removed or unknown member is reported with a response-level 404 status and no propstat
+        status_elem = response_elem.find("d:status", CARDDAV_NS)
+        if status_elem is not None and status_elem.text and " 404 " in f"{status_elem.text} ":
+            self.missing_hrefs.append(href)
+            return None
+        etag_elem = response_elem.find(".//d:getetag", CARDDAV_NS)
+        data_elem = response_elem.find(".//c:address-data", CARDDAV_NS)
+        etag = etag_elem.text.strip() if etag_elem is not None and etag_elem.text else None
+        vcard_blob = data_elem.text if data_elem is not None and data_elem.text else None
+        return href, etag, vcard_blob
+
+def is_collection_href(book_url, href):
+    """Checks if an href of a Depth:1 response points to the address book collection itself."""
+    book_path = urllib.parse.urlparse(book_url).path.rstrip('/')
+    return urllib.parse.urlparse(urllib.parse.urljoin(book_url, href)).path.rstrip('/') == book_path
+
+# --- 1. Discover all address books ---
+def addressbook_name_from_url(full_url):
+    """Extracts an address book name from its URL, for address books without displayname."""
+    # e.g., from "https://server/dav.php/addressbooks/user/my_addressbook/" -> "my_addressbook"
+    addressbook_name = ""
+    path_parts = [p for p in full_url.split('/') if p]
+    if path_parts:
+        # Try to get the last part if it's not the domain or a common DAV endpoint
+        if path_parts[-1] not in ["addressbooks", "dav.php", "user"]: # Added "user" to exclude common path segments
+            addressbook_name = path_parts[-1]
+        elif len(path_parts) > 1 and path_parts[-2] not in ["addressbooks", "dav.php", "user"]:
+            addressbook_name = path_parts[-2] # e.g., for /user/
+    if not addressbook_name: # Final fallback if still no name
+        addressbook_name = full_url # Use full URL as name if nothing else works
+    return addressbook_name
+
+def discover_addressbooks(session, config):
+    """
+    Lists the address books below CARDDAV_BASE_DISCOVERY_URL that pass the address book filters.
+    Returns a list of dicts with "url", "name", "ctag" and "collection_sync_token" (None if not reported),
+    or None if the discovery failed. If no address book is found, the discovery URL itself is used.
+    """
+    carddav_base_discovery_url = config["carddav_base_discovery_url"]
+    logger.info("Discovering address books from: %s", carddav_base_discovery_url)
+    discovery_headers = {
+        "Depth": "1",  # Request depth 1 to get direct child collections
+        "Content-Type": "application/xml; charset=UTF-8",
+    }
+    # XML body for PROPFIND request to discover collections and addressbooks.
+    # getctag (CalendarServer extension) and sync-token (RFC 6578) change whenever a contact in the book changes.
+    discovery_body = """<?xml version="1.0" encoding="utf-8" ?>
+    <D:propfind xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav" xmlns:CS="http://calendarserver.org/ns/">
+      <D:prop>
+        <D:resourcetype/>
+        <D:displayname/>
+        <CS:getctag/>
+        <D:sync-token/>
+      </D:prop>
+    </D:propfind>"""
+
+    try:
+        discovery_response = session.request(
+            method="PROPFIND",
+            url=carddav_base_discovery_url,
+            headers=discovery_headers,
+            data=discovery_body.encode("utf-8"),
+            timeout=config["http_timeout"]
+        )
+        discovery_response.raise_for_status()
+
+    except requests.exceptions.RequestException as e:
+        logger.error("Failed to connect to CardDAV server for discovery or fetch data: %s", e)
+        return None
+
+    if discovery_response.status_code != 207:
+        logger.error("CardDAV PROPFIND for discovery failed. Expected 207 Multi-Status, got %s. "
+                     "Please check your CARDDAV_BASE_DISCOVERY_URL, CARDDAV_USERNAME, and CARDDAV_PASSWORD.", discovery_response.status_code)
+        return None
+
+    discovery_ns = {
+        "d": "DAV:",
+        "c": "urn:ietf:params:xml:ns:carddav",
+        "cs": "http://calendarserver.org/ns/"
+    }
+    discovery_root = ET.fromstring(discovery_response.text)
+
+    address_books = []
+    # Find all <D:response> elements and check if they represent an addressbook
+    for response_elem in discovery_root.findall(".//d:response", discovery_ns):
+        href_elem = response_elem.find(".//d:href", discovery_ns)
+        resourcetype_elem = response_elem.find(".//d:resourcetype", discovery_ns)
+        displayname_elem = response_elem.find(".//d:displayname", discovery_ns) # Get displayname
+        ctag_elem = response_elem.find(".//cs:getctag", discovery_ns)
+        collection_sync_token_elem = response_elem.find(".//d:sync-token", discovery_ns)
+
+        if href_elem is None or resourcetype_elem is None:
+            continue
+        # Check if the resourcetype contains <C:addressbook/>
+        if resourcetype_elem.find(".//c:addressbook", discovery_ns) is None:
+            continue
+        relative_url_path = href_elem.text.strip()
+        full_url = urllib.parse.urljoin(carddav_base_discovery_url, relative_url_path)
+
+        # Extract address book name from displayname or URL path
+        addressbook_name = displayname_elem.text.strip() if displayname_elem is not None and displayname_elem.text else ""
+        if not addressbook_name:
+            # Fallback to extracting from URL if displayname is missing
+            addressbook_name = addressbook_name_from_url(full_url)
+
+        logger.debug("Discovered address book: '%s' at URL: '%s'", addressbook_name, full_url)
+
+        # Apply address book filters
+        skip_reason = filter_addressbook(addressbook_name, config)
+        if skip_reason:
+            logger.info("Skipping address book '%s' (%s) due to %s.", addressbook_name, full_url, skip_reason)
+            continue
+
+        address_books.append({
+            "url": full_url,
+            "name": addressbook_name,
+            "ctag": ctag_elem.text.strip() if ctag_elem is not None and ctag_elem.text else None,
+            "collection_sync_token": collection_sync_token_elem.text.strip() if collection_sync_token_elem is not None and collection_sync_token_elem.text else None,
+        })
+
+    if not address_books:
+        logger.warning("No address books found at the specified CARDDAV_BASE_DISCOVERY_URL.")
+        # Attempt to use CARDDAV_BASE_DISCOVERY_URL itself as a single address book if no others found.
+        # This covers cases where the discovery URL IS the the address book.
+        logger.info("Attempting to use %s as a single address book.", carddav_base_discovery_url)
+
+        # Extract name for filtering the base URL itself if used as a fallback
+        base_url_name = urllib.parse.urlparse(carddav_base_discovery_url).path.strip('/').split('/')[-1]
+        if not base_url_name:
+            base_url_name = urllib.parse.urlparse(carddav_base_discovery_url).netloc # Fallback to domain if path is empty
+        if not base_url_name:
+            base_url_name = carddav_base_discovery_url # Use full URL as name if nothing else works
+
+        logger.debug("Attempting to filter base URL as address book: '%s'", base_url_name)
+
+        skip_reason = filter_addressbook(base_url_name, config)
+        if skip_reason:
+            logger.info("Skipping base URL '%s' (%s) due to %s.", base_url_name, carddav_base_discovery_url, skip_reason)
+        else:
+            address_books.append({"url": carddav_base_discovery_url, "name": base_url_name, "ctag": None, "collection_sync_token": None})
+
+    logger.info("Found %d address book(s) to process.", len(address_books))
+    return address_books
+
+# --- CardDAV sync-collection (RFC 6578) ---
+class InvalidSyncTokenError(Exception):
+    """Raised when the server rejects a stored sync token and a full sync is required."""
+
+def request_sync_collection(session, config, book_url, sync_token, transfers=None):
+    """
+    Sends a sync-collection REPORT to an address book and returns a MultistatusStream over the result.
+    An empty sync_token requests the complete address book. Deleted contacts end up in missing_hrefs,
+    the new sync token in sync_token of the returned stream.
+    Raises InvalidSyncTokenError if the server no longer accepts sync_token.
+    """
+    sync_token_elem = f"<D:sync-token>{xml_escape(sync_token)}</D:sync-token>" if sync_token else "<D:sync-token/>"
+    report_body = f"""<?xml version="1.0" encoding="utf-8" ?>
+    <D:sync-collection xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav">
+      {sync_token_elem}
+      <D:sync-level>1</D:sync-level>
+      <D:prop>
+        <D:getetag/>
+        <C:address-data/>
+      </D:prop>
+    </D:sync-collection>"""
+
+    try:
+        # sync-collection requests must use depth 0, the sync-level element controls the scope
+        response = send_carddav_request(session, config, "REPORT", book_url, "0", report_body)
+    except requests.exceptions.HTTPError as e:
+        # RFC 6578 section 3.2: an invalid or expired token is answered with 403 (or 409 by some servers)
+        # and a DAV:valid-sync-token precondition.
+        if sync_token and e.response is not None and e.response.status_code in (403, 409) and "valid-sync-token" in e.response.text:
+            raise InvalidSyncTokenError(f"Server rejected sync token for {book_url}") from e
+        raise
+    return MultistatusStream(response, transfers)
+
+def fetch_address_book_etags(session, config, book_url, transfers=None):
+    """
+    Lists all contacts of an address book with a Depth:1 PROPFIND that only requests getetag.
+    Returns a dict mapping each contact href to its ETag.
+    """
+    etag_body = """<?xml version="1.0" encoding="utf-8" ?>
+    <D:propfind xmlns:D="DAV:">
+      <D:prop>
+        <D:getetag/>
+      </D:prop>
+    </D:propfind>"""
+
+    listed_etags = {}
+    for href, etag, _ in MultistatusStream(send_carddav_request(session, config, "PROPFIND", book_url, "1", etag_body), transfers):
+        # Skip the address book collection itself, which is part of a Depth:1 response
+        if etag and not is_collection_href(book_url, href):
+            listed_etags[href] = etag
+    return listed_etags
+
+def request_address_book_multiget(session, config, book_url, hrefs, transfers=None):
+    """
+    Requests the given contacts with an addressbook-multiget REPORT (RFC 6352 section 8.7).
+    Returns a MultistatusStream over the result.
+    """
+    href_elems = "\n".join(f"      <D:href>{xml_escape(href)}</D:href>" for href in hrefs)
+    multiget_body = f"""<?xml version="1.0" encoding="utf-8" ?>
+    <C:addressbook-multiget xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav">
+      <D:prop>
+        <D:getetag/>
+        <C:address-data/>
+      </D:prop>
+{href_elems}
+    </C:addressbook-multiget>"""
+    return MultistatusStream(send_carddav_request(session, config, "REPORT", book_url, "1", multiget_body), transfers)
+
+def iter_multiget_cards(session, config, book_url, hrefs, missing_hrefs, transfers=None):
+    """
+    Yields (href, etag, vcard_blob) for the given contacts, fetched in batches of CARDDAV_MULTIGET_BATCH_SIZE.
+    Hrefs the server reported as missing are appended to missing_hrefs.
+    """
+    batch_size = config["multiget_batch_size"]
+    for batch_start in range(0, len(hrefs), batch_size):
+        stream = request_address_book_multiget(session, config, book_url, hrefs[batch_start:batch_start + batch_size], transfers)
+        yield from stream
+        missing_hrefs.extend(stream.missing_hrefs)
+
+def request_address_book_propfind(session, config, book_url, transfers=None):
+    """
+    Requests all vCards of an address book with a single Depth:1 PROPFIND.
+    Returns a MultistatusStream over the result.
+    """
+    # XML body for PROPFIND request to get address-data (vCard content) for contacts
+    contact_body = """<?xml version="1.0" encoding="utf-8" ?>
+    <D:propfind xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav">
+      <D:prop>
+        <D:href/>
+        <D:getetag/>
+        <C:address-data/>
+      </D:prop>
+    </D:propfind>"""
+    return MultistatusStream(send_carddav_request(session, config, "PROPFIND", book_url, "1", contact_body), transfers)
+
+def guard_card_stream(card_stream, errors):
+    """
+    Passes through the cards of a stream. Network and XML errors raised while the stream is consumed
+    are appended to errors instead of being raised, so that the caller can discard the address book.
+    """
+    try:
+        yield from card_stream
+    except (requests.exceptions.RequestException, ET.ParseError) as e:
+        errors.append(e)
+
+# --- 2. Fetch the contacts of one address book ---
+def fetch_cards(session, config, book, book_state, fetch_result, log=logger.log):
+    """
+    Yields (href, etag, vcard_blob) for all (or, in incremental fetch modes, all changed) contacts of an
+    address book while the response is streamed from the server. book is a discover_addressbooks() entry,
+    book_state its state saved by the previous run.
+    Once the generator is exhausted, fetch_result["new_book_state"] holds the state to save after the LDAP
+    import, or None if the address book could not be fetched completely. fetch_result["transfers"] lists the
+    MultistatusStream of every response (for the metrics). Messages are passed to log(level, msg, *args).
+    """
+    book_url = book["url"]
+    fetch_mode = config["fetch_mode"]
+    keep_stale_entries = config["ldap_stale_entries"] == "keep"
+    fetch_result["new_book_state"] = None
+    transfers = fetch_result["transfers"] = []
+    log(logging.INFO, "Fetching contacts from address book: %s", book_url)
+    # New state for this address book, saved at the end of the run
+    new_book_state = {key: book[key] for key in ("ctag", "collection_sync_token") if book[key] is not None}
+
+    card_stream = None # Stays None if the address book is fetched with a full PROPFIND
+    sync_stream = None # MultistatusStream of a sync-collection REPORT, provides deleted hrefs and the new sync token
+    deleted_hrefs = []
+    if fetch_mode == "sync-collection":
+        previous_sync_token = book_state.get("sync_token")
+        if previous_sync_token and not keep_stale_entries and not has_card_dns(book_state):
+            log(logging.INFO, "Sync state of %s does not record LDAP DNs yet. Performing a full sync.", book_url)
+            previous_sync_token = None
+        try:
+            try:
+                sync_stream = request_sync_collection(session, config, book_url, previous_sync_token, transfers)
+            except InvalidSyncTokenError:
+                log(logging.INFO, "Stored sync token for %s is no longer valid. Performing a full sync.", book_url)
+                previous_sync_token = None
+                sync_stream = request_sync_collection(session, config, book_url, None, transfers)
+            card_stream = sync_stream
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code in (400, 405, 501):
+                # The server does not implement sync-collection for this collection, fall back to a full PROPFIND
+                log(logging.WARNING, "%s does not support sync-collection (HTTP %s). Falling back to a full PROPFIND.", book_url, e.response.status_code)
+            else:
+                log(logging.ERROR, "sync-collection REPORT for %s failed: %s", book_url, e)
+                return
+        except requests.exceptions.RequestException as e:
+            log(logging.ERROR, "sync-collection REPORT for %s failed: %s", book_url, e)
+            return
+
+    elif fetch_mode == "etag":
+        previous_cards = book_state.get("cards", {})
+        try:
+            # Phase 1: list href and ETag of every contact, then compare with the ETags of the previous run
+            listed_etags = fetch_address_book_etags(session, config, book_url, transfers)
+        except (requests.exceptions.RequestException, ET.ParseError) as e:
+            log(logging.ERROR, "Failed to fetch contacts from %s: %s", book_url, e)
+            return
+        changed_hrefs = [href for href, etag in listed_etags.items() if previous_cards.get(href, {}).get("etag") != etag
+                         or (not keep_stale_entries and "dn" not in previous_cards.get(href, {}))]
+        deleted_hrefs = [href for href in previous_cards if href not in listed_etags]
+        # Phase 2: fetch only the changed contacts, in batches to keep single responses bounded
+        missing_hrefs = []
+        card_stream = iter_multiget_cards(session, config, book_url, changed_hrefs, missing_hrefs, transfers)
+
+    if card_stream is None:
+        try:
+            card_stream = request_address_book_propfind(session, config, book_url, transfers)
+        except requests.exceptions.RequestException as e:
+            log(logging.ERROR, "Failed to fetch contacts from %s: %s", book_url, e)
+            return
+
+    fetch_errors = []
+    fetched_etags = {} # ETag of every contact received in this run, keyed by href
+    for href, etag, vcard_blob in guard_card_stream(card_stream, fetch_errors):
+        if not vcard_blob:
+            continue
+        fetched_etags[href] = etag
+        yield href, etag, vcard_blob
+
+    if fetch_errors:
+        # The state of a partially transferred address book is not advanced, the next run fetches it again
+        log(logging.ERROR, "Failed to fetch contacts from %s: %s", book_url, fetch_errors[0])
+        return
+
+    # Remember what was fetched, the state is saved after the LDAP import
+    if sync_stream is not None:
+        deleted_hrefs = sync_stream.missing_hrefs
+        if previous_sync_token:
+            log(logging.INFO, "%d changed and %d deleted contact(s) in %s since the last sync.", len(fetched_etags), len(deleted_hrefs), book_url)
+        # Only the cards known from a previous run are kept when this is an incremental sync
+        cards = dict(book_state.get("cards", {})) if previous_sync_token else {}
+        for href in deleted_hrefs:
+            cards.pop(href, None)
+        for href, etag in fetched_etags.items():
+            cards[href] = {"etag": etag, "dn": None} # The DN is filled in by the LDAP import
+        if sync_stream.sync_token:
+            new_book_state["sync_token"] = sync_stream.sync_token
+            new_book_state["cards"] = cards
+        else:
+            log(logging.WARNING, "Server did not return a sync token for %s. The next run will perform a full sync.", book_url)
+    elif fetch_mode == "etag":
+        log(logging.INFO, "%d changed, %d deleted and %d unchanged contact(s) in %s.",
+            len(fetched_etags), len(deleted_hrefs), len(listed_etags) - len(changed_hrefs), book_url)
+        if missing_hrefs:
+            # Contacts deleted between listing and fetching are picked up again by the next run
+            log(logging.WARNING, "%d contact(s) in %s disappeared while fetching.", len(missing_hrefs), book_url)
+        # Unchanged contacts keep their ETag, fetched contacts use the ETag returned with their data
+        changed_href_set = set(changed_hrefs)
+        cards = {href: dict(previous_cards[href], etag=etag) for href, etag in listed_etags.items() if href not in changed_href_set}
+        for href, etag in fetched_etags.items():
+            cards[href] = {"etag": etag or listed_etags.get(href), "dn": None}
+        new_book_state["cards"] = cards
+    else:
+        # Full fetch, the cards are recorded so the DNs of this address book are known if it is skipped next time
+        new_book_state["cards"] = {href: {"etag": etag, "dn": None} for href, etag in fetched_etags.items()}
+    if deleted_hrefs and keep_stale_entries:
+        log(logging.INFO, "Contacts deleted in CardDAV are not removed from LDAP: %d contact(s) in %s.", len(deleted_hrefs), book_url)
+    fetch_result["new_book_state"] = new_book_state
@@ -0,0 +1,47 @@
+# carddav2ldap/cli.py
+# Command line entry point: reads the settings from environment variables and runs one synchronization,
+# or keeps running with --daemon. Used by sync_script.py and "python -m carddav2ldap".
+
+import argparse # Import for the --daemon command line option
+import logging
+import sys
+import urllib3
+from .config import load_config, ConfigError
+from .sync import Synchronizer
+from .daemon import run_daemon
+from .logging_config import configure_logging
+
+logger = logging.getLogger(__name__)
+
+def main(argv=None):
+    """Runs the synchronization. Returns the exit status (1 if the settings are invalid or the run failed)."""
+    argument_parser = argparse.ArgumentParser(description="Synchronizes contacts from CardDAV address books to LDAP.")
+    argument_parser.add_argument("--daemon", action="store_true",
+                                 help="keep running and synchronize every SYNC_INTERVAL_SECONDS instead of once")
+    daemon_mode = argument_parser.parse_args(argv).daemon
+
+    try:
+        config = load_config()
+    except ConfigError as e:
+        # Print to stderr so it's always visible in logs, even if stdout is buffered
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 1
+    if daemon_mode and config["ldap_export_ldif_file"]:
+        print("ERROR: LDAP_EXPORT_LDIF_FILE is meant for one-off runs and cannot be used with --daemon.", file=sys.stderr)
+        return 1
+
+    configure_logging(config)
+
+    # Suppress InsecureRequestWarning if SSL verification is disabled
+    if not config["ssl_verify"]:
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    logger.info("Starting contact synchronization from CardDAV to LDAP (Project carddav2ldap)...")
+    synchronizer = Synchronizer(config, keep_connections=daemon_mode, caller_id=daemon_mode and config["callerid_lookup_port"] > 0)
+    try:
+        if daemon_mode:
+            run_daemon(synchronizer, config)
+            return 0
+        return 0 if synchronizer.run_locked_cycle() else 1
+    finally:
+        synchronizer.close()
@@ -0,0 +1,279 @@
+# carddav2ldap/config.py
+# Reads the settings of a synchronization from environment variables.
+# All settings end up in one plain dict, which the pipeline stages receive as their "config" argument.
+
+import ipaddress # Import for checking whether the sync trigger endpoint is only reachable locally
+import os
+import re
+from .filters import compile_filters
+from .phonebook import PHONEBOOK_FORMATS
+from .photo_normalizer import is_pillow_available # Photo conversion (CARDDAV_NORMALIZE_PHOTOS) needs Pillow
+
+class ConfigError(Exception):
+    """Raised when an environment variable is missing or has an invalid value."""
+
+def is_loopback_bind(bind):
+    """Returns True if a listen address only accepts connections from this host."""
+    if bind.lower() == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(bind).is_loopback
+    except ValueError:
+        return False
+
+# --- Helper functions to read environment variables ---
+def get_env_or_fail(environ, var_name):
+    """Retrieves an environment variable. Raises ConfigError if the variable is not set."""
+    value = environ.get(var_name)
+    if not value:
+        raise ConfigError(f"Environment variable '{var_name}' is not set. Current value received: '{value}'. Please set it and retry.")
+    return value
+
+def get_boolean_env(environ, var_name, default=False):
+    """
+    Retrieves a boolean environment variable. Returns default if not set or invalid.
+    Expects "true" or "false" (case-insensitive).
+    """
+    value = environ.get(var_name)
+    if value is None:
+        return default
+    return value.lower() == "true"
+
+def get_int_env(environ, var_name, default):
+    """
+    Retrieves an integer environment variable. Returns default if not set.
+    Raises ConfigError if the value is not a valid integer.
+    """
+    value = environ.get(var_name)
+    if value is None or not value.strip():
+        return default
+    try:
+        return int(value.strip())
+    except ValueError:
+        raise ConfigError(f"Environment variable '{var_name}' must be an integer. Current value received: '{value}'.")
+
+def get_float_env(environ, var_name, default):
+    """
+    Retrieves a floating point environment variable. Returns default if not set.
+    Raises ConfigError if the value is not a valid number.
+    """
+    value = environ.get(var_name)
+    if value is None or not value.strip():
+        return default
+    try:
+        return float(value.strip())
+    except ValueError:
+        raise ConfigError(f"Environment variable '{var_name}' must be a number. Current value received: '{value}'.")
+
+def get_list_env(environ, var_name):
+    """Retrieves a comma-separated environment variable as a list. Empty entries are removed."""
+    return [item.strip() for item in environ.get(var_name, "").split(',') if item.strip()]
+
+# --- Settings ---
+def load_config(environ=None):
+    """
+    Reads and validates all settings from the environment (os.environ by default).
+    Returns the config dict. Raises ConfigError if a setting is missing or invalid.
+    """
+    if environ is None:
+        environ = os.environ
+    config = {
+        # CardDAV base URL for discovering address books (e.g., "https://your.carddav.server/dav.php/addressbooks/user/")
+        # This URL should list all your address books as sub-collections.
+        "carddav_base_discovery_url": get_env_or_fail(environ, "CARDDAV_BASE_DISCOVERY_URL"),
+        "carddav_username": get_env_or_fail(environ, "CARDDAV_USERNAME"),
+        "carddav_password": environ.get("CARDDAV_PASSWORD"), # Get password value as is for requests auth
+        # CardDAV SSL verification. Set to "true" or "false". Default to True for security
+        "ssl_verify": get_boolean_env(environ, "CARDDAV_SSL_VERIFY", default=True),
+        # Set to "true" to import photos from vCards into LDAP (jpegPhoto attribute). Default is "false".
+        "import_photos": get_boolean_env(environ, "CARDDAV_IMPORT_PHOTOS", default=False),
+        # Set to "true" to convert imported photos to JPEGs of at most CARDDAV_PHOTO_MAX_DIMENSION pixels and
+        # CARDDAV_PHOTO_MAX_BYTES bytes (requires Pillow). Default is "false", photos are stored as sent by the server.
+        "normalize_photos": get_boolean_env(environ, "CARDDAV_NORMALIZE_PHOTOS", default=False),
+        "photo_max_dimension": get_int_env(environ, "CARDDAV_PHOTO_MAX_DIMENSION", 256), # Maximum width and height of converted photos in pixels
+        "photo_max_bytes": get_int_env(environ, "CARDDAV_PHOTO_MAX_BYTES", 32768), # Size converted photos are recompressed to
+        # Directory caching converted photos by the hash of the original photo. Empty disables the cache.
+        "photo_cache_dir": environ.get("CARDDAV_PHOTO_CACHE_DIR", "/var/lib/carddav2ldap/photo_cache").strip(),
+        # How contacts are fetched from each address book. "propfind" (default) downloads every vCard on every run,
+        # "sync-collection" uses RFC 6578 sync tokens to fetch only contacts changed since the last run,
+        # "etag" lists the ETags of all contacts and fetches only changed ones with addressbook-multiget REPORTs.
+        "fetch_mode": environ.get("CARDDAV_FETCH_MODE", "propfind").strip().lower(),
+        "multiget_batch_size": get_int_env(environ, "CARDDAV_MULTIGET_BATCH_SIZE", 100), # Contacts per addressbook-multiget REPORT
+        # Set to "true" to parse common vCards with the built-in fast parser instead of vobject. Default is "false".
+        "fast_vcard_parser": get_boolean_env(environ, "CARDDAV_FAST_VCARD_PARSER", default=False),
+        # Set to "true" to skip address books whose CTag/sync-token did not change since the last run. Default is "false".
+        "skip_unchanged_books": get_boolean_env(environ, "CARDDAV_SKIP_UNCHANGED_BOOKS", default=False),
+        # Set to "true" to skip all LDAP work for contacts whose content did not change since the last successful run.
+        # A hash of every contact is kept in the sync state. Default is "false".
+        "skip_unchanged_contacts": get_boolean_env(environ, "LDAP_SKIP_UNCHANGED_CONTACTS", default=False),
+        "http_timeout": get_float_env(environ, "CARDDAV_HTTP_TIMEOUT", 60.0), # Seconds to wait for the server to connect or send data
+        "http_retries": get_int_env(environ, "CARDDAV_HTTP_RETRIES", 3), # Retries on connection errors, 429 and 5xx responses
+        "http_backoff_factor": get_float_env(environ, "CARDDAV_HTTP_BACKOFF_FACTOR", 1.0), # Exponential backoff between retries
+        "http_pool_size": get_int_env(environ, "CARDDAV_HTTP_POOL_SIZE", 10), # Keep-alive connections kept per host
+        "fetch_workers": get_int_env(environ, "CARDDAV_FETCH_WORKERS", 1), # Address books fetched in parallel
+        "parse_workers": get_int_env(environ, "CARDDAV_PARSE_WORKERS", 1), # Processes parsing vCards, 1 parses in the fetching thread
+        "parse_chunk_size": get_int_env(environ, "CARDDAV_PARSE_CHUNK_SIZE", 50), # vCards handed to a parse worker at once
+        "fetch_queue_size": get_int_env(environ, "CARDDAV_FETCH_QUEUE_SIZE", 100), # Parsed contacts buffered per address book being fetched
+
+        # Whitelist/Blacklist for individual contacts (comma-separated)
+        "email_whitelist_domains": get_list_env(environ, "CARDDAV_EMAIL_WHITELIST_DOMAINS"),
+        "email_blacklist_domains": get_list_env(environ, "CARDDAV_EMAIL_BLACKLIST_DOMAINS"),
+        "category_whitelist": get_list_env(environ, "CARDDAV_CATEGORY_WHITELIST"),
+        "category_blacklist": get_list_env(environ, "CARDDAV_CATEGORY_BLACKLIST"),
+        # Whitelist/Blacklist for entire address books (comma-separated)
+        "addressbook_whitelist": get_list_env(environ, "CARDDAV_ADDRESSBOOK_WHITELIST"),
+        "addressbook_blacklist": get_list_env(environ, "CARDDAV_ADDRESSBOOK_BLACKLIST"),
+
+        # LDAP server address (e.g., "ldap://localhost:389")
+        "ldap_server_url": environ.get("LDAP_SERVER"),
+        # LDAP bind username (e.g., "cn=admin,dc=yourdomain,dc=local")
+        "ldap_user": environ.get("LDAP_USER"),
+        "ldap_password": environ.get("LDAP_PASSWORD"), # Get password value as is for ldap3 bind
+        # LDAP base DN for contacts (e.g., "ou=contacts,dc=yourdomain,dc=local")
+        "ldap_base_dn": environ.get("LDAP_BASE_DN"),
+        "ldap_page_size": get_int_env(environ, "LDAP_SEARCH_PAGE_SIZE", 500), # Entries per page when reading the existing LDAP entries
+        "ldap_write_workers": get_int_env(environ, "LDAP_WRITE_WORKERS", 1), # LDAP connections writing in parallel, 1 writes one entry after another
+        # LDAP attribute that stores the vCard UID (or the href for cards without UID) of every entry. Default is "uid".
+        # Entries are matched to contacts by this attribute, so renamed contacts keep their entry. Empty disables it.
+        "ldap_uid_attribute": environ.get("LDAP_UID_ATTRIBUTE", "uid").strip(),
+        # What to do with entries below LDAP_BASE_DN that were not produced by this run (e.g. contacts deleted in CardDAV).
+        # "keep" (default) leaves them alone, "dry-run" only logs them, "delete" removes them.
+        "ldap_stale_entries": environ.get("LDAP_STALE_ENTRIES", "keep").strip().lower(),
+        "ldap_max_deletions": get_int_env(environ, "LDAP_MAX_DELETIONS", 50), # Stale entries removed per run at most, otherwise nothing is removed
+        # If set, no LDAP connection is made. Every entry this run would create is written to this LDIF file instead,
+        # which can be loaded offline with slapadd (see LDAP_BULK_IMPORT_FILE of the ldap service).
+        "ldap_export_ldif_file": environ.get("LDAP_EXPORT_LDIF_FILE", "").strip(),
+
+        # Directory the phonebook XML files for desk phones are written to after every run, e.g. the web_data volume
+        # of the nginx "web" service. Default is "", which disables the phonebooks.
+        "phonebook_export_dir": environ.get("PHONEBOOK_EXPORT_DIR", "").strip(),
+        "phonebook_formats": [f.lower() for f in get_list_env(environ, "PHONEBOOK_FORMATS") or ["yealink", "snom", "fritzbox"]],
+        "phonebook_title": environ.get("PHONEBOOK_TITLE", "Contacts").strip(), # Title shown by the phones
+
+        # Country code (e.g. "49") of national phone numbers. If set, phone numbers are stored in E.164 format
+        # (+49301234 for "030 1234" and "0049 30 1234"). Default is "", which only removes spaces, dashes etc.
+        "phone_default_country_code": environ.get("PHONE_DEFAULT_COUNTRY_CODE", "").strip().lstrip("+"),
+        "phone_trunk_prefix": environ.get("PHONE_TRUNK_PREFIX", "0").strip(), # Prefix of national numbers, "" if the country has none
+        "phone_international_prefix": environ.get("PHONE_INTERNATIONAL_PREFIX", "00").strip(), # Prefix of international numbers
+        # Port of the caller ID lookup endpoint in daemon mode ("GET /lookup?number=<number>"). Default is 0, which disables it.
+        "callerid_lookup_port": get_int_env(environ, "CALLERID_LOOKUP_PORT", 0),
+        "callerid_lookup_bind": environ.get("CALLERID_LOOKUP_BIND", "127.0.0.1").strip(), # Address the lookup endpoint listens on
+        "callerid_min_suffix_digits": get_int_env(environ, "CALLERID_MIN_SUFFIX_DIGITS", 6), # Shortest trailing match accepted for unknown formats
+
+        # Files the timings and counters of every cycle are written to: a JSON report and a Prometheus textfile
+        # for the node_exporter textfile collector (the name must end with .prom). Empty (default) disables them.
+        "metrics_json_file": environ.get("METRICS_JSON_FILE", "").strip(),
+        "metrics_prometheus_file": environ.get("METRICS_PROMETHEUS_FILE", "").strip(),
+        # Set to "true" to also record latency histograms of CardDAV requests and LDAP operations. Default is "false".
+        "metrics_histograms": get_boolean_env(environ, "METRICS_HISTOGRAMS", default=False),
+
+        # Local file that keeps per-address-book sync state (sync tokens etc.) between runs.
+        "sync_state_file": environ.get("SYNC_STATE_FILE", "/var/lib/carddav2ldap/state.json"),
+        # Lock file that prevents two synchronizations (cron runs, daemon cycles or manual runs) from running at the same time.
+        "sync_lock_file": environ.get("SYNC_LOCK_FILE", "/var/lib/carddav2ldap/sync.lock"),
+        "sync_interval": get_float_env(environ, "SYNC_INTERVAL_SECONDS", 1800.0), # Seconds between the starts of two daemon cycles
+        "sync_interval_jitter": get_float_env(environ, "SYNC_INTERVAL_JITTER_SECONDS", 0.0), # Random extra delay between daemon cycles
+        # Port of the HTTP endpoint that triggers an immediate synchronization in daemon mode ("POST /sync?addressbook=<name>").
+        # Default is 0, which disables the endpoint.
+        "sync_trigger_port": get_int_env(environ, "SYNC_TRIGGER_PORT", 0),
+        # Address the sync trigger endpoint listens on. Default is "127.0.0.1" (this host only).
+        "sync_trigger_bind": environ.get("SYNC_TRIGGER_BIND", "127.0.0.1").strip(),
+        # Token the sync trigger endpoint expects in an "Authorization: Bearer <token>" header.
+        # Optional for a loopback bind, required for any other SYNC_TRIGGER_BIND.
+        "sync_trigger_token": environ.get("SYNC_TRIGGER_TOKEN", ""),
+        "sync_trigger_debounce": get_float_env(environ, "SYNC_TRIGGER_DEBOUNCE_SECONDS", 5.0), # Quiet time before a triggered cycle starts
+
+        # Use the global 'DEBUG' variable to control Python debug output (the default of LOG_LEVEL)
+        "debug": get_boolean_env(environ, "DEBUG", default=False),
+        # Lowest level of the log output: DEBUG, INFO (default, DEBUG if DEBUG is "true"), WARNING or ERROR
+        "log_level": environ.get("LOG_LEVEL", "").strip().upper(),
+        # "text" (default) writes "LEVEL: message" lines, "json" one JSON object per line
+        "log_format": environ.get("LOG_FORMAT", "text").strip().lower(),
+        "log_warning_limit": get_int_env(environ, "LOG_WARNING_LIMIT", 20), # Warnings with the same message logged per cycle, 0 logs all
+        # Censor e-mail addresses, phone numbers etc. in debug output
+        "censor_secrets_in_logs": get_boolean_env(environ, "CENSOR_SECRETS_IN_LOGS", default=True),
+    }
+    if not config["log_level"]:
+        config["log_level"] = "DEBUG" if config["debug"] else "INFO"
+    validate_config(config)
+    # The whitelists and blacklists are compiled once, see filters.py
+    try:
+        config["filters"] = compile_filters(config)
+    except re.error as e:
+        raise ConfigError(f"Invalid regular expression in a whitelist or blacklist: {e}")
+    # The state file is only needed if one of the incremental features is enabled.
+    # An LDIF export always fetches every contact and leaves the state of the regular sync untouched.
+    config["use_sync_state"] = ((config["fetch_mode"] != "propfind" or config["skip_unchanged_books"] or config["skip_unchanged_contacts"])
+                                and not config["ldap_export_ldif_file"])
+    return config
+
+def validate_config(config):
+    """Checks the ranges and choices of the settings. Raises ConfigError for the first invalid one."""
+    if config["fetch_mode"] not in ("propfind", "sync-collection", "etag"):
+        raise ConfigError(f"Invalid CARDDAV_FETCH_MODE '{config['fetch_mode']}'. Expected 'propfind', 'sync-collection' or 'etag'.")
+    if config["multiget_batch_size"] < 1:
+        raise ConfigError(f"CARDDAV_MULTIGET_BATCH_SIZE must be at least 1, got {config['multiget_batch_size']}.")
+    if config["http_retries"] < 0 or config["http_pool_size"] < 1:
+        raise ConfigError("CARDDAV_HTTP_RETRIES must not be negative and CARDDAV_HTTP_POOL_SIZE must be at least 1.")
+    if config["fetch_workers"] < 1 or config["parse_workers"] < 1 or config["parse_chunk_size"] < 1 or config["fetch_queue_size"] < 1:
+        raise ConfigError("CARDDAV_FETCH_WORKERS, CARDDAV_PARSE_WORKERS, CARDDAV_PARSE_CHUNK_SIZE and CARDDAV_FETCH_QUEUE_SIZE must be at least 1.")
+    if config["ldap_page_size"] < 1 or config["ldap_write_workers"] < 1:
+        raise ConfigError("LDAP_SEARCH_PAGE_SIZE and LDAP_WRITE_WORKERS must be at least 1.")
+    if config["photo_max_dimension"] < 32 or config["photo_max_bytes"] < 1024:
+        raise ConfigError("CARDDAV_PHOTO_MAX_DIMENSION must be at least 32 and CARDDAV_PHOTO_MAX_BYTES at least 1024.")
+    if config["import_photos"] and config["normalize_photos"] and not is_pillow_available():
+        raise ConfigError("CARDDAV_NORMALIZE_PHOTOS requires Pillow. Install it with 'pip install -r requirements-photos.txt' or disable the option.")
+    if config["sync_interval"] < 1 or config["sync_interval_jitter"] < 0:
+        raise ConfigError("SYNC_INTERVAL_SECONDS must be at least 1 and SYNC_INTERVAL_JITTER_SECONDS must not be negative.")
+    if not 0 <= config["sync_trigger_port"] <= 65535 or config["sync_trigger_debounce"] < 0:
+        raise ConfigError("SYNC_TRIGGER_PORT must be between 0 and 65535 and SYNC_TRIGGER_DEBOUNCE_SECONDS must not be negative.")
+    if config["sync_trigger_port"] and not config["sync_trigger_token"] and not is_loopback_bind(config["sync_trigger_bind"]):
+        # Anyone who can reach the port could start full synchronizations
+        raise ConfigError(f"SYNC_TRIGGER_TOKEN must be set when the sync trigger endpoint listens on '{config['sync_trigger_bind']}'. "
+                          "Set a token or SYNC_TRIGGER_BIND=127.0.0.1.")
+    if config["ldap_stale_entries"] not in ("keep", "dry-run", "delete"):
+        raise ConfigError(f"Invalid LDAP_STALE_ENTRIES '{config['ldap_stale_entries']}'. Expected 'keep', 'dry-run' or 'delete'.")
+    if config["ldap_max_deletions"] < 0:
+        raise ConfigError(f"LDAP_MAX_DELETIONS must not be negative, got {config['ldap_max_deletions']}.")
+    for var_name, value in (("PHONE_DEFAULT_COUNTRY_CODE", config["phone_default_country_code"]),
+                            ("PHONE_TRUNK_PREFIX", config["phone_trunk_prefix"]),
+                            ("PHONE_INTERNATIONAL_PREFIX", config["phone_international_prefix"])):
+        if value and not value.isdigit():
+            raise ConfigError(f"{var_name} must only contain digits, got '{value}'.")
+    if not 0 <= config["callerid_lookup_port"] <= 65535 or config["callerid_min_suffix_digits"] < 1:
+        raise ConfigError("CALLERID_LOOKUP_PORT must be between 0 and 65535 and CALLERID_MIN_SUFFIX_DIGITS must be at least 1.")
+    if config["log_level"] not in ("DEBUG", "INFO", "WARNING", "ERROR"):
+        raise ConfigError(f"Invalid LOG_LEVEL '{config['log_level']}'. Expected 'DEBUG', 'INFO', 'WARNING' or 'ERROR'.")
+    if config["log_format"] not in ("text", "json") or config["log_warning_limit"] < 0:
+        raise ConfigError("LOG_FORMAT must be 'text' or 'json' and LOG_WARNING_LIMIT must not be negative.")
+    unknown_formats = [f for f in config["phonebook_formats"] if f not in PHONEBOOK_FORMATS]
+    if unknown_formats:
+        raise ConfigError(f"Invalid PHONEBOOK_FORMATS {unknown_formats}. Expected any of {sorted(PHONEBOOK_FORMATS)}.")
+
+def build_parse_options(config):
+    """Returns the options passed to parse_card(), a plain dict so they can be sent to worker processes."""
+    return {
+        "import_photos": config["import_photos"],
+        # Debug messages are only built in the workers if they are logged
+        "debug": config["log_level"] == "DEBUG",
+        "fast_parser": config["fast_vcard_parser"],
+        # Contact filters, applied before the phones, addresses and photo of a card are read
+        "filters": config["filters"],
+        "phone_options": build_phone_options(config),
+        # Limits and cache of the photo conversion, None imports photos unchanged
+        "photo_options": {
+            "max_dimension": config["photo_max_dimension"],
+            "max_bytes": config["photo_max_bytes"],
+            "cache_dir": config["photo_cache_dir"],
+        } if config["normalize_photos"] else None,
+    }
+
+def build_phone_options(config):
+    """Returns the options of normalize_phone_number(), None if PHONE_DEFAULT_COUNTRY_CODE is not set."""
+    if not config["phone_default_country_code"]:
+        return None
+    return {
+        "country_code": config["phone_default_country_code"],
+        "trunk_prefix": config["phone_trunk_prefix"],
+        "international_prefix": config["phone_international_prefix"],
+    }
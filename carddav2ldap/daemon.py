@@ -0,0 +1,186 @@
+# carddav2ldap/daemon.py
+# Daemon mode (--daemon): runs a synchronization every SYNC_INTERVAL_SECONDS and, if SYNC_TRIGGER_PORT is set,
+# whenever the sync trigger endpoint is called. Serves the caller ID lookup if CALLERID_LOOKUP_PORT is set.
+# Stops gracefully on SIGTERM/SIGINT.
+
+import json
+import logging
+import random # Import for the jitter of the daemon interval
+import signal # Import for stopping the daemon gracefully on SIGTERM
+import threading # Import for waiting between daemon cycles
+import time
+import hmac # Import for comparing the sync trigger token in constant time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler # Import for the sync trigger endpoint
+from .caller_id import start_caller_id_server
+
+logger = logging.getLogger(__name__)
+
+STOP_POLL_SECONDS = 1.0 # How often the waiting daemon checks for a stop signal
+
+# --- Sync triggers (daemon mode) ---
+class SyncTriggers:
+    """
+    Collects the address books requested through the sync trigger endpoint and the stop request of the daemon.
+    A burst of triggers is coalesced into one cycle that starts once no trigger arrived for
+    SYNC_TRIGGER_DEBOUNCE_SECONDS, but no later than four times that after the first trigger of the burst.
+    """
+    def __init__(self, debounce):
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        self.book_names = set()
+        self.all_books = False # A trigger without address book name requests a full cycle
+        self.first_request = None
+        self.last_request = None
+        self.stop_signal = None # Set by the signal handler, noticed by the main thread in check_stop
+        self.stopping = False
+
+    def request(self, book_names):
+        """Requests a cycle for the given address book names, or for all address books if there are none."""
+        with self.condition:
+            now = time.monotonic()
+            if self.first_request is None:
+                self.first_request = now
+            self.last_request = now
+            if book_names:
+                self.book_names.update(book_names)
+            else:
+                self.all_books = True
+            self.condition.notify_all()
+
+    def stop(self, signum):
+        """
+        Requests the daemon to stop. Only sets an attribute and neither locks nor logs, so it is safe to call
+        from a signal handler. The main thread notices the request in check_stop within STOP_POLL_SECONDS.
+        """
+        self.stop_signal = signum
+
+    def check_stop(self):
+        """Returns whether the daemon is stopping. Logs a pending stop request and wakes up waiting threads."""
+        if self.stop_signal is not None and not self.stopping:
+            logger.info("Received %s. Stopping the daemon.", signal.Signals(self.stop_signal).name)
+            with self.condition:
+                self.stopping = True
+                self.condition.notify_all()
+        return self.stopping
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for triggered address books. Returns their names, or None if a full cycle
+        is due (timeout reached or a trigger without address book name). Returns None immediately when stopping.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not self.check_stop():
+                now = time.monotonic()
+                due = deadline
+                if self.first_request is not None:
+                    due = min(self.last_request + self.debounce, self.first_request + 4 * self.debounce)
+                    if now >= due:
+                        book_names = None if self.all_books else self.book_names
+                        self.clear()
+                        return book_names
+                if now >= deadline:
+                    self.clear() # The full cycle covers the pending triggers
+                    return None
+                # Wakes up regularly, a signal handler cannot notify the condition
+                self.condition.wait(min(deadline - now, due - now, STOP_POLL_SECONDS))
+            return None
+
+    def clear(self):
+        """Forgets the pending triggers. Call with the condition held."""
+        self.book_names = set()
+        self.all_books = False
+        self.first_request = None
+        self.last_request = None
+
+class SyncTriggerHandler(BaseHTTPRequestHandler):
+    """Handles "POST /sync?addressbook=<name>" requests. The addressbook parameter may be repeated or left out."""
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        # Read the request body (if any) so the connection stays usable
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if url.path.rstrip("/") != "/sync":
+            self.send_json(404, {"error": "not found"})
+            return
+        if self.server.token:
+            expected = f"Bearer {self.server.token}".encode("utf-8")
+            if not hmac.compare_digest(self.headers.get("Authorization", "").encode("utf-8"), expected):
+                logger.warning("Rejected sync trigger from %s with a missing or wrong token.", self.client_address[0])
+                self.send_json(401, {"error": "unauthorized"})
+                return
+        book_names = [name.strip() for name in urllib.parse.parse_qs(url.query).get("addressbook", []) if name.strip()]
+        logger.info("Sync triggered by %s for %s.", self.client_address[0],
+                    ", ".join(repr(name) for name in book_names) if book_names else "all address books")
+        self.server.sync_triggers.request(book_names)
+        self.send_json(202, {"status": "accepted", "addressbooks": book_names or "all"})
+
+    def do_GET(self):
+        self.send_json(405 if urllib.parse.urlsplit(self.path).path.rstrip("/") == "/sync" else 404, {"error": "use POST /sync"})
+
+    def send_json(self, status, body):
+        response_body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        logger.debug("Sync trigger endpoint: %s " + format, self.client_address[0], *args)
+
+def start_sync_trigger_server(config, sync_triggers):
+    """Serves the sync trigger endpoint in a background thread. Returns the server, or None if it could not be started."""
+    bind, port = config["sync_trigger_bind"], config["sync_trigger_port"]
+    try:
+        server = ThreadingHTTPServer((bind, port), SyncTriggerHandler)
+    except OSError as e:
+        logger.error("Could not start the sync trigger endpoint on %s:%s: %s", bind, port, e)
+        return None
+    server.daemon_threads = True
+    # Read by SyncTriggerHandler
+    server.sync_triggers = sync_triggers
+    server.token = config["sync_trigger_token"]
+    threading.Thread(target=server.serve_forever, name="sync-trigger", daemon=True).start()
+    logger.info("Sync trigger endpoint listening on %s:%s (POST /sync?addressbook=<name>, debounce %g seconds).",
+                bind, port, config["sync_trigger_debounce"])
+    return server
+
+def run_daemon(synchronizer, config):
+    """Runs synchronization cycles until SIGTERM or SIGINT is received."""
+    sync_interval = config["sync_interval"]
+    sync_interval_jitter = config["sync_interval_jitter"]
+    sync_triggers = SyncTriggers(config["sync_trigger_debounce"])
+
+    def handle_stop_signal(signum, frame):
+        """Lets the current cycle finish and stops the daemon afterwards."""
+        sync_triggers.stop(signum)
+
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+    signal.signal(signal.SIGINT, handle_stop_signal)
+    logger.info("Running as daemon. Synchronizing every %g seconds (plus up to %g seconds jitter).", sync_interval, sync_interval_jitter)
+    sync_trigger_server = start_sync_trigger_server(config, sync_triggers) if config["sync_trigger_port"] else None
+    caller_id_server = start_caller_id_server(config, synchronizer) if config["callerid_lookup_port"] else None
+    # HTTP session, LDAP connections, parse workers and sync state are kept between cycles
+    next_cycle_books = None # None runs a full cycle, otherwise the names of the triggered address books
+    while not sync_triggers.check_stop():
+        cycle_start = time.monotonic()
+        try:
+            if not synchronizer.run_locked_cycle(next_cycle_books):
+                logger.error("Synchronization cycle failed. Retrying in the next cycle.")
+        except Exception as e:
+            logger.error("Synchronization cycle failed: %s. Retrying in the next cycle.", e)
+            synchronizer.directory.close()
+        if next_cycle_books is None:
+            # The interval is measured from the start of the full cycle, a cycle that took longer is followed immediately.
+            # Triggered cycles do not postpone the next full cycle.
+            next_full_cycle = cycle_start + sync_interval + random.uniform(0, sync_interval_jitter)
+        delay = max(0.0, next_full_cycle - time.monotonic())
+        if not sync_triggers.check_stop():
+            logger.info("Next synchronization in %.0f seconds.", delay)
+        next_cycle_books = sync_triggers.wait(delay)
+    if sync_trigger_server is not None:
+        sync_trigger_server.shutdown()
+    if caller_id_server is not None:
+        caller_id_server.shutdown()
+    logger.info("Daemon stopped.")
@@ -0,0 +1,134 @@
+# carddav2ldap/filters.py
+# Whitelist/Blacklist filters for address books and individual contacts (pipeline stage filter_contact()).
+#
+# The lists are compiled once by compile_filters() (see load_config()). Every entry of a list is one rule:
+#   example.com       exact match (a set lookup)
+#   .example.com      example.com and all its subdomains (email domain lists only)
+#   *.example.*       glob pattern with *, ? and [...]
+#   re:^ex[0-9]+$     regular expression, has to match the whole value
+# Email domains are compared case-insensitively, categories and address book names exactly as written.
+
+import fnmatch # Import for translating glob rules to regular expressions
+import re
+
+# Characters that make a rule a glob pattern
+GLOB_CHARACTERS = set("*?[")
+
+def normalize_domain(domain):
+    """Returns the comparison form of a domain: lowercase, without surrounding spaces and trailing dot."""
+    return domain.strip().lower().rstrip(".")
+
+def email_domain(email):
+    """Returns the domain of an email address (everything after the last '@')."""
+    return email.rpartition("@")[2]
+
+class FilterRules:
+    """
+    A compiled whitelist or blacklist. Plain entries are kept in a frozenset, subdomain rules in a second one
+    that is checked for every parent domain, and every glob and regex rule is compiled on its own (a rule with an
+    inline flag like (?i) could not be combined with the others). Raises re.error naming the rule if a regex
+    rule is invalid.
+    """
+    __slots__ = ("exact", "suffixes", "patterns", "domains")
+
+    def __init__(self, entries, domains=False):
+        exact = set()
+        suffixes = set()
+        patterns = []
+        flags = re.IGNORECASE if domains else 0
+        for entry in entries:
+            if entry.startswith("re:"):
+                try:
+                    patterns.append(re.compile(entry[3:], flags))
+                except re.error as e:
+                    raise re.error(f"rule '{entry}': {e}") from e
+                continue
+            if domains:
+                entry = normalize_domain(entry)
+            if domains and entry.startswith("."):
+                suffixes.add(entry[1:])
+            elif GLOB_CHARACTERS.intersection(entry):
+                patterns.append(re.compile(fnmatch.translate(entry), flags))
+            else:
+                exact.add(entry)
+        self.exact = frozenset(exact)
+        self.suffixes = frozenset(suffixes)
+        self.patterns = tuple(patterns)
+        self.domains = domains
+
+    def __bool__(self):
+        """An empty list has no rules (an empty whitelist allows everything)."""
+        return bool(self.exact or self.suffixes or self.patterns)
+
+    def match(self, value):
+        """Checks if a value (a domain for email domain lists) matches one of the rules."""
+        if self.domains:
+            value = normalize_domain(value)
+        if value in self.exact:
+            return True
+        if self.suffixes:
+            # Check the domain and each of its parent domains: a.b.example.com, b.example.com, example.com, com
+            domain = value
+            while True:
+                if domain in self.suffixes:
+                    return True
+                dot = domain.find(".")
+                if dot < 0:
+                    break
+                domain = domain[dot + 1:]
+        return any(pattern.fullmatch(value) is not None for pattern in self.patterns)
+
+def compile_filters(config):
+    """Compiles the whitelists and blacklists of the config. Raises re.error if a regex rule is invalid."""
+    return {
+        "email_whitelist": FilterRules(config["email_whitelist_domains"], domains=True),
+        "email_blacklist": FilterRules(config["email_blacklist_domains"], domains=True),
+        "category_whitelist": FilterRules(config["category_whitelist"]),
+        "category_blacklist": FilterRules(config["category_blacklist"]),
+        "addressbook_whitelist": FilterRules(config["addressbook_whitelist"]),
+        "addressbook_blacklist": FilterRules(config["addressbook_blacklist"]),
+    }
+
+# --- Pipeline stages ---
+def filter_addressbook(addressbook_name, config):
+    """
+    Applies the address book filters. Returns None if the address book is synchronized,
+    otherwise the reason it is skipped (e.g. "not being in whitelist").
+    """
+    filters = config["filters"]
+    # If the whitelist is empty, all address books are allowed
+    if filters["addressbook_whitelist"] and not filters["addressbook_whitelist"].match(addressbook_name):
+        return "not being in whitelist"
+    if filters["addressbook_blacklist"].match(addressbook_name):
+        return "being in blacklist"
+    return None
+
+def filter_contact_fields(emails, categories, filters):
+    """
+    Applies the email domain and category filters to the emails and categories of a contact.
+    Used by parse_card() before the rest of the card is read, so skipped contacts are cheap.
+    Returns None if the contact is imported, otherwise the reason it is skipped.
+    """
+    # Filter by email domain
+    if filters["email_whitelist"]:
+        if not any(filters["email_whitelist"].match(email_domain(email)) for email in emails):
+            return "email not in whitelist"
+    if filters["email_blacklist"]:
+        if any(filters["email_blacklist"].match(email_domain(email)) for email in emails):
+            return "email in blacklist"
+
+    # Filter by category
+    if filters["category_whitelist"]:
+        if not any(filters["category_whitelist"].match(category) for category in categories):
+            return "category not in whitelist"
+    if filters["category_blacklist"]:
+        if any(filters["category_blacklist"].match(category) for category in categories):
+            return "category in blacklist"
+    return None
+
+def filter_contact(contact_data, config):
+    """
+    Applies the email domain and category filters to a parsed contact. Returns None if the contact
+    is imported, otherwise the reason it is skipped (e.g. "email not in whitelist").
+    """
+    return filter_contact_fields(contact_data['emails'], contact_data['categories'], config["filters"])
@@ -0,0 +1,424 @@
+# carddav2ldap/ldap_directory.py
+# Writes contacts to the LDAP server (pipeline stage apply_to_ldap()). LdapDirectory keeps the connections and
+# the index of the existing entries below LDAP_BASE_DN, so add, modify or no-op is decided locally for every contact.
+
+import concurrent.futures # Import for collecting pipelined LDAP writes as they finish
+import logging
+import queue # Import for the pool of LDAP connections
+import time
+from concurrent.futures import ThreadPoolExecutor
+import ldap3
+from ldap3.utils.dn import escape_rdn # Import for escaping RDN components
+from .ldap_entries import (managed_ldap_attributes, index_ldap_attributes, compute_ldap_changes, hash_contact,
+                           contact_uid, build_ldap_entry, format_ldap_entry_for_log)
+
+logger = logging.getLogger(__name__)
+
+class LdapDirectory:
+    """
+    Connection to the LDAP server, the pool of additional bound connections for pipelined writes
+    (LDAP_WRITE_WORKERS > 1) and the index of the existing entries. In daemon mode the connections are
+    kept open between cycles. Without connect() (LDIF export) the index stays empty, as for an empty directory.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.base_dn = config["ldap_base_dn"]
+        self.uid_attribute = config["ldap_uid_attribute"]
+        self.write_workers = config["ldap_write_workers"]
+        self.managed_attributes = managed_ldap_attributes(config)
+        # The index also holds cn, so the phonebooks can be built from it without searching the entries again
+        self.index_attributes = self.managed_attributes + ['cn']
+        self.server = None
+        self.conn = None
+        self.connection_pool = queue.Queue()
+        self.reset_index()
+
+    def reset_index(self):
+        """Forgets the entries read by load_index()."""
+        # Lowercased DN -> indexed managed attributes, and lowercased DN -> DN as returned by the server
+        self.ldap_index = {}
+        self.existing_dns = {}
+        # UID index: uid -> lowercased DN of its entry, and the reverse mapping to see which contact owns a DN.
+        self.uid_index = {}
+        self.dn_owners = {}
+
+    # --- LDAP connection helpers ---
+    def open_connection(self):
+        """Opens and binds a new connection to the LDAP server."""
+        if self.server is None:
+            self.server = ldap3.Server(self.config["ldap_server_url"], port=389, use_ssl=False) # Adjust port and use_ssl if needed
+        # client_encoding was removed as it caused 'unexpected keyword argument' error on some ldap3 versions.
+        # Python 3 strings are Unicode, and ldap3 should handle UTF-8 encoding by default.
+        return ldap3.Connection(self.server, user=self.config["ldap_user"], password=self.config["ldap_password"],
+                          auto_bind=True, client_strategy='SYNC', # Changed to string literal 'SYNC'
+                          authentication='SIMPLE') # Changed to string literal 'SIMPLE'
+
+    def is_connection_alive(self):
+        """
+        Checks if the connections opened by a previous daemon cycle can still be used, with a search for
+        LDAP_BASE_DN that returns no attributes on each of them. The server closes idle connections after its idle timeout.
+        """
+        if self.conn is None or not self.conn.bound:
+            return False
+        pool_conns = list(self.connection_pool.queue)
+        if len(pool_conns) != (self.write_workers if self.write_workers > 1 else 0):
+            return False
+        try:
+            for checked_conn in [self.conn] + pool_conns:
+                # Any answer of the server shows that the connection is still open
+                checked_conn.search(self.base_dn, '(objectClass=*)', search_scope=ldap3.BASE, attributes=['1.1'])
+                if checked_conn.closed:
+                    return False
+        except Exception:
+            return False
+        return True
+
+    def connect(self):
+        """Connects and binds, or reuses the connections of the previous cycle. Returns False if that failed."""
+        if self.is_connection_alive():
+            logger.info("Reusing the LDAP connection of the previous cycle.")
+            return True
+        self.close() # Connections of the previous cycle that were closed by the server
+        try:
+            self.conn = self.open_connection()
+
+            if not self.conn.bind():
+                logger.error("LDAP bind failed: %s", self.conn.result)
+                # LDAP bind values for invalidDNSyntax diagnosis
+                logger.debug("LDAP User (bind_dn): '%s'", self.config['ldap_user'])
+                # Censor password if required by CENSOR_SECRETS_IN_LOGS
+                if self.config["censor_secrets_in_logs"]:
+                    logger.debug("LDAP Password: [REDACTED]")
+                else:
+                    ldap_password = self.config["ldap_password"]
+                    logger.debug("LDAP Password length: %d (not printed for security)", len(ldap_password) if ldap_password else 0)
+                logger.debug("LDAP Server URL: '%s'", self.config['ldap_server_url'])
+                logger.debug("LDAP Base DN: '%s'", self.base_dn) # Crucial for DN syntax
+                self.close()
+                return False
+            logger.info("Successfully connected and bound to LDAP server.")
+
+            # Additional bound connections for pipelined writes, each worker thread uses one of them at a time
+            if self.write_workers > 1:
+                for _ in range(self.write_workers):
+                    pool_conn = self.open_connection()
+                    if not pool_conn.bound and not pool_conn.bind():
+                        logger.error("LDAP bind failed: %s", pool_conn.result)
+                        self.close()
+                        return False
+                    self.connection_pool.put(pool_conn)
+                logger.info("Opened %d LDAP connections for parallel writes.", self.write_workers)
+
+        except Exception as e:
+            logger.error("Failed to connect to LDAP server: %s", e)
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        """Unbinds the connection and the connection pool. Errors of already closed connections are ignored."""
+        open_conns = [self.conn] if self.conn is not None else []
+        while not self.connection_pool.empty():
+            open_conns.append(self.connection_pool.get())
+        for open_conn in open_conns:
+            try:
+                open_conn.unbind()
+            except Exception:
+                pass
+        self.conn = None
+
+    # --- Index of the existing entries ---
+    def load_index(self):
+        """
+        Reads all existing entries below LDAP_BASE_DN with one paged search.
+        Entries without the UID attribute (created by older versions) are matched by their DN once and then get one.
+        """
+        self.reset_index()
+        for entry in self.conn.extend.standard.paged_search(self.base_dn, '(objectClass=inetOrgPerson)',
+                                                            search_scope=ldap3.LEVEL, attributes=self.index_attributes,
+                                                            paged_size=self.config["ldap_page_size"], generator=True):
+            if entry.get('type') != 'searchResEntry':
+                continue
+            self.ldap_index[entry['dn'].lower()] = index_ldap_attributes(entry['raw_attributes'], self.index_attributes)
+            self.existing_dns[entry['dn'].lower()] = entry['dn']
+        if self.uid_attribute:
+            for dn, indexed_attributes in self.ldap_index.items():
+                for value in indexed_attributes.get(self.uid_attribute, ()):
+                    self.uid_index[value.decode('utf-8')] = dn
+                    self.dn_owners[dn] = value.decode('utf-8')
+
+    def read_entry(self, conn, ldap_dn):
+        """Reads the indexed attributes of a single entry. Returns None if the entry does not exist."""
+        if not conn.search(ldap_dn, '(objectClass=*)', search_scope=ldap3.BASE, attributes=self.index_attributes):
+            return None
+        return index_ldap_attributes(conn.response[0]['raw_attributes'], self.index_attributes)
+
+    def choose_ldap_rdn(self, contact):
+        """
+        Returns the RDN for a contact: cn=<full name>, or cn=<full name>+<LDAP_UID_ATTRIBUTE>=<uid> if an entry
+        of another contact already uses cn=<full name>. An entry that already has the second form keeps it, also
+        after the other contact is renamed or removed, so a DN only changes with the name of its own contact and
+        does not depend on the order in which the writes of a cycle finish.
+        """
+        cn_rdn = f"cn={escape_rdn(contact['full_name'])}"
+        if not self.uid_attribute:
+            return cn_rdn
+        uid = contact_uid(contact)
+        uid_rdn = f"{cn_rdn}+{self.uid_attribute}={escape_rdn(uid)}"
+        if self.uid_index.get(uid) == f"{uid_rdn},{self.base_dn}".lower():
+            return uid_rdn
+        owner = self.dn_owners.get(f"{cn_rdn},{self.base_dn}".lower())
+        if owner is None or owner == uid:
+            return cn_rdn
+        return uid_rdn
+
+    # --- Writing entries ---
+    def write_entry(self, conn, contact, ldap_dn, ldap_rdn, current_dn, attributes):
+        """
+        Renames, adds or modifies the entry of one contact on the given connection.
+        Runs in a worker thread when LDAP_WRITE_WORKERS > 1, so messages are collected in the returned result
+        instead of being logged directly. Returns a dict with the outcome ("added", "updated", "unchanged" or
+        "failed"), the lowercased DN the entry was renamed from (or None), the log messages as (level, msg, args), the duration of every
+        LDAP operation as (operation, seconds) and the number of jpegPhoto bytes written.
+        """
+        ldap_index = self.ldap_index
+        existing_dns = self.existing_dns
+        write_log = []
+
+        def log(level, msg, *args):
+            # Messages below the log level are not collected at all
+            if logger.isEnabledFor(level):
+                write_log.append((level, msg, args))
+
+        latencies = []
+        write_result = {"contact": contact, "outcome": "failed", "renamed_from": None, "log": write_log,
+                        "latencies": latencies, "photo_bytes": 0}
+
+        def timed(operation, ldap_call, *args):
+            start = time.perf_counter()
+            try:
+                return ldap_call(*args)
+            finally:
+                latencies.append((operation, time.perf_counter() - start))
+
+        try:
+            if current_dn is not None and current_dn != ldap_dn.lower() and ldap_dn.lower() not in ldap_index:
+                # The contact was renamed in CardDAV, move its entry with a single modify_dn
+                timed("modify_dn", conn.modify_dn, existing_dns.get(current_dn, current_dn), ldap_rdn)
+                if conn.result['description'] != 'success':
+                    log(logging.WARNING, "Failed to rename entry %s to %s: %s", existing_dns.get(current_dn, current_dn), ldap_dn, conn.result)
+                    return write_result
+                log(logging.DEBUG, "Renamed contact: %s -> %s", existing_dns.get(current_dn, current_dn), ldap_dn)
+                write_result["renamed_from"] = current_dn
+                # modify_dn also removes the values of the old RDN, read the entry again before comparing
+                ldap_index.pop(current_dn, None)
+                existing_dns.pop(current_dn, None)
+                ldap_index[ldap_dn.lower()] = self.read_entry(conn, ldap_dn) or {}
+            if self.uid_attribute:
+                self.uid_index[contact_uid(contact)] = ldap_dn.lower()
+
+            existing = ldap_index.get(ldap_dn.lower())
+            if existing is None:
+                # Attempt to add the entry
+                timed("add", conn.add, ldap_dn, None, attributes)
+                if conn.result['description'] == 'success':
+                    log(logging.DEBUG, "Added contact: %s", contact['full_name'])
+                    write_result["outcome"] = "added"
+                    write_result["photo_bytes"] = len(attributes.get('jpegPhoto') or b"")
+                    ldap_index[ldap_dn.lower()] = index_ldap_attributes(attributes, self.index_attributes)
+                    return write_result
+                if conn.result['description'] != 'entryAlreadyExists':
+                    log(logging.WARNING, "Failed to add/update contact %s: %s", contact['full_name'], conn.result)
+                    return write_result
+                # The entry exists under a differently written DN, compare with its current attributes
+                log(logging.DEBUG, "Contact '%s' already exists. Attempting to update.", contact['full_name'])
+                existing = self.read_entry(conn, ldap_dn) or {}
+
+            # Only send the attributes that actually changed
+            changes = compute_ldap_changes(existing, attributes, self.managed_attributes)
+            if not changes:
+                write_result["outcome"] = "unchanged"
+                log(logging.DEBUG, "No changes detected for contact %s. Skipping update.", contact['full_name'])
+                return write_result
+
+            log(logging.DEBUG, "Changed attributes of '%s': %s", ldap_dn, sorted(changes))
+            timed("modify", conn.modify, ldap_dn, changes)
+            if conn.result['description'] == 'success':
+                log(logging.DEBUG, "Updated contact: %s", contact['full_name'])
+                write_result["outcome"] = "updated"
+                write_result["photo_bytes"] = sum(len(value) for _, values in changes.get('jpegPhoto', []) for value in values)
+                ldap_index[ldap_dn.lower()] = index_ldap_attributes(attributes, self.index_attributes)
+            else:
+                log(logging.WARNING, "Failed to update contact %s: %s", contact['full_name'], conn.result)
+                # The entry may be partially modified, read it again before the next comparison
+                ldap_index.pop(ldap_dn.lower(), None)
+
+        except Exception as e:
+            log(logging.ERROR, "Failed to add/update contact '%s' to LDAP: %s", contact['full_name'], e)
+        return write_result
+
+    def write_entry_pooled(self, *args):
+        """Runs write_entry() on a connection taken from the pool of bound connections."""
+        pooled_conn = self.connection_pool.get()
+        try:
+            return self.write_entry(pooled_conn, *args)
+        finally:
+            self.connection_pool.put(pooled_conn)
+
+    # --- Removing stale entries ---
+    def remove_stale_entries(self, stale_dns, metrics=None):
+        """
+        Removes (or, with LDAP_STALE_ENTRIES=dry-run, only logs) the entries with the given lowercased DNs.
+        Nothing is removed if there are more than LDAP_MAX_DELETIONS of them. Returns the number of removed entries.
+        The latency of every delete is recorded in metrics (a SyncMetrics, optional).
+        """
+        max_deletions = self.config["ldap_max_deletions"]
+        if len(stale_dns) > max_deletions:
+            logger.warning("Found %d stale entries, which is more than LDAP_MAX_DELETIONS (%d). "
+                           "Not removing any of them. Check the CardDAV server or raise LDAP_MAX_DELETIONS.", len(stale_dns), max_deletions)
+            return 0
+        if self.config["ldap_stale_entries"] == "dry-run":
+            for dn in stale_dns:
+                logger.info("Dry run, would remove stale entry: %s", self.existing_dns[dn])
+            logger.info("Dry run, %d stale entries would be removed.", len(stale_dns))
+            return 0
+        deleted_count = 0
+        for dn in stale_dns:
+            start = time.perf_counter()
+            try:
+                self.conn.delete(self.existing_dns[dn])
+            except Exception as e:
+                logger.error("Failed to remove stale entry %s: %s", self.existing_dns[dn], e)
+                continue
+            finally:
+                if metrics is not None:
+                    metrics.observe("ldap_delete", time.perf_counter() - start)
+            if self.conn.result['description'] == 'success':
+                logger.info("Removed stale entry: %s", self.existing_dns.pop(dn))
+                self.ldap_index.pop(dn, None)
+                deleted_count += 1
+            else:
+                logger.warning("Failed to remove stale entry %s: %s", self.existing_dns[dn], self.conn.result)
+        logger.info("Removed %d of %d stale entries.", deleted_count, len(stale_dns))
+        return deleted_count
+
+# --- Import contacts into LDAP ---
+def apply_to_ldap(contacts, directory, config, previous_books, ldif_export=None, metrics=None):
+    """
+    Writes the entries of the given contacts (any iterable, consumed as it is produced) to the directory,
+    or to ldif_export if one is given. previous_books is the "books" part of the sync state of the previous run,
+    used to skip unchanged contacts (LDAP_SKIP_UNCHANGED_CONTACTS). The latency of every LDAP operation and the
+    photo bytes written are recorded in metrics (a SyncMetrics, optional).
+    Returns a dict with the import counts, the lowercased DNs of all contacts ("produced_dns"), the DN and hash
+    of every contact keyed by (book_url, href) ("card_updates") and the address books with failed writes.
+    Raises OSError if the LDIF export cannot be written.
+    """
+    # Checked once, so the debug output of every entry is skipped without any formatting work
+    debug = logger.isEnabledFor(logging.DEBUG)
+    uid_attribute = config["ldap_uid_attribute"]
+    skip_unchanged_contacts = config["skip_unchanged_contacts"]
+    write_workers = config["ldap_write_workers"]
+    import_result = {
+        "counts": {"added": 0, "updated": 0, "renamed": 0, "unchanged": 0, "failed": 0, "exported": 0, "skipped": 0},
+        # Lowercased DNs of all contacts of this run, entries not in this set are stale
+        "produced_dns": set(),
+        # DN (and hash) of every imported contact, stored in the sync state of its address book
+        "card_updates": {},
+        # Address books with at least one failed LDAP operation. Their sync state is not advanced,
+        # so the affected contacts are fetched again on the next run.
+        "failed_book_urls": set(),
+    }
+    import_counts = import_result["counts"]
+    produced_dns = import_result["produced_dns"]
+    # Writes queued to the LDAP connection pool, mapped to the DNs/UIDs they touch (LDAP_WRITE_WORKERS > 1)
+    pending_writes = {}
+
+    def handle_write_result(write_result):
+        """Logs the messages of a finished write and records its outcome."""
+        for level, msg, args in write_result["log"]:
+            logger.log(level, msg, *args)
+        import_counts[write_result["outcome"]] += 1
+        if metrics is not None:
+            for operation, seconds in write_result["latencies"]:
+                metrics.observe(f"ldap_{operation}", seconds)
+            metrics.add("photo_bytes_written", write_result["photo_bytes"])
+        if write_result["renamed_from"] is not None:
+            import_counts["renamed"] += 1
+            if directory.dn_owners.get(write_result["renamed_from"]) == contact_uid(write_result["contact"]):
+                del directory.dn_owners[write_result["renamed_from"]]
+        if write_result["outcome"] == "failed":
+            import_result["failed_book_urls"].add(write_result["contact"]['book_url'])
+
+    def collect_finished_writes(done_futures):
+        """Handles the results of finished writes, in the order they finished."""
+        for future in done_futures:
+            del pending_writes[future]
+            handle_write_result(future.result())
+
+    def wait_for_pending_writes(keys):
+        """Waits until no queued write touches one of the given DNs/UIDs."""
+        conflicting = [future for future, future_keys in pending_writes.items() if future_keys & keys]
+        if conflicting:
+            collect_finished_writes(concurrent.futures.wait(conflicting).done)
+
+    ldap_write_executor = None
+    if write_workers > 1 and ldif_export is None and directory.conn is not None:
+        ldap_write_executor = ThreadPoolExecutor(max_workers=write_workers)
+    try:
+        for contact in contacts:
+            if ldap_write_executor is not None:
+                # A queued write of a contact with the same UID may still rename its entry
+                wait_for_pending_writes({contact_uid(contact)})
+            # Construct the DN (Distinguished Name) for the LDAP entry
+            # Using 'cn' (Common Name) for the RDN (Relative Distinguished Name)
+            ldap_rdn = directory.choose_ldap_rdn(contact)
+            ldap_dn = f"{ldap_rdn},{directory.base_dn}"
+            # DN of the existing entry of this contact, if it is known by its UID
+            current_dn = directory.uid_index.get(contact_uid(contact)) if uid_attribute else None
+            if uid_attribute:
+                directory.dn_owners[ldap_dn.lower()] = contact_uid(contact)
+            produced_dns.add(ldap_dn.lower())
+            # Remember the DN in the sync state, so it is known in later runs that do not fetch this contact
+            card_update = {"dn": ldap_dn}
+            import_result["card_updates"][(contact['book_url'], contact['href'])] = card_update
+
+            if skip_unchanged_contacts:
+                # Skip the contact if it is unchanged since the last successful run and its entry still exists
+                contact_hash = hash_contact(contact, config)
+                card_update["hash"] = contact_hash
+                previous_card = previous_books.get(contact['book_url'], {}).get("cards", {}).get(contact['href'], {})
+                if (previous_card.get("hash") == contact_hash and (previous_card.get("dn") or "").lower() == ldap_dn.lower()
+                        and ldap_dn.lower() in directory.ldap_index):
+                    import_counts["unchanged"] += 1
+                    import_counts["skipped"] += 1
+                    continue
+
+            attributes = build_ldap_entry(contact, config)
+
+            # Debug output for constructed LDAP entry, the censored copy of the attributes is only built when it is logged
+            if debug:
+                logger.debug("Parsed contact data (before LDAP operation): %s", contact)
+                logger.debug("Constructed LDAP DN: '%s'", ldap_dn)
+                logger.debug("LDAP attributes to add/modify: %s", format_ldap_entry_for_log(attributes, config['censor_secrets_in_logs']))
+
+            if ldif_export is not None:
+                ldif_export.write_entry(ldap_dn, attributes)
+                import_counts["exported"] += 1
+                continue
+            if ldap_write_executor is None:
+                handle_write_result(directory.write_entry(directory.conn, contact, ldap_dn, ldap_rdn, current_dn, attributes))
+                continue
+            # Operations on the same entry must not overlap, and only a bounded number of writes is queued
+            write_keys = {ldap_dn.lower(), contact_uid(contact)}
+            if current_dn is not None:
+                write_keys.add(current_dn)
+            wait_for_pending_writes(write_keys)
+            while len(pending_writes) >= 2 * write_workers:
+                collect_finished_writes(concurrent.futures.wait(pending_writes, return_when=concurrent.futures.FIRST_COMPLETED).done)
+            future = ldap_write_executor.submit(directory.write_entry_pooled, contact, ldap_dn, ldap_rdn, current_dn, attributes)
+            pending_writes[future] = write_keys
+    finally:
+        if ldap_write_executor is not None:
+            collect_finished_writes(concurrent.futures.wait(pending_writes).done)
+            ldap_write_executor.shutdown()
+    return import_result
@@ -0,0 +1,216 @@
+# carddav2ldap/ldap_entries.py
+# Builds the LDAP entry of a parsed contact (pipeline stage build_ldap_entry()) and compares entries with
+# the existing ones, so that only changed attributes are written.
+
+import hashlib # Import for comparing photos with existing LDAP entries by digest
+import json
+import logging
+import re
+import ldap3
+
+logger = logging.getLogger(__name__)
+
+# --- LDAP diff helpers ---
+# Attributes written by this script. Only these are read from existing entries and compared.
+# cn is the RDN and objectClass never changes, so both are only set when an entry is added.
+BASE_MANAGED_LDAP_ATTRIBUTES = ['sn', 'givenName', 'telephoneNumber', 'facsimileTelephoneNumber', 'mail',
+                                'streetAddress', 'l', 'postalCode', 'o', 'ou', 'title', 'businessCategory', 'jpegPhoto']
+
+def managed_ldap_attributes(config):
+    """Returns the attributes written by this script, including LDAP_UID_ATTRIBUTE if it is set."""
+    if config["ldap_uid_attribute"]:
+        return BASE_MANAGED_LDAP_ATTRIBUTES + [config["ldap_uid_attribute"]]
+    return list(BASE_MANAGED_LDAP_ATTRIBUTES)
+
+def normalize_ldap_values(attr_name, value):
+    """
+    Converts an attribute value (str, bytes or a list of them) into a set of bytes for comparison.
+    Photos are reduced to their SHA-256 digest, so the index of existing entries stays small.
+    """
+    values = value if isinstance(value, list) else [value]
+    values = {v if isinstance(v, bytes) else str(v).encode('utf-8') for v in values}
+    if attr_name == 'jpegPhoto':
+        return {hashlib.sha256(v).digest() for v in values}
+    return values
+
+def index_ldap_attributes(raw_attributes, managed_attributes):
+    """Builds the comparison form {attribute name: set of values} of the managed attributes of an entry."""
+    managed_names = {name.lower(): name for name in managed_attributes}
+    indexed = {}
+    for attr_name, values in raw_attributes.items():
+        name = managed_names.get(attr_name.lower())
+        if name and values:
+            indexed[name] = normalize_ldap_values(name, values)
+    return indexed
+
+def compute_ldap_changes(existing, attributes, managed_attributes):
+    """
+    Compares the attributes built for a contact with the indexed attributes of the existing entry.
+    Returns the ldap3 modify changes: MODIFY_ADD/MODIFY_DELETE when values were only added or only removed,
+    MODIFY_REPLACE otherwise. Managed attributes missing from the contact are deleted.
+    """
+    changes = {}
+    for attr_name in managed_attributes:
+        old_values = existing.get(attr_name, set())
+        if attr_name not in attributes:
+            if old_values:
+                changes[attr_name] = [(ldap3.MODIFY_DELETE, [])]
+            continue
+        new_value = attributes[attr_name]
+        new_list = new_value if isinstance(new_value, list) else [new_value]
+        new_values = normalize_ldap_values(attr_name, new_list)
+        if new_values == old_values:
+            continue
+        if not old_values:
+            changes[attr_name] = [(ldap3.MODIFY_ADD, new_list)]
+        elif attr_name != 'jpegPhoto' and old_values < new_values:
+            changes[attr_name] = [(ldap3.MODIFY_ADD, [v for v in new_list if v not in old_values])]
+        elif attr_name != 'jpegPhoto' and new_values < old_values:
+            changes[attr_name] = [(ldap3.MODIFY_DELETE, list(old_values - new_values))]
+        else:
+            changes[attr_name] = [(ldap3.MODIFY_REPLACE, new_list)]
+    return changes
+
+# Part of every contact hash. Increase it when the LDAP attributes built from a contact change,
+# so that all contacts are compared with LDAP again after an update.
+CONTACT_HASH_VERSION = 1
+
+def hash_contact(contact, config):
+    """
+    Returns a hash of the parsed contact data and the settings the LDAP entry depends on.
+    Photos are included by their SHA-256 digest.
+    """
+    hashed_data = dict(contact, jpeg_photo=hashlib.sha256(contact['jpeg_photo']).hexdigest() if contact['jpeg_photo'] else None)
+    hashed_data["_settings"] = [CONTACT_HASH_VERSION, config["ldap_uid_attribute"], config["ldap_base_dn"]]
+    return hashlib.sha256(json.dumps(hashed_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+def contact_uid(contact):
+    """Returns the stable identifier of a contact: its vCard UID, or its href if the card has no UID."""
+    return contact['uid'] or contact['href']
+
+# --- Building the entry ---
+def build_ldap_entry(contact, config):
+    """Returns the attributes of the LDAP entry of a parsed contact, values encoded as UTF-8 bytes."""
+    # Define LDAP attributes for the entry
+    # All values are now expected to be Python unicode strings from parsing.
+    # We will explicitly encode them to bytes before sending to LDAP, to enforce UTF-8.
+    attributes = {
+        'objectClass': ['inetOrgPerson', 'organizationalPerson', 'person', 'top'], # Added organizationalPerson and person
+        'cn': contact['full_name'].encode('utf-8'), # Explicitly encode
+        'sn': contact['surname'].encode('utf-8') # Explicitly encode
+    }
+
+    # Add givenName attribute ONLY if it has a non-empty value
+    if contact['given_name']:
+        attributes['givenName'] = contact['given_name'].encode('utf-8') # Explicitly encode
+
+    # Store the UID, so the entry is found again after the contact was renamed
+    if config["ldap_uid_attribute"]:
+        attributes[config["ldap_uid_attribute"]] = contact_uid(contact).encode('utf-8')
+
+    # Add various phone number attributes
+    # Collect all non-fax phone numbers for telephoneNumber
+    non_fax_phones = []
+    non_fax_phones.extend(contact['work_phones'])
+    non_fax_phones.extend(contact['home_phones'])
+    non_fax_phones.extend(contact['mobile_phones'])
+    non_fax_phones.extend(contact['other_phones']) # Include any uncategorized phones
+
+    # Filter out any numbers that are also identified as fax numbers
+    # This is crucial to prevent fax numbers from appearing in telephoneNumber
+    final_telephone_numbers = [p for p in non_fax_phones if p not in contact['fax_numbers']]
+
+    # Ensure uniqueness
+    final_telephone_numbers = list(set(final_telephone_numbers))
+
+    if final_telephone_numbers:
+        attributes['telephoneNumber'] = [p.encode('utf-8') for p in final_telephone_numbers]
+
+    # Add specific phone number types if they exist
+    # These are already lists, so we just check if they are non-empty
+    if contact['fax_numbers']:
+        attributes['facsimileTelephoneNumber'] = [p.encode('utf-8') for p in contact['fax_numbers']]
+
+    # Add optional attributes if they exist
+    if contact['emails']:
+        raw_email = contact['emails'][0] # Already stripped during parsing
+        # A very basic email regex, can be expanded if needed
+        if re.match(r"[^@]+@[^@]+\.[^@]+", raw_email):
+            attributes['mail'] = raw_email.encode('utf-8') # Explicitly encode
+        else:
+            logger.warning("Email for '%s' is malformed: '%s'. Skipping email attribute.", contact['full_name'], raw_email)
+
+    # Add address attributes only if they have non-empty values
+    if contact['street_address']:
+        attributes['streetAddress'] = contact['street_address'].encode('utf-8') # Explicitly encode
+    if contact['locality']:
+        attributes['l'] = contact['locality'].encode('utf-8') # Explicitly encode
+    if contact['postal_code']:
+        attributes['postalCode'] = contact['postal_code'].encode('utf-8') # Explicitly encode
+
+    # Add Organization (Company Name)
+    if contact['organization']:
+        attributes['o'] = contact['organization'].encode('utf-8') # Explicitly encode
+
+    # Add Organizational Unit (Department)
+    if contact['organizational_unit']:
+        attributes['ou'] = contact['organizational_unit'].encode('utf-8') # Explicitly encode
+
+    # Add Job Title
+    if contact['job_title']:
+        attributes['title'] = contact['job_title'].encode('utf-8') # Explicitly encode
+
+    # Add Categories
+    if contact['categories']:
+        attributes['businessCategory'] = [c.encode('utf-8') for c in contact['categories']] # Explicitly encode list elements
+
+    # Add jpegPhoto attribute if photo data is available
+    if contact['jpeg_photo']:
+        attributes['jpegPhoto'] = contact['jpeg_photo'] # Already bytes or None
+    return attributes
+
+def format_ldap_entry_for_log(attributes, censor_secrets):
+    """Returns the attributes of an entry with decoded values for debug output, personal data censored if requested."""
+    # For display, values should be strings. Decode bytes if they were explicitly encoded.
+    display_attributes = {}
+    for key, value in attributes.items():
+        if key == 'jpegPhoto': # Handle binary photo data separately
+            # Do not attempt to decode binary photo data as UTF-8
+            display_attributes[key] = '[REDACTED_PHOTO_DATA]' if censor_secrets else 'Bytes (not displayed)'
+        elif isinstance(value, list):
+            # Ensure all elements in lists are strings for display
+            # Only decode if the item is bytes, otherwise keep as is (already string or other type)
+            display_attributes[key] = [v.decode('utf-8') if isinstance(v, bytes) else v for v in value]
+        elif isinstance(value, bytes):
+            # Decode bytes to string for display (for other string attributes that were encoded)
+            display_attributes[key] = value.decode('utf-8')
+        else:
+            # Use value as is (already string or other type)
+            display_attributes[key] = value
+
+    if censor_secrets:
+        # Censor email and phone
+        if 'mail' in display_attributes:
+            display_attributes['mail'] = '[REDACTED_EMAIL]'
+        # Censor all phone list attributes
+        if 'telephoneNumber' in display_attributes:
+            display_attributes['telephoneNumber'] = ['[REDACTED_PHONE]' for _ in display_attributes['telephoneNumber']]
+        if 'facsimileTelephoneNumber' in display_attributes:
+            display_attributes['facsimileTelephoneNumber'] = ['[REDACTED_FAX]' for _ in display_attributes['facsimileTelephoneNumber']]
+        # Censor address fields
+        if 'streetAddress' in display_attributes:
+            display_attributes['streetAddress'] = '[REDACTED_STREET]'
+        if 'l' in display_attributes:
+            display_attributes['l'] = '[REDACTED_LOCALITY]'
+        if 'postalCode' in display_attributes:
+            display_attributes['postalCode'] = '[REDACTED_POSTAL_CODE]' # Postal code can be single or multi-valued depending on schema
+        # Censor organization and categories
+        if 'o' in display_attributes:
+            display_attributes['o'] = '[REDACTED_ORG]'
+        if 'ou' in display_attributes:
+            display_attributes['ou'] = '[REDACTED_OU]'
+        if 'title' in display_attributes:
+            display_attributes['title'] = '[REDACTED_TITLE]'
+        if 'businessCategory' in display_attributes:
+            display_attributes['businessCategory'] = ['[REDACTED_CATEGORY]' for _ in display_attributes['businessCategory']]
+    return display_attributes
@@ -0,0 +1,73 @@
+# carddav2ldap/ldif.py
+# LDIF export (RFC 2849) of the entries a run would create, for a fast bulk load with slapadd (LDAP_EXPORT_LDIF_FILE).
+
+import base64 # Import for binary and non-ASCII values in LDIF exports
+import os
+
+# Maximum length of an LDIF line, longer lines are folded
+LDIF_LINE_LENGTH = 76
+
+def is_ldif_safe_string(value):
+    """
+    Checks if a value can be written as a plain LDIF SAFE-STRING. Values with non-ASCII or control
+    characters, a leading space, colon or less-than sign or a trailing space must be base64-encoded.
+    """
+    if not value:
+        return True
+    if value[0] in b" :<" or value[-1:] == b" ":
+        return False
+    return all(0 < byte < 128 and byte not in (10, 13) for byte in value)
+
+def fold_ldif_line(line):
+    """Folds an LDIF line into lines of at most LDIF_LINE_LENGTH characters, continuation lines start with a space."""
+    parts = [line[:LDIF_LINE_LENGTH]]
+    for start in range(LDIF_LINE_LENGTH, len(line), LDIF_LINE_LENGTH - 1):
+        parts.append(" " + line[start:start + LDIF_LINE_LENGTH - 1])
+    return "\n".join(parts)
+
+def format_ldif_line(attr_name, value):
+    """Formats one attribute value (str or bytes) as a folded LDIF line, base64-encoded ('::') if necessary."""
+    value = value if isinstance(value, bytes) else str(value).encode('utf-8')
+    if is_ldif_safe_string(value):
+        return fold_ldif_line(f"{attr_name}: {value.decode('ascii')}")
+    return fold_ldif_line(f"{attr_name}:: {base64.b64encode(value).decode('ascii')}")
+
+def format_ldif_entry(ldap_dn, attributes):
+    """Formats an entry as an LDIF content record (without changetype, as expected by slapadd)."""
+    lines = [format_ldif_line("dn", ldap_dn)]
+    for attr_name, value in attributes.items():
+        for single_value in (value if isinstance(value, list) else [value]):
+            lines.append(format_ldif_line(attr_name, single_value))
+    return "\n".join(lines) + "\n\n"
+
+class LdifExport:
+    """
+    Streams entries to a temporary file, which replaces the target file once commit() is called.
+    An export that is discarded (or fails) leaves an existing target file untouched.
+    Raises OSError if the file cannot be written.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # LDIF is plain ASCII, everything else is base64-encoded by format_ldif_line(). The base DN is not written
+        # into the header comment, it may contain non-ASCII characters and is part of every dn line anyway.
+        self.file = open(self.tmp_path, "w", encoding="ascii", newline="\n")
+        self.file.write("# Contacts exported by carddav2ldap for slapadd\nversion: 1\n\n")
+
+    def write_entry(self, ldap_dn, attributes):
+        """Appends one entry to the export."""
+        self.file.write(format_ldif_entry(ldap_dn, attributes))
+
+    def commit(self):
+        """Completes the export and moves it to the target file."""
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        """Removes the incomplete export."""
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
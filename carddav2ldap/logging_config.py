@@ -0,0 +1,113 @@
+# carddav2ldap/logging_config.py
+# Log output of the synchronization: all modules log to the "carddav2ldap" logger hierarchy, configure_logging()
+# writes the records to stdout as "LEVEL: message" lines (or JSON lines with LOG_FORMAT=json).
+# Debug output is not flushed after every line, and repeated warnings are limited per cycle (LOG_WARNING_LIMIT).
+
+import json
+import logging
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# Logger all modules of the package log to
+PACKAGE_LOGGER = logging.getLogger("carddav2ldap")
+
+class StdoutHandler(logging.Handler):
+    """
+    Writes records to sys.stdout, looked up for every record so redirections of sys.stdout apply.
+    The stream is flushed right away for info, warning and error records (a few per address book and cycle),
+    debug records at most every flush_interval seconds, so a burst of them does not cost one write per line.
+    """
+    def __init__(self, flush_interval=1.0):
+        super().__init__()
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+            stream = sys.stdout
+            stream.write(line + "\n")
+            now = time.monotonic()
+            if record.levelno >= logging.INFO or now - self.last_flush >= self.flush_interval:
+                stream.flush()
+                self.last_flush = now
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            sys.stdout.flush()
+            self.last_flush = time.monotonic()
+
+class TextFormatter(logging.Formatter):
+    """Formats records as "LEVEL: message", the format the log lines of this project always had."""
+    def format(self, record):
+        line = f"{record.levelname}: {record.getMessage()}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, e.g. for log collectors (LOG_FORMAT=json)."""
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class WarningRateLimiter(logging.Filter):
+    """
+    Lets only the first limit warnings with the same message template (e.g. "Could not parse vCard blob from %s ...")
+    through per cycle and counts the others. report_suppressed() logs how many were left out and starts over.
+    A limit of 0 lets all warnings through.
+    """
+    def __init__(self, limit=0):
+        super().__init__()
+        self.limit = limit
+        self.counts = {} # Message template -> number of warnings in this cycle
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno != logging.WARNING or not self.limit:
+            return True
+        with self.lock:
+            count = self.counts.get(record.msg, 0) + 1
+            self.counts[record.msg] = count
+        return count <= self.limit
+
+    def report_suppressed(self):
+        """Logs a summary line for every message template that was suppressed in this cycle."""
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        for template, count in counts.items():
+            if count > self.limit:
+                PACKAGE_LOGGER.info("%d more warning(s) like '%s' were not logged (LOG_WARNING_LIMIT=%d).",
+                                    count - self.limit, template, self.limit)
+
+# Rate limiter of the handler installed by configure_logging()
+warning_rate_limiter = WarningRateLimiter()
+
+def configure_logging(config):
+    """Sends the log records of the package to stdout with the LOG_LEVEL, LOG_FORMAT and LOG_WARNING_LIMIT settings."""
+    handler = StdoutHandler()
+    handler.setFormatter(JsonFormatter() if config["log_format"] == "json" else TextFormatter())
+    warning_rate_limiter.limit = config["log_warning_limit"]
+    handler.addFilter(warning_rate_limiter)
+    for old_handler in list(PACKAGE_LOGGER.handlers):
+        PACKAGE_LOGGER.removeHandler(old_handler)
+    PACKAGE_LOGGER.addHandler(handler)
+    PACKAGE_LOGGER.setLevel(config["log_level"])
+    PACKAGE_LOGGER.propagate = False
+
+def end_log_cycle():
+    """Called at the end of every cycle: reports suppressed warnings and flushes the log output."""
+    warning_rate_limiter.report_suppressed()
+    for handler in PACKAGE_LOGGER.handlers:
+        handler.flush()
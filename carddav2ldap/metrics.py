@@ -0,0 +1,200 @@
+# carddav2ldap/metrics.py
+# Timers and counters of one synchronization cycle, written at the end of every cycle as a JSON report
+# (METRICS_JSON_FILE) and as a Prometheus textfile (METRICS_PROMETHEUS_FILE) for the node_exporter textfile collector.
+
+import bisect # Import for sorting latencies into histogram buckets
+import contextlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from .phonebook import write_file_atomically
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets (METRICS_HISTOGRAMS)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Stages of a cycle, in pipeline order
+STAGES = ("discovery", "ldap_connect", "fetch", "parse", "fetch_wait", "ldap_write", "stale_entries", "phonebook", "save_state")
+
+class SyncMetrics:
+    """
+    Timers and counters of one cycle. Stages nest (the LDAP writes pull contacts from the parser, which pulls
+    cards from the download), so the time of a stage does not include the stages running inside it. Fetch
+    workers and LDAP write workers record their time in their own threads, so with workers the stage times add
+    up to more than the duration of the cycle. Latencies are only recorded if histograms is set. Thread-safe.
+    """
+    def __init__(self, histograms=False):
+        self.started = time.time()
+        self.start_counter = time.perf_counter()
+        self.duration = None
+        self.succeeded = None
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        self.counters = {}
+        # Histogram name -> [count per bucket, count above the last bucket, sum of all values]
+        self.histograms = {} if histograms else None
+        self.lock = threading.Lock()
+        self.local = threading.local() # Stack of the stages running in each thread
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Adds the time spent in the with block, minus the time of stages nested in it, to a stage."""
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0) # Time of nested stages
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + elapsed - nested
+
+    def timed_iter(self, name, iterable):
+        """Yields the items of iterable, the time spent producing them is added to a stage."""
+        iterator = iter(iterable)
+        try:
+            while True:
+                with self.stage(name):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                yield item
+        finally:
+            # Closes generators that are not exhausted, e.g. the HTTP response of an aborted fetch
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    def add(self, name, value=1):
+        """Adds value to a counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_counts(self, prefix, counts):
+        """Adds a dict of counts (e.g. the import counts of apply_to_ldap()) to the counters <prefix>_<key>."""
+        with self.lock:
+            for key, value in counts.items():
+                self.counters[f"{prefix}_{key}"] = self.counters.get(f"{prefix}_{key}", 0) + value
+
+    def observe(self, name, seconds):
+        """Records one latency in a histogram. Does nothing if histograms are disabled."""
+        if self.histograms is None:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * len(LATENCY_BUCKETS), 0, 0.0]
+            position = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+            if position < len(LATENCY_BUCKETS):
+                histogram[0][position] += 1
+            else:
+                histogram[1] += 1
+            histogram[2] += seconds
+
+    def finish(self, succeeded):
+        """Records the outcome and duration of the cycle."""
+        self.succeeded = succeeded
+        self.duration = time.perf_counter() - self.start_counter
+
+    def report(self):
+        """Returns the metrics as a JSON-serializable dict."""
+        with self.lock:
+            report = {
+                "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                "finished": datetime.fromtimestamp(self.started + (self.duration or 0.0), timezone.utc).isoformat(),
+                "succeeded": self.succeeded,
+                "duration_seconds": round(self.duration or 0.0, 6),
+                "stage_seconds": {stage: round(seconds, 6) for stage, seconds in self.stage_seconds.items()},
+                "counters": dict(sorted(self.counters.items())),
+            }
+            if self.histograms is not None:
+                report["latency_histograms"] = {
+                    name: {"buckets": dict(zip((str(bound) for bound in LATENCY_BUCKETS), bucket_counts)),
+                           "above_last_bucket": above, "count": sum(bucket_counts) + above, "sum_seconds": round(total, 6)}
+                    for name, (bucket_counts, above, total) in sorted(self.histograms.items())
+                }
+        return report
+
+# --- Prometheus textfile ---
+# Metric families written from the counters: name, help text, label name, label value -> counter name.
+# A label name of None writes the counter without labels.
+PROMETHEUS_COUNTER_FAMILIES = [
+    ("carddav2ldap_sync_address_books", "Address books of the last cycle by outcome.", "outcome",
+     {"fetched": "books_fetched", "skipped": "books_skipped", "failed": "books_failed"}),
+    ("carddav2ldap_sync_carddav_bytes_received", "Bytes of CardDAV response bodies (decompressed) received in the last cycle.", None,
+     {None: "carddav_bytes_received"}),
+    ("carddav2ldap_sync_cards", "vCards of the last cycle by outcome (skipped by the contact filters, failed to parse).", "outcome",
+     {"parsed": "cards_parsed", "skipped": "cards_skipped", "failed": "cards_failed"}),
+    ("carddav2ldap_sync_ldap_entries", "LDAP entries of the last cycle by outcome.", "outcome",
+     {"added": "ldap_added", "updated": "ldap_updated", "renamed": "ldap_renamed", "unchanged": "ldap_unchanged",
+      "skipped": "ldap_skipped", "failed": "ldap_failed", "deleted": "ldap_deleted", "exported": "ldap_exported"}),
+    ("carddav2ldap_sync_photo_bytes_written", "Bytes of jpegPhoto values written to LDAP in the last cycle.", None,
+     {None: "photo_bytes_written"}),
+]
+
+# Help texts of the latency histograms
+HISTOGRAM_HELP = {
+    "carddav_request": "Time until the CardDAV server started to answer a PROPFIND/REPORT request.",
+    "ldap_add": "Duration of LDAP add operations.",
+    "ldap_modify": "Duration of LDAP modify operations.",
+    "ldap_modify_dn": "Duration of LDAP modify DN operations (renamed contacts).",
+    "ldap_delete": "Duration of LDAP delete operations (stale entries).",
+}
+
+def format_prometheus_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render_prometheus_textfile(report):
+    """Returns a report() dict in the Prometheus text exposition format."""
+    lines = []
+
+    def family(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            label_text = ",".join(f'{label}="{label_value}"' for label, label_value in labels)
+            lines.append(f"{name}{{{label_text}}} {format_prometheus_value(value)}" if label_text else f"{name} {format_prometheus_value(value)}")
+
+    finished = datetime.fromisoformat(report["finished"]).timestamp()
+    family("carddav2ldap_sync_last_run_timestamp_seconds", "gauge", "End of the last cycle (Unix time).", [((), round(finished, 3))])
+    family("carddav2ldap_sync_success", "gauge", "1 if the last cycle succeeded, 0 if it was aborted.", [((), 1 if report["succeeded"] else 0)])
+    family("carddav2ldap_sync_duration_seconds", "gauge", "Duration of the last cycle.", [((), report["duration_seconds"])])
+    family("carddav2ldap_sync_stage_seconds", "gauge", "Time spent in each stage of the last cycle, summed over all threads.",
+           [((("stage", stage),), seconds) for stage, seconds in report["stage_seconds"].items()])
+    counters = report["counters"]
+    for name, help_text, label, counter_names in PROMETHEUS_COUNTER_FAMILIES:
+        family(name, "gauge", help_text,
+               [(((label, label_value),) if label else (), counters.get(counter_name, 0)) for label_value, counter_name in counter_names.items()])
+    for name, histogram in report.get("latency_histograms", {}).items():
+        metric_name = f"carddav2ldap_sync_{name}_seconds"
+        lines.append(f"# HELP {metric_name} {HISTOGRAM_HELP.get(name, 'Latency of ' + name + '.')} Last cycle.")
+        lines.append(f"# TYPE {metric_name} histogram")
+        cumulative = 0
+        for bound, count in histogram["buckets"].items():
+            cumulative += count
+            lines.append(f'{metric_name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{metric_name}_bucket{{le="+Inf"}} {histogram["count"]}')
+        lines.append(f"{metric_name}_sum {histogram['sum_seconds']!r}")
+        lines.append(f"{metric_name}_count {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+def write_metrics_reports(metrics, config):
+    """Writes the JSON report and the Prometheus textfile of a finished cycle, if they are configured."""
+    if not config["metrics_json_file"] and not config["metrics_prometheus_file"]:
+        return
+    report = metrics.report()
+    # Written atomically, so the textfile collector never reads a partial file
+    for path, render in ((config["metrics_json_file"], lambda: json.dumps(report, indent=2) + "\n"),
+                         (config["metrics_prometheus_file"], lambda: render_prometheus_textfile(report))):
+        if not path:
+            continue
+        try:
+            write_file_atomically(path, render().encode("utf-8"))
+        except OSError as e:
+            logger.warning("Could not write metrics file '%s': %s", path, e)
@@ -0,0 +1,37 @@
+# carddav2ldap/phone_numbers.py
+# Normalizes phone numbers to E.164 (+<country code><number>), so that "+49 30 1234", "004930 1234" and
+# "030 1234" are stored as the same telephoneNumber and match the caller ID of incoming calls.
+
+import re
+
+PHONE_NUMBER_CLEAN_RE = re.compile(r'[^0-9+]')
+# "+49 (0)30 1234": the trunk prefix in parentheses is not dialled after the country code
+PHONE_NUMBER_TRUNK_IN_PARENTHESES_RE = re.compile(r'\(\s*0\s*\)')
+
+def normalize_phone_number(raw_phone, phone_options=None):
+    """
+    Returns the normalized form of a phone number, or "" if it contains no digits.
+    Without phone_options, only characters other than digits and '+' are removed. With phone_options
+    ({"country_code", "trunk_prefix", "international_prefix"}, see build_phone_options()), national numbers
+    (starting with the trunk prefix) and numbers with the international prefix are converted to E.164.
+    Numbers without either prefix (local numbers without area code, service numbers) are only cleaned.
+    """
+    if phone_options is None:
+        cleaned_phone = PHONE_NUMBER_CLEAN_RE.sub('', raw_phone).strip()
+        return '' if cleaned_phone == '+' else cleaned_phone
+    cleaned_phone = PHONE_NUMBER_CLEAN_RE.sub('', PHONE_NUMBER_TRUNK_IN_PARENTHESES_RE.sub('', raw_phone))
+    digits = cleaned_phone.replace('+', '')
+    if not digits:
+        return ''
+    if cleaned_phone.startswith('+'):
+        return '+' + digits
+    international_prefix = phone_options["international_prefix"]
+    if international_prefix and digits.startswith(international_prefix):
+        return '+' + digits[len(international_prefix):] if len(digits) > len(international_prefix) else digits
+    trunk_prefix = phone_options["trunk_prefix"]
+    if not trunk_prefix:
+        # Countries without trunk prefix dial the full national number everywhere
+        return '+' + phone_options["country_code"] + digits
+    if digits.startswith(trunk_prefix) and len(digits) > len(trunk_prefix):
+        return '+' + phone_options["country_code"] + digits[len(trunk_prefix):]
+    return digits
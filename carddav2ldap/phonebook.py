@@ -0,0 +1,154 @@
+# carddav2ldap/phonebook.py
+# Phonebook XML files for desk phones (PHONEBOOK_EXPORT_DIR), served by the nginx "web" service.
+# Phones load one static file instead of searching LDAP on every keypress of the directory.
+
+import gzip # Import for the precompressed copies served with gzip_static
+import hashlib
+import logging
+import os
+import xml.etree.ElementTree as ET # Import for building the XML documents
+import ldap3
+
+logger = logging.getLogger(__name__)
+
+# Attributes of the LDAP entries used for the phonebooks
+PHONEBOOK_LDAP_ATTRIBUTES = ['cn', 'telephoneNumber', 'facsimileTelephoneNumber']
+
+def phonebook_entry(names, phones, faxes):
+    """
+    Returns the phonebook entry for the raw cn, telephoneNumber and facsimileTelephoneNumber values of an
+    LDAP entry, or None if it has no name or no phone number.
+    """
+    if not names or not (phones or faxes):
+        return None
+    return {"name": names[0].decode('utf-8'), "phones": sorted(v.decode('utf-8') for v in phones),
+            "faxes": sorted(v.decode('utf-8') for v in faxes)}
+
+def sort_phonebook_entries(entries):
+    """Sorts the entries by name, so the files only change when the phonebook does. Returns the list."""
+    entries.sort(key=lambda e: (e["name"].casefold(), e["name"], e["phones"], e["faxes"]))
+    return entries
+
+def read_phonebook_entries(directory):
+    """
+    Reads the name and phone numbers of all entries below LDAP_BASE_DN with one paged search, so the phonebooks
+    also contain the contacts a (incremental) run did not fetch. Returns a list of dicts sorted by name,
+    entries without phone numbers are left out.
+    """
+    entries = []
+    for entry in directory.conn.extend.standard.paged_search(directory.base_dn, '(objectClass=inetOrgPerson)',
+                                                             search_scope=ldap3.LEVEL, attributes=PHONEBOOK_LDAP_ATTRIBUTES,
+                                                             paged_size=directory.config["ldap_page_size"], generator=True):
+        if entry.get('type') != 'searchResEntry':
+            continue
+        raw_attributes = {name.lower(): values for name, values in entry['raw_attributes'].items()}
+        phonebook_entry_data = phonebook_entry(raw_attributes.get('cn', []), raw_attributes.get('telephonenumber', []),
+                                               raw_attributes.get('facsimiletelephonenumber', []))
+        if phonebook_entry_data is not None:
+            entries.append(phonebook_entry_data)
+    return sort_phonebook_entries(entries)
+
+def index_phonebook_entries(directory):
+    """
+    Returns the same entries as read_phonebook_entries(), built from the index of the existing entries
+    (LdapDirectory.ldap_index) instead of a second search. The index is only complete if every write of the
+    cycle succeeded, an entry whose write failed may be missing from it.
+    """
+    entries = []
+    for indexed_attributes in directory.ldap_index.values():
+        # The index holds sets, the smallest name stands in for the first one returned by the server
+        phonebook_entry_data = phonebook_entry(sorted(indexed_attributes.get('cn', ())), indexed_attributes.get('telephoneNumber', ()),
+                                               indexed_attributes.get('facsimileTelephoneNumber', ()))
+        if phonebook_entry_data is not None:
+            entries.append(phonebook_entry_data)
+    return sort_phonebook_entries(entries)
+
+# --- Phonebook formats ---
+def render_yealink(entries, title):
+    """Yealink remote phonebook: one DirectoryEntry per contact with all of its numbers."""
+    root = ET.Element("YealinkIPPhoneDirectory")
+    ET.SubElement(root, "Title").text = title
+    for entry in entries:
+        directory_entry = ET.SubElement(root, "DirectoryEntry")
+        ET.SubElement(directory_entry, "Name").text = entry["name"]
+        for number in entry["phones"] + entry["faxes"]:
+            ET.SubElement(directory_entry, "Telephone").text = number
+    return root
+
+def render_snom(entries, title):
+    """Snom IP phone directory: one DirectoryEntry per number, faxes are left out."""
+    root = ET.Element("SnomIPPhoneDirectory")
+    ET.SubElement(root, "Title").text = title
+    for entry in entries:
+        for number in entry["phones"]:
+            directory_entry = ET.SubElement(root, "DirectoryEntry")
+            ET.SubElement(directory_entry, "Name").text = entry["name"]
+            ET.SubElement(directory_entry, "Telephone").text = number
+    return root
+
+def render_fritzbox(entries, title):
+    """Fritz!Box phonebook (import format of the Fritz!Box web interface and phonebook URLs)."""
+    root = ET.Element("phonebooks")
+    phonebook = ET.SubElement(root, "phonebook", name=title)
+    for entry in entries:
+        contact = ET.SubElement(phonebook, "contact")
+        ET.SubElement(contact, "category").text = "0"
+        ET.SubElement(ET.SubElement(contact, "person"), "realName").text = entry["name"]
+        telephony = ET.SubElement(contact, "telephony")
+        numbers = [("work", number) for number in entry["phones"]] + [("fax_work", number) for number in entry["faxes"]]
+        for prio, (number_type, number) in enumerate(numbers):
+            ET.SubElement(telephony, "number", type=number_type, prio="1" if prio == 0 else "0").text = number
+    return root
+
+# Format name -> (file name, render function)
+PHONEBOOK_FORMATS = {
+    "yealink": ("phonebook_yealink.xml", render_yealink),
+    "snom": ("phonebook_snom.xml", render_snom),
+    "fritzbox": ("phonebook_fritzbox.xml", render_fritzbox),
+}
+
+# --- Writing the files ---
+def file_digest(path):
+    """Returns the SHA-256 digest of a file, or None if it cannot be read."""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).digest()
+    except OSError:
+        return None
+
+def write_file_atomically(path, data):
+    """Writes data to a temporary file next to path and renames it, so the web server never serves a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def write_phonebook_file(path, data):
+    """
+    Writes a phonebook file and its precompressed .gz copy, unless the file already has this content.
+    Returns True if the file was written. Raises OSError if it cannot be written.
+    """
+    gz_path = f"{path}.gz"
+    if file_digest(path) == hashlib.sha256(data).digest() and os.path.exists(gz_path):
+        return False
+    # mtime=0 keeps the .gz identical for identical content
+    write_file_atomically(gz_path, gzip.compress(data, compresslevel=9, mtime=0))
+    write_file_atomically(path, data)
+    return True
+
+def export_phonebooks(entries, config):
+    """Writes the phonebooks of all PHONEBOOK_FORMATS with the read_phonebook_entries() entries to PHONEBOOK_EXPORT_DIR."""
+    export_dir = config["phonebook_export_dir"]
+    try:
+        os.makedirs(export_dir, exist_ok=True)
+        for format_name in config["phonebook_formats"]:
+            file_name, render = PHONEBOOK_FORMATS[format_name]
+            root = render(entries, config["phonebook_title"])
+            ET.indent(root)
+            data = ET.tostring(root, encoding="utf-8", xml_declaration=True) + b"\n"
+            if write_phonebook_file(os.path.join(export_dir, file_name), data):
+                logger.info("Wrote phonebook %s with %d contacts.", file_name, len(entries))
+            else:
+                logger.debug("Phonebook %s is unchanged.", file_name)
+    except OSError as e:
+        logger.warning("Could not write phonebooks to '%s': %s", export_dir, e)
@@ -0,0 +1,110 @@
+# carddav2ldap/photo_normalizer.py
+# Converts contact photos to small JPEGs for the jpegPhoto attribute. Used by vcard_parser.py.
+# Phones store PHOTO as multi-megabyte JPEG, PNG or HEIC images. Every client search that returns photos
+# transfers them, so they are recompressed to at most max_dimension pixels and max_bytes bytes.
+# Results are cached on disk by the SHA-256 of the source bytes, so unchanged photos are only converted once.
+
+import hashlib # Import for the cache key of a source photo
+import io
+import os
+import threading # Import for unique temporary file names of parallel fetch workers
+
+# Pillow is only required if CARDDAV_NORMALIZE_PHOTOS is enabled
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+# HEIC/HEIF photos (iPhone) can only be read if pillow-heif is installed
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+except ImportError:
+    pass
+
+# JPEG qualities tried one after another until the photo fits into max_bytes
+PHOTO_JPEG_QUALITIES = (85, 75, 65, 55, 45)
+# Factor the dimensions are reduced by when even the lowest quality is too large
+PHOTO_DOWNSCALE_FACTOR = 0.75
+# Photos are never made smaller than this (in pixels), the result may then exceed max_bytes
+PHOTO_MIN_DIMENSION = 32
+
+def is_pillow_available():
+    """Returns True if Pillow is installed."""
+    return Image is not None
+
+def photo_cache_path(photo_bytes, photo_options):
+    """
+    Returns the cache file for a source photo, or None if caching is disabled.
+    The limits are part of the file name, so changing them converts all photos again.
+    """
+    if not photo_options["cache_dir"]:
+        return None
+    digest = hashlib.sha256(photo_bytes).hexdigest()
+    return os.path.join(photo_options["cache_dir"], f"{digest}-{photo_options['max_dimension']}-{photo_options['max_bytes']}.jpg")
+
+def encode_jpeg(image, quality):
+    """Encodes an RGB image as JPEG and returns the bytes."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+def convert_photo(photo_bytes, photo_options):
+    """
+    Converts a photo to a JPEG of at most max_dimension x max_dimension pixels and, if possible, max_bytes bytes.
+    JPEGs that are already within both limits are returned unchanged.
+    Raises an exception (e.g. PIL.UnidentifiedImageError) if the photo cannot be read.
+    """
+    max_dimension = photo_options["max_dimension"]
+    max_bytes = photo_options["max_bytes"]
+    with Image.open(io.BytesIO(photo_bytes)) as image:
+        if image.format == "JPEG" and max(image.size) <= max_dimension and len(photo_bytes) <= max_bytes:
+            return photo_bytes
+        # Large JPEGs are decoded at a reduced scale right away, which is much faster than decoding all pixels
+        image.draft("RGB", (max_dimension, max_dimension))
+        # Apply the EXIF orientation, the EXIF data itself is not kept
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            # JPEG has no transparency, put transparent photos on a white background
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+        while True:
+            for quality in PHOTO_JPEG_QUALITIES:
+                jpeg_bytes = encode_jpeg(image, quality)
+                if len(jpeg_bytes) <= max_bytes:
+                    return jpeg_bytes
+            new_size = (int(image.width * PHOTO_DOWNSCALE_FACTOR), int(image.height * PHOTO_DOWNSCALE_FACTOR))
+            if min(new_size) < PHOTO_MIN_DIMENSION:
+                return jpeg_bytes # Smallest result at the lowest quality
+            image = image.resize(new_size, Image.LANCZOS)
+
+def normalize_photo(photo_bytes, photo_options):
+    """
+    Returns the normalized JPEG of a photo, taken from the cache if the same photo was converted before.
+    Raises an exception if the photo cannot be read. Errors writing the cache are ignored.
+    """
+    cache_path = photo_cache_path(photo_bytes, photo_options)
+    if cache_path is not None:
+        try:
+            with open(cache_path, "rb") as f:
+                return f.read()
+        except OSError:
+            pass # Not converted yet
+    jpeg_bytes = convert_photo(photo_bytes, photo_options)
+    # Photos returned unchanged are not cached, checking them again only reads the image header
+    if cache_path is not None and jpeg_bytes is not photo_bytes:
+        # Workers may convert the same photo at the same time, write atomically under a unique name
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(photo_options["cache_dir"], exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(jpeg_bytes)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass # The photo is converted again on the next run
+    return jpeg_bytes
@@ -0,0 +1,452 @@
+# carddav2ldap/sync.py
+# One synchronization cycle: discover_addressbooks() -> fetch_cards() -> parse_card() -> filter_contact()
+# -> build_ldap_entry() -> apply_to_ldap(). The stages are generators that stream into each other, so contacts
+# are written to LDAP while the address books are still being downloaded.
+
+import fcntl # Import for the lock file preventing overlapping runs
+import logging
+import multiprocessing # Import for selecting the start method of the parse worker processes
+import os
+import queue # Import for the bounded queues between fetch workers and LDAP writes
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor # Import for fetching and parsing in parallel
+from concurrent.futures.process import BrokenProcessPool # Raised by every parse after a worker process died
+from .config import build_parse_options, build_phone_options
+from .carddav import create_carddav_session, discover_addressbooks, fetch_cards
+from .vcard_parser import parse_cards, parse_card_chunk
+from .ldap_directory import LdapDirectory, apply_to_ldap
+from .ldif import LdifExport
+from .phonebook import read_phonebook_entries, index_phonebook_entries, export_phonebooks
+from .caller_id import CallerIdIndex
+from .metrics import SyncMetrics, write_metrics_reports
+from .logging_config import end_log_cycle
+from .sync_state import load_sync_state, save_sync_state, empty_sync_state, is_address_book_unchanged, has_card_dns
+
+logger = logging.getLogger(__name__)
+
+class FetchAborted(Exception):
+    """Raised in a fetch worker when the cycle it is fetching for has ended."""
+
+class Synchronizer:
+    """
+    Runs synchronization cycles with the settings of a config dict (see load_config()).
+    The CardDAV HTTP session, the parse worker processes and the sync state are kept between cycles,
+    the LDAP connections too if keep_connections is set (daemon mode). If caller_id is set, caller_id_index
+    is rebuilt after every cycle for the caller ID lookup endpoint. metrics holds the SyncMetrics of the
+    current (or last) cycle. Call close() when done.
+    """
+    def __init__(self, config, keep_connections=False, caller_id=False):
+        self.config = config
+        self.keep_connections = keep_connections
+        self.caller_id = caller_id
+        self.caller_id_index = None # CallerIdIndex of the last cycle, replaced as a whole
+        self.metrics = None
+        self.session = create_carddav_session(config)
+        self.parse_options = build_parse_options(config)
+        self.parse_executor = create_parse_executor(config["parse_workers"])
+        self.directory = LdapDirectory(config)
+        self.sync_state = load_sync_state(config["sync_state_file"]) if config["use_sync_state"] else empty_sync_state()
+
+    def close(self):
+        """Closes the LDAP connections and stops the parse worker processes."""
+        self.directory.close()
+        if self.parse_executor is not None:
+            self.parse_executor.shutdown()
+
+    # --- 2. Fetch, parse and filter the contacts of one address book ---
+    def should_skip_address_book(self, book, requested_book_urls, log):
+        """Returns True if an address book is not fetched in this cycle (not requested, or unchanged)."""
+        book_url = book["url"]
+        # Triggered cycles only process the requested address books, the others keep their entries
+        if requested_book_urls is not None and book_url not in requested_book_urls:
+            log(logging.DEBUG, "Address book %s was not requested by the sync trigger. Skipping.", book_url)
+            return True
+        book_state = self.sync_state["books"].get(book_url, {})
+        # Stale-entry removal needs to know the DNs of the contacts of a skipped address book
+        can_skip = self.config["ldap_stale_entries"] == "keep" or has_card_dns(book_state)
+        if self.config["skip_unchanged_books"] and can_skip and is_address_book_unchanged(book, book_state):
+            log(logging.INFO, "Address book %s is unchanged since the last run (CTag/sync-token). Skipping.", book_url)
+            return True
+        return False
+
+    def iter_address_book_contacts(self, book, fetch_result, log):
+        """
+        Yields the parsed contacts of an address book that pass the contact filters. Messages are passed to
+        log(level, msg, *args). fetch_result["new_book_state"] is set once the generator is exhausted, see fetch_cards().
+        """
+        metrics = self.metrics
+        book_state = self.sync_state["books"].get(book["url"], {})
+        cards = metrics.timed_iter("fetch", fetch_cards(self.session, self.config, book, book_state, fetch_result, log))
+        parse_counts = {"parsed": 0, "skipped": 0, "failed": 0}
+        failed_hrefs = []
+        parsed_cards = parse_cards(cards, book["url"], self.parse_options, self.parse_executor,
+                                   self.config["parse_chunk_size"], 2 * self.config["parse_workers"], parse_counts, failed_hrefs)
+        try:
+            for href, contact_data, messages in metrics.timed_iter("parse", parsed_cards):
+                for level, msg, args in messages:
+                    log(level, msg, *args)
+                # The Whitelist/Blacklist filters for individual contacts are applied while parsing (parse_options["filters"])
+                if contact_data is None:
+                    continue # Skip this problematic or filtered vCard and continue with others
+                yield contact_data
+            if failed_hrefs and fetch_result["new_book_state"] is not None:
+                keep_failed_card_dns(fetch_result["new_book_state"], book_state, failed_hrefs)
+            # One summary line per address book instead of one line per contact
+            log(logging.INFO, "%d contact(s) parsed, %d skipped by the contact filters and %d failed in %s.",
+                parse_counts["parsed"], parse_counts["skipped"], parse_counts["failed"], book["url"])
+        finally:
+            metrics.add_counts("cards", parse_counts)
+            for transfer in fetch_result.get("transfers", []):
+                metrics.add("carddav_bytes_received", transfer.bytes_received)
+                metrics.observe("carddav_request", transfer.response.elapsed.total_seconds())
+
+    def stream_address_book(self, book, requested_book_urls, book_queue, stop_event):
+        """
+        Fetches, parses and filters one address book in a worker thread (CARDDAV_FETCH_WORKERS > 1).
+        Log messages ("log", (level, msg, args)) and contacts ("contact", contact) are put into the bounded book_queue, which pauses
+        the worker while the queue is full. The last item is ("done", new_book_state), ("skipped", None) or
+        ("error", exception). Stops early if stop_event is set.
+        """
+        def put(item):
+            while not stop_event.is_set():
+                try:
+                    book_queue.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+            raise FetchAborted()
+
+        def log(level, msg, *args):
+            # Messages below the log level are dropped here instead of being queued
+            if logger.isEnabledFor(level):
+                put(("log", (level, msg, args)))
+
+        if stop_event.is_set():
+            return
+        try:
+            if self.should_skip_address_book(book, requested_book_urls, log):
+                put(("skipped", None))
+                return
+            fetch_result = {}
+            for contact in self.iter_address_book_contacts(book, fetch_result, log):
+                put(("contact", contact))
+            put(("done", fetch_result["new_book_state"]))
+        except FetchAborted:
+            pass
+        except Exception as e:
+            try:
+                put(("error", e))
+            except FetchAborted:
+                pass
+
+    def iter_contacts(self, address_books, requested_book_urls, cycle):
+        """
+        Yields the contacts of all address books, in discovery order. Records skipped and failed address books
+        and the new sync state of every completely fetched one in cycle.
+        """
+        def finish_address_book(book_url, new_book_state):
+            if new_book_state is None:
+                cycle["failed_fetch_book_urls"].add(book_url)
+            else:
+                cycle["pending_book_states"][book_url] = new_book_state
+
+        if self.config["fetch_workers"] == 1:
+            # Contacts are handed on while the address book is streamed from the server
+            for book in address_books:
+                if self.should_skip_address_book(book, requested_book_urls, logger.log):
+                    cycle["skipped_book_urls"].add(book["url"])
+                    continue
+                fetch_result = {}
+                for contact in self.iter_address_book_contacts(book, fetch_result, logger.log):
+                    cycle["contact_count"] += 1
+                    yield contact
+                finish_address_book(book["url"], fetch_result["new_book_state"])
+            return
+
+        # Address books are fetched in parallel and handed on in discovery order. Every address book has a
+        # bounded queue, so workers ahead of the LDAP writes only buffer a few contacts each.
+        book_queues = [queue.Queue(maxsize=self.config["fetch_queue_size"]) for _ in address_books]
+        stop_event = threading.Event()
+        with ThreadPoolExecutor(max_workers=self.config["fetch_workers"]) as fetch_executor:
+            try:
+                for book, book_queue in zip(address_books, book_queues):
+                    fetch_executor.submit(self.stream_address_book, book, requested_book_urls, book_queue, stop_event)
+                for book, book_queue in zip(address_books, book_queues):
+                    while True:
+                        # Time the LDAP writes wait for the fetch workers
+                        with self.metrics.stage("fetch_wait"):
+                            kind, value = book_queue.get()
+                        if kind == "log":
+                            level, msg, args = value
+                            logger.log(level, msg, *args)
+                        elif kind == "contact":
+                            cycle["contact_count"] += 1
+                            yield value
+                        else:
+                            break
+                    if kind == "error":
+                        raise value
+                    if kind == "skipped":
+                        cycle["skipped_book_urls"].add(book["url"])
+                        continue
+                    finish_address_book(book["url"], value)
+            finally:
+                # Stops the workers if the import ends early, e.g. because of an error
+                stop_event.set()
+
+    # --- Stale entry helpers ---
+    def find_stale_dns(self, address_books, cycle, produced_dns):
+        """
+        Returns the lowercased DNs of existing entries that were not produced by this run, or None if
+        that cannot be decided safely. Contacts that were not fetched in this run (unchanged contacts in
+        incremental fetch modes, skipped address books) are kept through the DNs saved in the sync state.
+        """
+        if cycle["failed_fetch_book_urls"]:
+            logger.warning("Skipping removal of stale entries because %d address book(s) could not be fetched.", len(cycle["failed_fetch_book_urls"]))
+            return None
+        kept_dns = set(produced_dns)
+        for book in address_books:
+            book_url = book["url"]
+            if book_url in cycle["skipped_book_urls"]:
+                book_state = self.sync_state["books"].get(book_url, {})
+            else:
+                book_state = cycle["pending_book_states"].get(book_url, {})
+            if not has_card_dns(book_state):
+                logger.warning("Skipping removal of stale entries because the DNs of %s are not known.", book_url)
+                return None
+            kept_dns.update(card["dn"].lower() for card in book_state["cards"].values() if card["dn"])
+        return [dn for dn in self.directory.existing_dns if dn not in kept_dns]
+
+    # --- Synchronization cycle ---
+    def run_cycle(self, book_names=None):
+        """
+        Runs one synchronization: discovers the address books, streams their contacts into LDAP (or an LDIF
+        export), removes stale entries and saves the sync state. The metrics of the cycle are written afterwards
+        (METRICS_JSON_FILE, METRICS_PROMETHEUS_FILE), also if the cycle failed, and the log output is flushed.
+        If book_names is given (a triggered cycle), only the address books with these names are processed.
+        Returns False if the cycle was aborted because of an error.
+        """
+        self.metrics = SyncMetrics(histograms=self.config["metrics_histograms"])
+        succeeded = False
+        try:
+            succeeded = self.run_cycle_stages(book_names, self.metrics)
+        except BrokenProcessPool as e:
+            # A crashed worker breaks the whole pool, start new workers so the next cycle can parse again
+            logger.error("A parse worker process terminated abruptly: %s. Restarting the parse workers.", e)
+            self.parse_executor.shutdown(wait=False, cancel_futures=True)
+            self.parse_executor = create_parse_executor(self.config["parse_workers"])
+        finally:
+            self.metrics.finish(succeeded)
+            write_metrics_reports(self.metrics, self.config)
+            end_log_cycle()
+        return succeeded
+
+    def run_cycle_stages(self, book_names, metrics):
+        """The stages of run_cycle(), timed in metrics."""
+        config = self.config
+        ldif_path = config["ldap_export_ldif_file"]
+
+        # --- 1. Discover all address book URLs from CardDAV server ---
+        with metrics.stage("discovery"):
+            address_books = discover_addressbooks(self.session, config)
+        if address_books is None:
+            return False
+
+        # Address books processed in this cycle, None processes all of them
+        requested_book_urls = None
+        if book_names is not None:
+            # Address books are requested by the name the filters use or by the last segment of their URL
+            requested_book_urls = set()
+            for book_name in sorted(book_names):
+                matching_urls = [book["url"] for book in address_books
+                                 if book_name.lower() in (book["name"].lower(), book["url"].rstrip("/").split("/")[-1].lower())]
+                if not matching_urls:
+                    logger.warning("Requested address book '%s' was not found or is excluded by the address book filters.", book_name)
+                requested_book_urls.update(matching_urls)
+            logger.info("Triggered synchronization of %d of %d address book(s).", len(requested_book_urls), len(address_books))
+
+        # --- 2. Connect to LDAP Server (or open the LDIF export) ---
+        # Read the existing entries once, so add, modify or no-op can be decided locally for every contact.
+        # An LDIF export describes an empty directory, so every entry is exported as it would be added.
+        ldif_export = None
+        if ldif_path:
+            logger.info("LDAP_EXPORT_LDIF_FILE is set. Writing entries to %s instead of connecting to LDAP.", ldif_path)
+            try:
+                ldif_export = LdifExport(ldif_path)
+            except OSError as e:
+                logger.error("Could not write LDIF file '%s.tmp': %s", ldif_path, e)
+                return False
+            logger.info("Exporting contacts to LDIF...")
+        else:
+            with metrics.stage("ldap_connect"):
+                if not self.directory.connect():
+                    return False
+                try:
+                    self.directory.load_index()
+                except Exception as e:
+                    logger.error("Failed to read existing entries below %s: %s", config["ldap_base_dn"], e)
+                    self.directory.close()
+                    return False
+            logger.info("Found %d existing entries in LDAP. Importing contacts into LDAP...", len(self.directory.ldap_index))
+
+        # --- 3. Stream the contacts of all address books into LDAP ---
+        cycle = {
+            # Sync state that will be written after a successful LDAP import, keyed by address book URL
+            "pending_book_states": {},
+            # Address books that could not be fetched completely in this run
+            "failed_fetch_book_urls": set(),
+            # Address books skipped because they did not change since the last run (or were not requested)
+            "skipped_book_urls": set(),
+            "contact_count": 0,
+        }
+        contacts = self.iter_contacts(address_books, requested_book_urls, cycle)
+        try:
+            with metrics.stage("ldap_write"):
+                import_result = apply_to_ldap(contacts, self.directory, config, self.sync_state["books"], ldif_export, metrics)
+        except OSError as e:
+            if ldif_export is None:
+                raise
+            logger.error("Could not write LDIF file '%s': %s", ldif_path, e)
+            ldif_export.discard()
+            return False
+        import_counts = import_result["counts"]
+        metrics.add_counts("ldap", import_counts)
+        metrics.add("books_fetched", len(cycle["pending_book_states"]))
+        metrics.add("books_skipped", len(cycle["skipped_book_urls"]))
+        metrics.add("books_failed", len(cycle["failed_fetch_book_urls"]))
+        logger.info("Parsed %d contact(s) from all address books (%d skipped by the contact filters, %d failed).",
+                    cycle["contact_count"], metrics.counters.get("cards_skipped", 0), metrics.counters.get("cards_failed", 0))
+
+        if ldif_export is not None:
+            if cycle["failed_fetch_book_urls"]:
+                logger.error("Not exporting an LDIF file because %d address book(s) could not be fetched.", len(cycle["failed_fetch_book_urls"]))
+                ldif_export.discard()
+                return False
+            try:
+                ldif_export.commit()
+            except OSError as e:
+                logger.error("Could not write LDIF file '%s': %s", ldif_path, e)
+                return False
+            logger.info("Exported %d entries to %s. LDIF export completed.", import_counts["exported"], ldif_path)
+            return True
+
+        logger.info("LDAP import finished: %d added, %d updated, %d renamed, %d unchanged, %d failed.", import_counts["added"],
+                    import_counts["updated"], import_counts["renamed"], import_counts["unchanged"], import_counts["failed"])
+        if config["skip_unchanged_contacts"]:
+            logger.info("%d unchanged contact(s) skipped by content hash.", import_counts["skipped"])
+
+        # --- 4. Remove stale entries (mark and sweep) ---
+        # Triggered cycles leave this to the next full cycle, which knows the current contents of every address book
+        if config["ldap_stale_entries"] != "keep" and requested_book_urls is not None:
+            logger.info("Skipping removal of stale entries in a triggered synchronization.")
+        elif config["ldap_stale_entries"] != "keep":
+            with metrics.stage("stale_entries"):
+                stale_dns = self.find_stale_dns(address_books, cycle, import_result["produced_dns"])
+                if stale_dns is not None:
+                    metrics.add("ldap_deleted", self.directory.remove_stale_entries(stale_dns, metrics))
+
+        # --- 5. Phonebooks for desk phones and the caller ID index, from the entries now in LDAP ---
+        # The index of the existing entries was kept up to date by the writes and deletions of this cycle,
+        # LDAP is only searched again if a write failed and the index may be incomplete.
+        build_caller_id_index = self.caller_id and config["callerid_lookup_port"]
+        if config["phonebook_export_dir"] or build_caller_id_index:
+            with metrics.stage("phonebook"):
+                try:
+                    if import_counts["failed"]:
+                        phonebook_entries = read_phonebook_entries(self.directory)
+                    else:
+                        phonebook_entries = index_phonebook_entries(self.directory)
+                except Exception as e:
+                    logger.warning("Could not read the LDAP entries for the phonebooks and the caller ID index: %s. Keeping the previous ones.", e)
+                else:
+                    if config["phonebook_export_dir"]:
+                        export_phonebooks(phonebook_entries, config)
+                    if build_caller_id_index:
+                        self.caller_id_index = CallerIdIndex(phonebook_entries, build_phone_options(config), config["callerid_min_suffix_digits"])
+                        logger.info("Caller ID index holds %d phone numbers.", len(self.caller_id_index))
+
+        # --- 6. Disconnect from LDAP ---
+        # The daemon keeps the connections open for the next cycle
+        if not self.keep_connections:
+            self.directory.close()
+            logger.info("Disconnected from LDAP server.")
+
+        # --- 7. Persist sync state for the next run ---
+        if config["use_sync_state"]:
+            pending_book_states = cycle["pending_book_states"]
+            for (book_url, href), card_update in import_result["card_updates"].items():
+                card_state = pending_book_states.get(book_url, {}).get("cards", {}).get(href)
+                if card_state is not None:
+                    card_state.update(card_update)
+            for book_url, book_state in pending_book_states.items():
+                if book_url in import_result["failed_book_urls"]:
+                    logger.warning("Not advancing sync state for %s because some contacts failed to import.", book_url)
+                    continue
+                self.sync_state["books"][book_url] = book_state
+            with metrics.stage("save_state"):
+                save_sync_state(config["sync_state_file"], self.sync_state)
+        logger.info("Synchronization process completed.")
+        return True
+
+    def run_locked_cycle(self, book_names=None):
+        """Runs one synchronization cycle while holding the lock. Returns False if the cycle failed."""
+        lock_file = acquire_sync_lock(self.config["sync_lock_file"])
+        if lock_file is None:
+            logger.warning("Another synchronization is still running (lock file '%s'). Skipping this run.", self.config["sync_lock_file"])
+            return True
+        try:
+            return self.run_cycle(book_names)
+        finally:
+            if lock_file:
+                lock_file.close() # Closing the file releases the lock
+
+def keep_failed_card_dns(new_book_state, book_state, failed_hrefs):
+    """
+    Carries the DNs of cards that could not be parsed over from the previous state of their address book, so a
+    malformed card does not get its LDAP entry removed as stale. Only contacts skipped by the filters lose their DN.
+    The ETag is not kept, so the card is fetched and parsed again on the next run.
+    """
+    previous_cards = book_state.get("cards", {})
+    cards = new_book_state.get("cards", {})
+    for href in failed_hrefs:
+        previous_dn = previous_cards.get(href, {}).get("dn")
+        if previous_dn and href in cards:
+            cards[href] = {"etag": None, "dn": previous_dn}
+
+# --- Parse worker processes ---
+def create_parse_executor(parse_workers):
+    """
+    Returns the process pool parsing vCards (CARDDAV_PARSE_WORKERS), or None for a single worker.
+    The workers are started lazily, when the fetch threads and the HTTP endpoints of the daemon may already be
+    running. Forking a process with threads can leave locks held by those threads locked forever in the child,
+    so the workers are started by a fork server (or spawned), which has no other threads.
+    """
+    if parse_workers <= 1:
+        return None
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        # The fork server imports the parser once, every worker forked from it starts with it imported
+        context.set_forkserver_preload([parse_card_chunk.__module__])
+    else:
+        context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=parse_workers, mp_context=context)
+
+# --- Lock against overlapping runs ---
+def acquire_sync_lock(lock_path):
+    """
+    Locks the lock file. Returns the open lock file, None if another synchronization holds the lock,
+    or False if the lock file cannot be used (the synchronization then runs without lock).
+    """
+    try:
+        os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+        lock_file = open(lock_path, "a")
+    except OSError as e:
+        logger.warning("Could not open lock file '%s': %s. Running without lock.", lock_path, e)
+        return False
+    try:
+        # lockf() locks belong to this process and are not inherited by child processes, unlike flock() locks
+        fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
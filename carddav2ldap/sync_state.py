@@ -0,0 +1,63 @@
+# carddav2ldap/sync_state.py
+# Local sync state kept between runs: per address book the CTag, sync tokens and, per contact, ETag, LDAP DN and hash.
+# Format: {"version": 1, "books": {book_url: {"ctag", "collection_sync_token", "sync_token", "cards": {href: {...}}}}}
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+def empty_sync_state():
+    """Returns the state of a first run."""
+    return {"version": 1, "books": {}}
+
+def load_sync_state(path):
+    """Loads the sync state from a previous run. Returns an empty state if the file is missing or unreadable."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        # First run or a fresh sync_state volume
+        logger.info("No sync state file '%s' yet. Starting with a full sync.", path)
+        return empty_sync_state()
+    except (OSError, ValueError) as e:
+        logger.warning("Could not read sync state file '%s': %s. Starting with a full sync.", path, e)
+        return empty_sync_state()
+    if not isinstance(state, dict) or not isinstance(state.get("books"), dict):
+        logger.warning("Sync state file '%s' has an unexpected format. Starting with a full sync.", path)
+        return empty_sync_state()
+    return state
+
+def save_sync_state(path, state):
+    """Writes the sync state atomically (write to a temporary file, then rename)."""
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not write sync state file '%s': %s. The next run will fetch all contacts again.", path, e)
+
+# --- Helper to decide whether an address book changed since the last run ---
+def is_address_book_unchanged(book_version, book_state):
+    """
+    Compares the CTag/sync-token reported by the discovery PROPFIND with the values saved by the previous run.
+    Returns True only if the server reported at least one of them and all reported values are unchanged.
+    """
+    compared = False
+    for key in ("ctag", "collection_sync_token"):
+        if book_version.get(key) is None:
+            continue
+        if book_version[key] != book_state.get(key):
+            return False
+        compared = True
+    return compared
+
+def has_card_dns(book_state):
+    """
+    Returns True if the saved state of an address book records the LDAP DN of every contact.
+    State written before stale-entry removal existed does not, so such books must be fetched completely once.
+    """
+    return "cards" in book_state and all("dn" in card for card in book_state["cards"].values())
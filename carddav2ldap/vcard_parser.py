@@ -0,0 +1,470 @@
+# carddav2ldap/vcard_parser.py
+# Extracts the contact data used for LDAP from vCard blobs (pipeline stage parse_card()).
+
+import logging
+import re       # Import for regular expressions in the fast parser
+import collections # Import for the chunks in flight in parse_cards()
+import codecs   # Import for quoted-printable and Base64 decoding in the fast parser
+import binascii # Import for Base64 decoding errors
+import base64   # Import for Base64 encoding/dekoding if needed for PHOTO field
+import vobject
+from vobject.icalendar import stringToTextValues # Same unescaping as vobject uses for text properties
+from vobject.vcard import splitFields, Name, Address, NAME_ORDER, ADDRESS_ORDER # Same splitting as vobject uses for ORG, N and ADR
+from .photo_normalizer import normalize_photo # Resizing and recompressing photos (CARDDAV_NORMALIZE_PHOTOS)
+from .filters import filter_contact_fields
+from .phone_numbers import normalize_phone_number
+
+# --- Fast vCard parser ---
+# vobject builds and validates a full component tree for every card, but parse_card() only reads a few
+# properties. fast_read_vcard() handles the common vCard 3.0 layout directly and returns None for anything
+# unusual, in which case parse_card() falls back to vobject.readOne(). The result is the same either way,
+# see benchmark_vcard_parser.py.
+
+# Properties read by parse_card(). All other properties are only checked for valid syntax.
+FAST_PARSER_TEXT_PROPERTIES = {"FN", "EMAIL", "TEL", "TITLE", "PHOTO", "UID"}
+FAST_PARSER_PROPERTIES = FAST_PARSER_TEXT_PROPERTIES | {"N", "ADR", "ORG", "CATEGORIES"}
+
+FAST_PARSER_FOLD_RE = re.compile(r"(?:\r\n|\r|\n)[\t ]")
+FAST_PARSER_LINE_END_RE = re.compile(r"\r\n|\r|\n")
+FAST_PARSER_NAME_RE = re.compile(r"(?:[a-zA-Z0-9_-]+\.)?([a-zA-Z0-9_-]+)")
+FAST_PARSER_PARAM_RE = re.compile(r"([a-zA-Z0-9_-]+)=([^\";:,=]+(?:,[^\";:,=]+)*)")
+
+class FastVCardProperty:
+    """A single vCard property, with the value and params attributes of a vobject ContentLine."""
+    __slots__ = ("name", "params", "value")
+
+    def __init__(self, name, params, value):
+        self.name = name
+        self.params = params
+        self.value = value
+
+    def __repr__(self):
+        return f"<{self.name}{self.params}{self.value}>"
+
+class FastVCardEncodedProperty:
+    """
+    A Base64-encoded property (PHOTO). The value is only decoded when it is read, so cards whose photo is
+    not imported (or that are skipped by the filters) never pay for decoding it. Raises binascii.Error like vobject.
+    """
+    __slots__ = ("name", "params", "encoded_value", "decoded_value")
+
+    def __init__(self, name, params, encoded_value):
+        self.name = name
+        self.params = params
+        self.encoded_value = encoded_value
+        self.decoded_value = None
+
+    @property
+    def value(self):
+        if self.decoded_value is None:
+            self.decoded_value = codecs.decode(self.encoded_value.encode("utf-8"), "base64")
+        return self.decoded_value
+
+    def __repr__(self):
+        return f"<{self.name}{self.params}{self.value}>"
+
+class FastVCard:
+    """The properties of a vCard, accessible like on a vobject component (card.fn, card.tel_list, ...)."""
+
+    def __init__(self, contents):
+        self.contents = contents
+
+    def __getattr__(self, name):
+        try:
+            if name.endswith("_list"):
+                return self.contents[name[:-5].upper().replace("_", "-")]
+            return self.contents[name.upper().replace("_", "-")][0]
+        except KeyError:
+            raise AttributeError(name)
+
+def fast_read_vcard(vcard_blob):
+    """
+    Parses a single vCard without vobject. Handles line unfolding, parameters, QUOTED-PRINTABLE and Base64
+    for the properties read by parse_card(), with the same decoding vobject applies to them.
+    Returns a FastVCard, or None if the card uses anything this parser does not handle.
+    """
+    lines = [line for line in FAST_PARSER_LINE_END_RE.split(FAST_PARSER_FOLD_RE.sub("", vcard_blob)) if line]
+    if len(lines) < 2 or lines[0].upper() != "BEGIN:VCARD" or lines[-1].upper() != "END:VCARD":
+        return None
+
+    contents = {}
+    for line in lines[1:-1]:
+        name_and_params, separator, value = line.partition(":")
+        if not separator:
+            return None
+        name_part, *param_parts = name_and_params.split(";")
+        name_match = FAST_PARSER_NAME_RE.fullmatch(name_part)
+        if not name_match:
+            return None
+        name = name_match.group(1).replace("_", "-").upper()
+        if name in ("BEGIN", "END", "PROFILE"):
+            return None # Nested components are left to vobject
+
+        params = {}
+        for param_part in param_parts:
+            param_match = FAST_PARSER_PARAM_RE.fullmatch(param_part)
+            if not param_match:
+                return None # Quoted values, singleton parameters (vCard 2.1) etc.
+            params.setdefault(param_match.group(1).upper(), []).extend(param_match.group(2).split(","))
+
+        encodings = params.get("ENCODING")
+        if encodings and "QUOTED-PRINTABLE" in encodings:
+            encodings.remove("QUOTED-PRINTABLE")
+            if encodings or value.endswith("="):
+                return None # Soft line breaks and odd encodings are left to vobject
+            del params["ENCODING"]
+            try:
+                value = codecs.decode(value.encode("utf-8"), "quoted-printable").decode(params.get("CHARSET", ["utf-8"])[0])
+            except (ValueError, LookupError):
+                return None
+        if "ENCODING" in params and name != "PHOTO":
+            return None # vobject would decode these as Base64 and may fail on them
+
+        if name not in FAST_PARSER_PROPERTIES:
+            continue
+        if name in FAST_PARSER_TEXT_PROPERTIES:
+            if "ENCODING" in params: # Only PHOTO gets here, its Base64 data is decoded when read
+                contents.setdefault(name, []).append(FastVCardEncodedProperty(name, params, value))
+                continue
+            value = stringToTextValues(value)[0]
+        elif name == "CATEGORIES":
+            value = stringToTextValues(value)
+        elif name == "ORG":
+            value = splitFields(value)
+        elif name == "N":
+            value = Name(**dict(zip(NAME_ORDER, splitFields(value))))
+        elif name == "ADR":
+            value = Address(**dict(zip(ADDRESS_ORDER, splitFields(value))))
+        contents.setdefault(name, []).append(FastVCardProperty(name, params, value))
+    return FastVCard(contents)
+
+# --- vCard parsing ---
+def structured_field_text(field):
+    """Returns a field of a vobject Name or Address as text. Fields with comma-separated values are lists."""
+    if isinstance(field, list):
+        return " ".join(str(part).strip() for part in field if part).strip()
+    return str(field or "").strip()
+
+def parse_card(vcard_blob, book_url, parse_options):
+    """
+    Extracts the contact data used for LDAP from a single vCard blob.
+    This function only depends on its arguments, so it can run in a worker process (CARDDAV_PARSE_WORKERS).
+    Returns a tuple (contact_data, messages): contact_data is None if the vCard could not be parsed or is
+    skipped by parse_options["filters"] (the result of compile_filters(), optional), messages holds the log
+    messages produced while parsing as (level, msg, args) tuples, to be passed to logger.log().
+    """
+    outcome, contact_data, messages = parse_card_with_outcome(vcard_blob, book_url, parse_options)
+    return contact_data, messages
+
+def parse_card_with_outcome(vcard_blob, book_url, parse_options):
+    """
+    Same as parse_card(), but returns a tuple (outcome, contact_data, messages), outcome being "parsed",
+    "skipped" (by the contact filters) or "failed".
+    """
+    messages = []
+
+    def log(level, msg, *args):
+        # Arguments are converted to strings, so the messages can be sent back from a worker process
+        messages.append((level, msg, tuple(arg if isinstance(arg, (str, int)) else str(arg) for arg in args)))
+
+    try:
+        # Parse the vCard string with the fast parser if enabled, vobject handles everything else
+        vobj = fast_read_vcard(vcard_blob) if parse_options["fast_parser"] else None
+        if vobj is None:
+            vobj = vobject.readOne(vcard_blob)
+
+        # --- Extract Full Name (FN) ---
+        full_name = ""
+        fn_obj = getattr(vobj, "fn", None)
+        if parse_options["debug"]:
+            log(logging.DEBUG, "Raw FN object: %s", repr(fn_obj))
+            if fn_obj:
+                log(logging.DEBUG, "FN object value (raw): %s", repr(getattr(fn_obj, 'value', 'N/A')))
+                log(logging.DEBUG, "FN object contents (raw): %s", repr(getattr(fn_obj, 'contents', 'N/A')))
+
+        if fn_obj:
+            if hasattr(fn_obj, 'value') and fn_obj.value is not None:
+                # Prefer fn.value if it exists and is not None
+                full_name = str(fn_obj.value).strip()
+            elif hasattr(fn_obj, 'contents') and fn_obj.contents:
+                # Fallback to fn.contents if fn.value is None or missing
+                if isinstance(fn_obj.contents, dict) and 'value' in fn_obj.contents and fn_obj.contents['value']:
+                    full_name = str(fn_obj.contents['value'][0]).strip()
+                elif isinstance(fn_obj.contents, list) and fn_obj.contents:
+                    full_name = str(fn_obj.contents[0]).strip()
+            
+            # Final check for full_name from FN object itself if still empty
+            if not full_name and str(fn_obj) and str(fn_obj).startswith('FN:'):
+                full_name = str(fn_obj)[3:].strip() # Remove "FN:" prefix
+
+
+        # --- Extract Given Name (FIRST NAME from N property) and Surname (LAST NAME from N property) ---
+        given_name = ""
+        surname = ""
+        n_obj = getattr(vobj, "n", None)
+        if parse_options["debug"]:
+            log(logging.DEBUG, "Raw N object: %s", repr(n_obj))
+            if n_obj:
+                log(logging.DEBUG, "N object given: %s", repr(getattr(n_obj.value, 'given', 'N/A')))
+                log(logging.DEBUG, "N object family: %s", repr(getattr(n_obj.value, 'family', 'N/A')))
+
+        if n_obj:
+            # vobject turns N into a Name (the fast parser too), a few broken cards keep a plain string
+            given_name = structured_field_text(getattr(n_obj.value, 'given', ''))
+            surname = structured_field_text(getattr(n_obj.value, 'family', ''))
+        
+        # --- Fallback for full_name if FN was empty or problematic ---
+        if not full_name:
+            # If FN was empty, try to construct full_name from N (FirstName LastName)
+            if given_name and surname:
+                full_name = f"{given_name} {surname}".strip()
+            elif given_name:
+                full_name = given_name.strip()
+            elif surname:
+                full_name = surname.strip()
+
+        # Final fallback if still no full name
+        if not full_name:
+             full_name = "Unknown Contact"
+
+        # Fallback for surname: Ensure it's never empty if full_name exists, to satisfy LDAP schema requirements.
+        # This is specifically to address objectClassViolation for 'sn' in inetOrgPerson.
+        if not surname and full_name:
+            # If the full_name is a multi-word string, take the last word as surname.
+            if ' ' in full_name and full_name != "Unknown Contact":
+                surname = full_name.split()[-1].strip()
+            else:
+                # If full_name is a single word or no clear surname can be extracted,
+                # use the the first part of the full_name as surname. This satisfies 'sn' requirement.
+                surname = full_name.split()[0].strip() if ' ' in full_name else full_name.strip()
+        
+        # Final check: If surname is STILL empty after all fallbacks, set a placeholder.
+        # This handles cases where full_name might also be empty or derived as empty.
+        if not surname:
+            surname = "N/A" # Placeholder for required 'sn' attribute
+
+        # --- NEW DEBUGGING: Print extracted names immediately ---
+        if parse_options["debug"]:
+            log(logging.DEBUG, "After FN/N parsing - full_name: '%s', given_name: '%s', surname: '%s'", full_name, given_name, surname)
+
+        # --- Extract UID (stable identifier of the contact, used to find its LDAP entry) ---
+        uid = ""
+        uid_obj = getattr(vobj, 'uid', None)
+        if uid_obj and uid_obj.value:
+            uid = str(uid_obj.value).strip()
+
+        # Extract Email addresses
+        emails = [str(e.value).strip() for e in getattr(vobj, "email_list", []) if e.value]
+
+        # --- Extract Categories ---
+        categories = []
+        categories_obj = getattr(vobj, 'categories', None)
+        if categories_obj and categories_obj.value:
+            # CATEGORIES value can be a comma-separated string or a list
+            if isinstance(categories_obj.value, str):
+                categories = [str(cat).strip() for cat in categories_obj.value.split(',') if str(cat).strip()]
+            elif isinstance(categories_obj.value, list):
+                categories = [str(cat).strip() for cat in categories_obj.value if str(cat).strip()]
+
+        # --- Apply the contact filters before the phones, addresses and photo are read ---
+        if parse_options.get("filters") is not None:
+            skip_reason = filter_contact_fields(emails, categories, parse_options["filters"])
+            if skip_reason:
+                log(logging.DEBUG, "Skipping contact '%s' due to %s.", full_name, skip_reason)
+                return "skipped", None, messages
+
+        # --- Extract and categorize Telephone numbers ---
+        # Store all cleaned phone numbers in separate lists based on type
+        all_cleaned_phones = [] # For the general 'telephoneNumber' attribute
+        work_phones = [] # New list for work phones
+        home_phones = []
+        mobile_phones = []
+        fax_numbers = []
+        # New list for other/unspecified phone numbers
+        other_phones = []
+
+        for tel_obj in getattr(vobj, "tel_list", []):
+            raw_phone = str(tel_obj.value).strip()
+            # Empty if no digits remain after cleaning, E.164 if PHONE_DEFAULT_COUNTRY_CODE is set
+            cleaned_phone = normalize_phone_number(raw_phone, parse_options.get("phone_options"))
+
+            if cleaned_phone: # Only process non-empty cleaned numbers
+                all_cleaned_phones.append(cleaned_phone) # Add to general list
+                
+                # Debugging: Print the raw tel_obj and its parameters
+                if parse_options["debug"]:
+                    log(logging.DEBUG, "Processing tel_obj: %s", repr(tel_obj))
+                    log(logging.DEBUG, "  tel_obj.params: %s", repr(tel_obj.params))
+
+                # Try accessing parameters via .params dictionary
+                # vobject stores parameters in a dictionary, e.g., {'TYPE': ['VOICE', 'WORK']}
+                raw_type_params_from_params = tel_obj.params.get('TYPE', [])
+                types = [t.upper() for t in raw_type_params_from_params]
+                
+                if parse_options["debug"]:
+                    log(logging.DEBUG, "Processing phone: '%s', Cleaned: '%s'", raw_phone, cleaned_phone)
+                    log(logging.DEBUG, "  Raw type_param (from .params): %s, Processed Types: %s", repr(raw_type_params_from_params), repr(types))
+
+                # Check for specific types - a number can belong to multiple categories
+                if 'FAX' in types: # Prioritize FAX
+                    fax_numbers.append(cleaned_phone)
+                if 'WORK' in types:
+                    work_phones.append(cleaned_phone)
+                if 'HOME' in types:
+                    home_phones.append(cleaned_phone)
+                if 'CELL' in types or 'MOBILE' in types:
+                    mobile_phones.append(cleaned_phone)
+                
+                # Add to 'other_phones' only if it wasn't specifically categorized
+                # This check needs to be AFTER all specific categorizations.
+                if not any(t in types for t in ['WORK', 'HOME', 'CELL', 'MOBILE', 'FAX']):
+                    other_phones.append(cleaned_phone)
+
+
+        # --- Extract Address Information (Street, City, Postal Code) ---
+        # The ADR property can have multiple parts. We'll take the first one found.
+        # vCard ADR format: Post Office Box;Extended Address;Street Address;Locality;Region;Postal Code;Country Name
+        street_address = ""
+        locality = ""
+        postal_code = ""
+
+        adr_obj_list = getattr(vobj, 'adr_list', [])
+        if adr_obj_list:
+            first_adr = adr_obj_list[0].value # Take the first address, an Address
+            street_address = structured_field_text(getattr(first_adr, 'street', ''))
+            locality = structured_field_text(getattr(first_adr, 'city', '')) # 'city' maps to Locality
+            postal_code = structured_field_text(getattr(first_adr, 'code', '')) # 'code' maps to Postal Code
+        
+        # --- Extract Organization (Company Name) and Organizational Unit (Department) ---
+        organization = ""
+        organizational_unit = ""
+        org_obj = getattr(vobj, 'org', None)
+        if org_obj and org_obj.value:
+            if isinstance(org_obj.value, list):
+                if len(org_obj.value) > 0:
+                    organization = str(org_obj.value[0]).strip()
+                if len(org_obj.value) > 1:
+                    organizational_unit = str(org_obj.value[1]).strip()
+            elif isinstance(org_obj.value, str):
+                # Handle single string ORG value, assume it's the organization
+                organization = str(org_obj.value).strip()
+
+        # --- Extract Job Title ---
+        job_title = ""
+        title_obj = getattr(vobj, 'title', None)
+        if title_obj and title_obj.value:
+            job_title = str(title_obj.value).strip()
+
+        # Handle photo data if CARDDAV_IMPORT_PHOTOS is enabled
+        jpeg_photo_data = None
+        if parse_options["import_photos"]:
+            photo_obj = getattr(vobj, 'photo', None)
+            if photo_obj and hasattr(photo_obj, 'value') and photo_obj.value:
+                if isinstance(photo_obj.value, bytes):
+                    # If vobject already decoded it to bytes, use directly
+                    jpeg_photo_data = photo_obj.value
+                elif isinstance(photo_obj.value, str):
+                    # If for some reason it's a string, try base64 decoding it
+                    try:
+                        jpeg_photo_data = base64.b64decode(photo_obj.value)
+                    except binascii.Error as decode_err:
+                        log(logging.WARNING, "Photo data for '%s' from '%s' is string but invalid Base64. Error: %s. Skipping photo.", full_name, book_url, decode_err)
+                        jpeg_photo_data = None
+                    except Exception as decode_err:
+                        log(logging.WARNING, "Unexpected error decoding photo data for '%s' from '%s'. Error: %s. Skipping photo.", full_name, book_url, decode_err)
+                        jpeg_photo_data = None
+                else:
+                    log(logging.WARNING, "Unexpected photo data type for '%s' from '%s': %s. Skipping photo.", full_name, book_url, type(photo_obj.value))
+                    jpeg_photo_data = None
+            if jpeg_photo_data and parse_options["photo_options"] is not None:
+                # Convert to a small JPEG, photos that cannot be read are skipped
+                try:
+                    source_size = len(jpeg_photo_data)
+                    jpeg_photo_data = normalize_photo(jpeg_photo_data, parse_options["photo_options"])
+                    if parse_options["debug"]:
+                        log(logging.DEBUG, "Photo of '%s' normalized: %d -> %d bytes.", full_name, source_size, len(jpeg_photo_data))
+                except Exception as photo_err:
+                    log(logging.WARNING, "Could not convert photo of '%s' from '%s' to JPEG. Error: %s. Skipping photo.", full_name, book_url, photo_err)
+                    jpeg_photo_data = None
+
+
+        contact_data = {
+            "full_name": full_name,
+            "surname": surname,
+            "given_name": given_name,
+            "emails": emails,
+            "all_phones": all_cleaned_phones, # General list of all phones
+            "work_phones": work_phones, # New: list for work phones
+            "home_phones": home_phones,
+            "mobile_phones": mobile_phones,
+            "fax_numbers": fax_numbers,
+            "other_phones": other_phones, # New: list for other/unspecified phones
+            "street_address": street_address, # New address field
+            "locality": locality,             # New address field
+            "postal_code": postal_code,       # New address field
+            "organization": organization,     # New organization field
+            "organizational_unit": organizational_unit, # New organizational unit field
+            "job_title": job_title,           # New job title field
+            "categories": categories,         # New categories field
+            "jpeg_photo": jpeg_photo_data, # Add photo data here
+            "uid": uid,                       # vCard UID, empty if the card has none
+            "book_url": book_url # Address book the contact was fetched from
+        }
+        return "parsed", contact_data, messages
+
+    except binascii.Error as e:
+        # Catch specific Base64 decoding errors during initial vCard parsing
+        log(logging.ERROR, "Base64 decoding failed for vCard from %s. Error: %s. Problematic vCard blob starts: %s...", book_url, e, vcard_blob[:200])
+    except Exception as e:
+        # General error for other parsing issues
+        log(logging.WARNING, "Could not parse vCard blob from %s. Error: %s. Blob start: %s...", book_url, e, vcard_blob[:200])
+    return "failed", None, messages
+
+def parse_card_chunk(vcard_blobs, book_url, parse_options):
+    """Parses a list of vCard blobs in a worker process. Returns the parse_card_with_outcome() result of every blob."""
+    return [parse_card_with_outcome(vcard_blob, book_url, parse_options) for vcard_blob in vcard_blobs]
+
+def parse_cards(cards, book_url, parse_options, parse_executor=None, chunk_size=50, chunks_in_flight=2, parse_counts=None,
+                failed_hrefs=None):
+    """
+    Parses the (href, etag, vcard_blob) tuples of a card stream and yields (href, contact_data, messages)
+    in order, contact_data and messages being the parse_card() result. contact_data["href"] is set.
+    With a parse_executor (a process pool) the blobs are parsed in chunks of chunk_size. Only chunks_in_flight
+    chunks are submitted at any time, so memory use does not grow with the size of the address book.
+    If parse_counts (a dict) is given, the number of cards of every outcome is counted in it.
+    If failed_hrefs (a list) is given, the hrefs of the cards that could not be parsed are appended to it.
+    """
+    def parsed(href, outcome, contact_data, messages):
+        if contact_data is not None:
+            contact_data["href"] = href
+        if parse_counts is not None:
+            parse_counts[outcome] = parse_counts.get(outcome, 0) + 1
+        if failed_hrefs is not None and outcome == "failed":
+            failed_hrefs.append(href)
+        return href, contact_data, messages
+
+    if parse_executor is None:
+        for href, etag, vcard_blob in cards:
+            yield parsed(href, *parse_card_with_outcome(vcard_blob, book_url, parse_options))
+        return
+
+    def chunk_results(chunk_hrefs, future):
+        for href, result in zip(chunk_hrefs, future.result()):
+            yield parsed(href, *result)
+
+    pending_chunks = collections.deque() # (hrefs, future) of every chunk in flight
+    chunk_hrefs = []
+    chunk = []
+    for href, etag, vcard_blob in cards:
+        chunk_hrefs.append(href)
+        chunk.append(vcard_blob)
+        if len(chunk) >= chunk_size:
+            pending_chunks.append((chunk_hrefs, parse_executor.submit(parse_card_chunk, chunk, book_url, parse_options)))
+            chunk_hrefs = []
+            chunk = []
+            while len(pending_chunks) > chunks_in_flight:
+                yield from chunk_results(*pending_chunks.popleft())
+    if chunk:
+        pending_chunks.append((chunk_hrefs, parse_executor.submit(parse_card_chunk, chunk, book_url, parse_options)))
+    while pending_chunks:
+        yield from chunk_results(*pending_chunks.popleft())
@@ -65,6 +65,13 @@ if [[ "${DEBUG,,}" == "true" ]]; then
     echo "DEBUG: End of $ENV_FILE contents."
 fi
 
+# In daemon mode the sync script runs permanently and schedules itself (SYNC_INTERVAL_SECONDS), cron is not used.
+# exec replaces this shell, so SIGTERM from 'docker stop' reaches the sync script through tini.
+if [[ "${SYNC_DAEMON,,}" == "true" ]]; then
+    echo "SYNC_DAEMON is enabled. Starting the sync script in daemon mode (interval: ${SYNC_INTERVAL_SECONDS:-1800} seconds)."
+    exec /app/sync_script.sh --daemon
+fi
+
 # Check if CRON_SCHEDULE is set, otherwise use default value
 CRON_SCHEDULE=${CRON_SCHEDULE:-0 0 * * *}
 
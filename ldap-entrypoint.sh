@@ -16,6 +16,28 @@ if [ -z "$(ls -A "$LDAP_DATA_DIR" 2>/dev/null)" ]; then
     mkdir -p "$LDAP_CONFIG_DIR"
 fi
 
+# Bulk import of contacts exported by the sync service with LDAP_EXPORT_LDIF_FILE.
+# slapadd writes directly into the database files, which is much faster than adding entries over LDAP,
+# but it only works while slapd is stopped and once the database exists (i.e. not on the very first start).
+LDAP_BULK_IMPORT_FILE="${LDAP_BULK_IMPORT_FILE:-/var/lib/ldap-import/contacts.ldif}"
+if [ -f "$LDAP_BULK_IMPORT_FILE" ]; then
+    if [ -z "$(ls -A "$LDAP_DATA_DIR" 2>/dev/null)" ]; then
+        echo "INFO: LDAP database is not initialized yet. $LDAP_BULK_IMPORT_FILE will be loaded on the next start."
+    else
+        echo "INFO: Loading $LDAP_BULK_IMPORT_FILE into the LDAP database with slapadd..."
+        # -n 1: the mdb database holding the contacts, -c: continue after entries that already exist, -q: quick mode
+        if slapadd -F "$LDAP_CONFIG_DIR" -n 1 -c -q -l "$LDAP_BULK_IMPORT_FILE"; then
+            echo "INFO: Bulk import finished."
+        else
+            echo "WARNING: slapadd reported errors (entries that already exist are skipped). See the messages above."
+        fi
+        # slapadd runs as root, slapd runs as openldap
+        chown -R openldap:openldap "$LDAP_DATA_DIR"
+        # Rename the file so it is not loaded again on the next start
+        mv "$LDAP_BULK_IMPORT_FILE" "$LDAP_BULK_IMPORT_FILE.imported"
+    fi
+fi
+
 # Execute the original entrypoint of the osixia/openldap image.
 # Pass all arguments received by this script to the original entrypoint.
 # The original entrypoint for osixia/openldap is typically /container/tool/run
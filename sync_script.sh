@@ -81,6 +81,13 @@ if [[ "${DEBUG,,}" == "true" && "$ACTIVE_FILE_LOG_PATH" != "/dev/null" ]]; then
 fi
 # --- END DEBUGGING STEP ---
 
+# Daemon mode: replace this shell with the Python script, so it receives SIGTERM directly and can stop gracefully.
+# Its output is still written through log_and_tee. The script flushes its log output itself (see LOG_LEVEL).
+if [[ "$1" == "--daemon" ]]; then
+    exec > >(log_and_tee) 2>&1
+    exec /usr/local/bin/python /app/sync_script.py --daemon
+fi
+
 # Execute the Python script. Its stdout/stderr will be piped through log_and_tee.
 # Note: 2>&1 must come BEFORE the pipe, otherwise only stdout is piped.
 /usr/local/bin/python /app/sync_script.py 2>&1 | log_and_tee
@@ -0,0 +1,42 @@
+# tests/conftest.py
+# Makes the carddav2ldap package and the benchmark scripts in the repository root importable,
+# and provides the settings every configuration needs and an in-memory LDAP directory.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+REQUIRED_SETTINGS = {
+    "CARDDAV_BASE_DISCOVERY_URL": "https://carddav.example.com/addressbooks/user/", "CARDDAV_USERNAME": "user",
+    "CARDDAV_PASSWORD": "secret", "LDAP_SERVER": "ldap://localhost", "LDAP_USER": "cn=admin,dc=example,dc=com",
+    "LDAP_PASSWORD": "secret", "LDAP_BASE_DN": "ou=contacts,dc=example,dc=com",
+}
+
+@pytest.fixture
+def make_config(tmp_path):
+    """Returns a function that loads a config from REQUIRED_SETTINGS and the given settings."""
+    from carddav2ldap.config import load_config
+
+    def make(**settings):
+        environ = dict(REQUIRED_SETTINGS, SYNC_STATE_FILE=str(tmp_path / "sync_state.json"),
+                       SYNC_LOCK_FILE=str(tmp_path / "sync.lock"))
+        environ.update(settings)
+        return load_config(environ)
+    return make
+
+@pytest.fixture
+def make_directory():
+    """Returns a function that creates an LdapDirectory connected to an in-memory ldap3 directory with an empty base DN."""
+    import ldap3
+    from carddav2ldap.ldap_directory import LdapDirectory
+
+    def make(config):
+        directory = LdapDirectory(config)
+        directory.conn = ldap3.Connection(ldap3.Server("mock"), client_strategy=ldap3.MOCK_SYNC)
+        directory.conn.strategy.add_entry(config["ldap_base_dn"], {"objectClass": ["organizationalUnit"], "ou": "contacts"})
+        directory.conn.bind()
+        return directory
+    return make
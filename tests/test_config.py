@@ -0,0 +1,16 @@
+# tests/test_config.py
+# Validation of the settings read by load_config().
+
+import pytest
+
+from carddav2ldap.config import ConfigError
+
+def test_sync_trigger_listens_on_loopback_by_default(make_config):
+    config = make_config(SYNC_TRIGGER_PORT="8000")
+    assert config["sync_trigger_bind"] == "127.0.0.1"
+
+def test_sync_trigger_on_all_interfaces_requires_token(make_config):
+    with pytest.raises(ConfigError):
+        make_config(SYNC_TRIGGER_PORT="8000", SYNC_TRIGGER_BIND="0.0.0.0")
+    config = make_config(SYNC_TRIGGER_PORT="8000", SYNC_TRIGGER_BIND="0.0.0.0", SYNC_TRIGGER_TOKEN="token")
+    assert config["sync_trigger_token"] == "token"
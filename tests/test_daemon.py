@@ -0,0 +1,21 @@
+# tests/test_daemon.py
+# Stopping the daemon from a signal handler.
+
+import signal
+import threading
+import time
+
+from carddav2ldap.daemon import SyncTriggers
+
+def test_stop_request_wakes_up_waiting_daemon():
+    sync_triggers = SyncTriggers(debounce=1.0)
+    stopper = threading.Timer(0.2, sync_triggers.stop, args=(signal.SIGTERM,))
+    # Holding the condition shows that stop() does not need it, as in a signal handler
+    with sync_triggers.condition:
+        stopper.start()
+        stopper.join()
+    assert not sync_triggers.stopping
+    start = time.monotonic()
+    assert sync_triggers.wait(60) is None
+    assert time.monotonic() - start < 5
+    assert sync_triggers.stopping
@@ -0,0 +1,25 @@
+# tests/test_filters.py
+# Whitelist and blacklist rules compiled by FilterRules.
+
+import pytest
+
+from carddav2ldap.config import ConfigError
+from carddav2ldap.filters import FilterRules
+
+def test_regex_rule_with_inline_flag():
+    rules = FilterRules(["re:(?i)^team$", "Family"])
+    assert rules.match("TEAM")
+    assert rules.match("Family")
+    assert not rules.match("teams")
+
+def test_glob_and_regex_rules_are_combined():
+    rules = FilterRules(["*.example.*", "re:(?i)mail[0-9]+\\.org", ".example.net"], domains=True)
+    assert rules.match("mx.example.com")
+    assert rules.match("Mail42.ORG")
+    assert rules.match("a.b.example.net")
+    assert not rules.match("example.com")
+    assert not rules.match("mail.org")
+
+def test_invalid_regex_rule_is_named(make_config):
+    with pytest.raises(ConfigError, match="re:team\\("):
+        make_config(CARDDAV_CATEGORY_BLACKLIST="re:(?i)^spam$,re:team(")
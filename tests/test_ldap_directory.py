@@ -0,0 +1,37 @@
+# tests/test_ldap_directory.py
+# Choosing the DNs of the LDAP entries (apply_to_ldap() against an in-memory ldap3 directory).
+
+from carddav2ldap.config import build_parse_options
+from carddav2ldap.ldap_directory import apply_to_ldap
+from carddav2ldap.vcard_parser import parse_card
+
+BOOK_URL = "https://carddav.example.com/addressbooks/user/work/"
+
+def make_contact(uid, full_name, parse_options, extra_lines=""):
+    vcard = f"BEGIN:VCARD\r\nVERSION:3.0\r\nUID:{uid}\r\nFN:{full_name}\r\nN:;{full_name};;;\r\n{extra_lines}END:VCARD\r\n"
+    contact, messages = parse_card(vcard, BOOK_URL, parse_options)
+    contact["href"] = f"/work/{uid}.vcf"
+    return contact
+
+def run_import(directory, config, contacts):
+    """Runs one import like a sync cycle. Returns the sorted DNs of all entries afterwards."""
+    directory.load_index()
+    import_result = apply_to_ldap(contacts, directory, config, previous_books={})
+    directory.load_index()
+    return import_result["counts"], sorted(directory.existing_dns.values())
+
+def test_contact_with_shared_name_keeps_its_dn(make_config, make_directory):
+    config = make_config()
+    parse_options = build_parse_options(config)
+    directory = make_directory(config)
+
+    counts, dns = run_import(directory, config, [make_contact("a", "John Smith", parse_options),
+                                                 make_contact("b", "John Smith", parse_options)])
+    assert dns == ["cn=John Smith+uid=b,ou=contacts,dc=example,dc=com", "cn=John Smith,ou=contacts,dc=example,dc=com"]
+
+    # The first contact is renamed, the second one keeps its entry in this and the following runs
+    for expected_renames in (1, 0):
+        counts, dns = run_import(directory, config, [make_contact("a", "John Smyth", parse_options),
+                                                     make_contact("b", "John Smith", parse_options)])
+        assert dns == ["cn=John Smith+uid=b,ou=contacts,dc=example,dc=com", "cn=John Smyth,ou=contacts,dc=example,dc=com"]
+        assert counts["renamed"] == expected_renames
@@ -0,0 +1,17 @@
+# tests/test_ldif.py
+# LDIF export (LDAP_EXPORT_LDIF_FILE).
+
+import base64
+
+from carddav2ldap.ldif import LdifExport
+
+def test_export_with_non_ascii_base_dn(tmp_path):
+    path = tmp_path / "contacts.ldif"
+    ldap_dn = "cn=Jörg Müller,ou=Kontakte,o=Bäckerei,dc=example,dc=com"
+    ldif_export = LdifExport(str(path))
+    ldif_export.write_entry(ldap_dn, {"objectClass": ["inetOrgPerson", "top"], "cn": "Jörg Müller", "sn": "Müller"})
+    ldif_export.commit()
+    content = path.read_text(encoding="ascii")
+    assert content.startswith("# Contacts exported by carddav2ldap for slapadd\nversion: 1\n\n")
+    unfolded = content.replace("\n ", "")
+    assert f"dn:: {base64.b64encode(ldap_dn.encode('utf-8')).decode('ascii')}\n" in unfolded
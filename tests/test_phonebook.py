@@ -0,0 +1,28 @@
+# tests/test_phonebook.py
+# Phonebook entries built from the index of the existing LDAP entries.
+
+from carddav2ldap.config import build_parse_options
+from carddav2ldap.ldap_directory import apply_to_ldap
+from carddav2ldap.phonebook import read_phonebook_entries, index_phonebook_entries
+
+from test_ldap_directory import make_contact
+
+def test_index_phonebook_entries_match_ldap(make_config, make_directory):
+    config = make_config(LDAP_STALE_ENTRIES="delete")
+    parse_options = build_parse_options(config)
+    directory = make_directory(config)
+    directory.load_index()
+    apply_to_ldap([make_contact("a", "Anna Müller", parse_options, "TEL;TYPE=WORK:+49 30 1234\r\nTEL;TYPE=FAX:+49 30 1235\r\n"),
+                   make_contact("b", "Bernd Schulz", parse_options, "TEL:+49 89 555\r\n"),
+                   make_contact("c", "No Phone", parse_options)], directory, config, previous_books={})
+
+    # The next cycle renames one contact and removes another
+    directory.load_index()
+    import_result = apply_to_ldap([make_contact("a", "Anna Schmidt", parse_options, "TEL;TYPE=WORK:+49 30 1234\r\n"),
+                                   make_contact("c", "No Phone", parse_options)], directory, config, previous_books={})
+    stale_dns = [dn for dn in directory.existing_dns if dn not in import_result["produced_dns"]]
+    assert directory.remove_stale_entries(stale_dns) == 1
+
+    entries = index_phonebook_entries(directory)
+    assert entries == read_phonebook_entries(directory)
+    assert entries == [{"name": "Anna Schmidt", "phones": ["+49301234"], "faxes": []}]
@@ -0,0 +1,60 @@
+# tests/test_sync.py
+# Synchronization cycles (Synchronizer).
+
+from concurrent.futures.process import BrokenProcessPool
+
+from carddav2ldap.metrics import SyncMetrics
+from carddav2ldap.sync import Synchronizer
+
+def test_broken_parse_workers_are_restarted(make_config, monkeypatch):
+    synchronizer = Synchronizer(make_config(CARDDAV_PARSE_WORKERS="2"))
+    try:
+        broken_executor = synchronizer.parse_executor
+
+        def run_cycle_stages(book_names, metrics):
+            raise BrokenProcessPool("A child process terminated abruptly")
+        monkeypatch.setattr(synchronizer, "run_cycle_stages", run_cycle_stages)
+        assert synchronizer.run_cycle() is False
+        assert synchronizer.parse_executor is not broken_executor
+        # The new workers parse again
+        assert synchronizer.parse_executor.submit(sum, [1, 2]).result() == 3
+    finally:
+        synchronizer.close()
+
+def test_failed_parse_keeps_ldap_entry(make_config, monkeypatch):
+    """A card that cannot be parsed keeps the DN of its previous run, so its entry is not removed as stale."""
+    book = {"url": "https://carddav.example.com/addressbooks/user/work/", "name": "work", "ctag": "2", "collection_sync_token": None}
+    good_card = "BEGIN:VCARD\r\nVERSION:3.0\r\nUID:1\r\nFN:Anna Müller\r\nN:Müller;Anna;;;\r\nEND:VCARD\r\n"
+    broken_card = "BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Broken\r\nTEL;garbage\r\n"
+    filtered_card = "BEGIN:VCARD\r\nVERSION:3.0\r\nUID:3\r\nFN:Spam Sender\r\nCATEGORIES:Spam\r\nEND:VCARD\r\n"
+    cards = [("/work/1.vcf", '"a"', good_card), ("/work/2.vcf", '"b"', broken_card), ("/work/3.vcf", '"c"', filtered_card)]
+
+    def fetch_cards(session, config, fetched_book, book_state, fetch_result, log):
+        yield from cards
+        fetch_result["new_book_state"] = {"ctag": "2", "cards": {href: {"etag": etag, "dn": None} for href, etag, _ in cards}}
+    monkeypatch.setattr("carddav2ldap.sync.fetch_cards", fetch_cards)
+
+    synchronizer = Synchronizer(make_config(LDAP_STALE_ENTRIES="delete", CARDDAV_CATEGORY_BLACKLIST="Spam"))
+    try:
+        previous_dns = {"/work/1.vcf": "cn=Anna Müller,ou=contacts,dc=example,dc=com",
+                        "/work/2.vcf": "cn=Bernd Broken,ou=contacts,dc=example,dc=com",
+                        "/work/3.vcf": "cn=Spam Sender,ou=contacts,dc=example,dc=com"}
+        synchronizer.sync_state["books"][book["url"]] = {
+            "ctag": "1", "cards": {href: {"etag": '"old"', "dn": dn} for href, dn in previous_dns.items()}}
+        synchronizer.directory.existing_dns = {dn.lower(): dn for dn in previous_dns.values()}
+        synchronizer.metrics = SyncMetrics()
+
+        fetch_result = {}
+        contacts = list(synchronizer.iter_address_book_contacts(book, fetch_result, lambda *args: None))
+        assert [contact["full_name"] for contact in contacts] == ["Anna Müller"]
+        new_cards = fetch_result["new_book_state"]["cards"]
+        assert new_cards["/work/2.vcf"] == {"etag": None, "dn": previous_dns["/work/2.vcf"]}
+        assert new_cards["/work/3.vcf"]["dn"] is None
+
+        new_cards["/work/1.vcf"]["dn"] = previous_dns["/work/1.vcf"] # Set by the LDAP import
+        cycle = {"pending_book_states": {book["url"]: fetch_result["new_book_state"]},
+                 "failed_fetch_book_urls": set(), "skipped_book_urls": set()}
+        stale_dns = synchronizer.find_stale_dns([book], cycle, {previous_dns["/work/1.vcf"].lower()})
+        assert stale_dns == [previous_dns["/work/3.vcf"].lower()]
+    finally:
+        synchronizer.close()
@@ -0,0 +1,18 @@
+# tests/test_sync_state.py
+# Loading the sync state of the previous run.
+
+import logging
+
+from carddav2ldap.sync_state import load_sync_state, empty_sync_state
+
+def test_missing_state_file_is_not_a_warning(tmp_path, caplog):
+    with caplog.at_level(logging.INFO):
+        assert load_sync_state(str(tmp_path / "sync_state.json")) == empty_sync_state()
+    assert [record.levelname for record in caplog.records] == ["INFO"]
+
+def test_corrupt_state_file_is_a_warning(tmp_path, caplog):
+    path = tmp_path / "sync_state.json"
+    path.write_text("{not json", encoding="utf-8")
+    with caplog.at_level(logging.INFO):
+        assert load_sync_state(str(path)) == empty_sync_state()
+    assert [record.levelname for record in caplog.records] == ["WARNING"]
@@ -0,0 +1,33 @@
+# tests/test_vcard_parser.py
+# The fast vCard parser must produce the same contact_data as vobject, with the structured N and ADR fields filled in.
+
+import random
+
+from benchmark_vcard_parser import BOOK_URL, generate_vcard
+from carddav2ldap.vcard_parser import parse_card
+
+VOBJECT_OPTIONS = {"import_photos": True, "debug": False, "fast_parser": False, "photo_options": None}
+FAST_OPTIONS = dict(VOBJECT_OPTIONS, fast_parser=True)
+
+def test_fast_parser_matches_vobject():
+    rng = random.Random(42)
+    for index in range(500):
+        vcard_blob = generate_vcard(rng, index)
+        expected, _ = parse_card(vcard_blob, BOOK_URL, VOBJECT_OPTIONS)
+        actual, _ = parse_card(vcard_blob, BOOK_URL, FAST_OPTIONS)
+        assert actual == expected, vcard_blob
+        # Every generated card has an N property with a given name
+        assert actual["given_name"], vcard_blob
+        if "\nADR" in vcard_blob:
+            assert actual["street_address"] and actual["locality"] and actual["postal_code"], vcard_blob
+
+def test_structured_name_and_address():
+    vcard_blob = ("BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Anna Maria Müller\r\nN:Müller;Anna,Maria;;Dr.;\r\n"
+                  "ADR;TYPE=WORK:;;Hauptstraße 5\\, Hinterhaus;Berlin;;10115;Germany\r\nEND:VCARD\r\n")
+    for parse_options in (VOBJECT_OPTIONS, FAST_OPTIONS):
+        contact_data, _ = parse_card(vcard_blob, BOOK_URL, parse_options)
+        assert contact_data["given_name"] == "Anna Maria"
+        assert contact_data["surname"] == "Müller"
+        assert contact_data["street_address"] == "Hauptstraße 5, Hinterhaus"
+        assert contact_data["locality"] == "Berlin"
+        assert contact_data["postal_code"] == "10115"